@@ -0,0 +1,88 @@
+"""add message search
+
+Revision ID: 2cb5e6fcb8a0
+Revises: baefea1d8932
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '2cb5e6fcb8a0'
+down_revision = 'baefea1d8932'
+
+REQUIRED_EXTENSIONS = ['pg_trgm', 'unaccent']
+
+
+def _check_extensions():
+    # Creating an extension requires a superuser, they are created by
+    # wazo-chatd-init-db
+    query = sa.text('SELECT extname FROM pg_extension WHERE extname = ANY(:names)')
+    rows = op.get_bind().execute(query, names=REQUIRED_EXTENSIONS)
+    missing = set(REQUIRED_EXTENSIONS) - set(row.extname for row in rows)
+    if missing:
+        raise RuntimeError(
+            'Missing PostgreSQL extensions: {}. Run wazo-chatd-init-db or create '
+            'them as a superuser before upgrading'.format(', '.join(sorted(missing)))
+        )
+
+
+def upgrade():
+    _check_extensions()
+    op.execute('''
+        CREATE FUNCTION chatd_unaccent(text) RETURNS text AS $$
+            SELECT public.unaccent('public.unaccent', $1)
+        $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+        ''')
+    op.execute('CREATE TEXT SEARCH CONFIGURATION chatd_search (COPY = simple)')
+    op.execute('''
+        ALTER TEXT SEARCH CONFIGURATION chatd_search
+        ALTER MAPPING FOR hword, hword_part, word WITH unaccent, simple
+        ''')
+
+    op.add_column(
+        'chatd_room_message',
+        sa.Column('content_tsvector', postgresql.TSVECTOR),
+    )
+    op.execute('''
+        CREATE FUNCTION chatd_room_message_content_tsvector() RETURNS trigger AS $$
+        BEGIN
+            NEW.content_tsvector := to_tsvector('chatd_search', coalesce(NEW.content, ''));
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        ''')
+    op.execute('''
+        CREATE TRIGGER chatd_room_message_content_tsvector_trigger
+        BEFORE INSERT OR UPDATE OF content ON chatd_room_message
+        FOR EACH ROW EXECUTE PROCEDURE chatd_room_message_content_tsvector()
+        ''')
+    op.execute('''
+        UPDATE chatd_room_message
+        SET content_tsvector = to_tsvector('chatd_search', coalesce(content, ''))
+        ''')
+
+    op.create_index(
+        'chatd_room_message__idx__content_tsvector',
+        'chatd_room_message',
+        ['content_tsvector'],
+        postgresql_using='gin',
+    )
+    op.execute('''
+        CREATE INDEX chatd_room_message__idx__content_trgm
+        ON chatd_room_message USING gin (chatd_unaccent(content) gin_trgm_ops)
+        ''')
+
+
+def downgrade():
+    op.drop_index('chatd_room_message__idx__content_trgm')
+    op.drop_index('chatd_room_message__idx__content_tsvector')
+    op.execute(
+        'DROP TRIGGER chatd_room_message_content_tsvector_trigger ON chatd_room_message'
+    )
+    op.execute('DROP FUNCTION chatd_room_message_content_tsvector()')
+    op.drop_column('chatd_room_message', 'content_tsvector')
+    op.execute('DROP TEXT SEARCH CONFIGURATION chatd_search')
+    op.execute('DROP FUNCTION chatd_unaccent(text)')
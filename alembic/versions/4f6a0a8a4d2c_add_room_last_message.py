@@ -0,0 +1,42 @@
+"""add room last message
+
+Revision ID: 4f6a0a8a4d2c
+Revises: d3a9e2e5f1b7
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy_utils import UUIDType
+
+# revision identifiers, used by Alembic.
+revision = '4f6a0a8a4d2c'
+down_revision = 'd3a9e2e5f1b7'
+
+
+def upgrade():
+    op.add_column(
+        'chatd_room',
+        sa.Column(
+            'last_message_uuid',
+            UUIDType(),
+            sa.ForeignKey(
+                'chatd_room_message.uuid',
+                ondelete='SET NULL',
+                name='chatd_room_last_message_uuid_fkey',
+            ),
+        ),
+    )
+    op.execute('''
+        UPDATE chatd_room SET last_message_uuid = latest.uuid
+        FROM (
+            SELECT DISTINCT ON (room_uuid) room_uuid, uuid
+            FROM chatd_room_message
+            ORDER BY room_uuid, created_at DESC, uuid DESC
+        ) AS latest
+        WHERE chatd_room.uuid = latest.room_uuid
+        ''')
+
+
+def downgrade():
+    op.drop_column('chatd_room', 'last_message_uuid')
@@ -0,0 +1,202 @@
+"""add line state cache
+
+Revision ID: 9e1f5c7a3b62
+Revises: 4f6a0a8a4d2c
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '9e1f5c7a3b62'
+down_revision = '4f6a0a8a4d2c'
+
+LINE_STATES = "('available', 'unavailable', 'holding', 'ringing', 'talking')"
+
+
+def upgrade():
+    op.add_column(
+        'chatd_line',
+        sa.Column(
+            'state',
+            sa.String(24),
+            sa.CheckConstraint(f'state in {LINE_STATES}'),
+            nullable=False,
+            server_default='unavailable',
+        ),
+    )
+    op.add_column(
+        'chatd_user',
+        sa.Column(
+            'line_state',
+            sa.String(24),
+            sa.CheckConstraint(f'line_state in {LINE_STATES}'),
+            nullable=False,
+            server_default='unavailable',
+        ),
+    )
+
+    op.execute('''
+        CREATE FUNCTION chatd_line_state(integer, text) RETURNS varchar AS $$
+            SELECT CASE
+                WHEN bool_or(state = 'ringing') THEN 'ringing'
+                WHEN bool_or(state = 'holding') THEN 'holding'
+                WHEN bool_or(state = 'talking') THEN 'talking'
+                ELSE coalesce(
+                    (SELECT state FROM chatd_endpoint WHERE name = $2), 'unavailable'
+                )
+            END
+            FROM chatd_channel WHERE line_id = $1
+        $$ LANGUAGE sql STABLE
+        ''')
+    op.execute('''
+        CREATE FUNCTION chatd_user_line_state(uuid) RETURNS varchar AS $$
+            SELECT CASE
+                WHEN bool_or(state = 'ringing') THEN 'ringing'
+                WHEN bool_or(state = 'holding') THEN 'holding'
+                WHEN bool_or(state = 'talking') THEN 'talking'
+                WHEN bool_or(state = 'available') THEN 'available'
+                ELSE 'unavailable'
+            END
+            FROM chatd_line WHERE user_uuid = $1
+        $$ LANGUAGE sql STABLE
+        ''')
+    # The row is locked before its state is computed: a concurrent transaction
+    # changing the same line or user waits for the commit, and then computes
+    # the state from the committed changes. The rows are always locked in the
+    # same order to avoid deadlocks: endpoint, lines, then user
+    op.execute('''
+        CREATE FUNCTION chatd_refresh_line_state(integer) RETURNS void AS $$
+        BEGIN
+            PERFORM 1 FROM chatd_line WHERE id = $1 FOR UPDATE;
+            UPDATE chatd_line SET state = chatd_line_state(id, endpoint_name)
+            WHERE id = $1 AND state <> chatd_line_state(id, endpoint_name);
+        END
+        $$ LANGUAGE plpgsql
+        ''')
+    op.execute('''
+        CREATE FUNCTION chatd_refresh_user_line_state(uuid) RETURNS void AS $$
+        BEGIN
+            PERFORM 1 FROM chatd_user WHERE uuid = $1 FOR UPDATE;
+            UPDATE chatd_user SET line_state = chatd_user_line_state(uuid)
+            WHERE uuid = $1 AND line_state <> chatd_user_line_state(uuid);
+        END
+        $$ LANGUAGE plpgsql
+        ''')
+    op.execute('UPDATE chatd_line SET state = chatd_line_state(id, endpoint_name)')
+    op.execute('UPDATE chatd_user SET line_state = chatd_user_line_state(uuid)')
+
+    op.execute('''
+        CREATE FUNCTION chatd_channel_line_state() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM chatd_refresh_line_state(NEW.line_id);
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM chatd_refresh_line_state(OLD.line_id);
+            ELSE
+                PERFORM chatd_refresh_line_state(OLD.line_id);
+                IF NEW.line_id <> OLD.line_id THEN
+                    PERFORM chatd_refresh_line_state(NEW.line_id);
+                END IF;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''')
+    op.execute('''
+        CREATE TRIGGER chatd_channel_line_state_trigger
+        AFTER INSERT OR UPDATE OF state, line_id OR DELETE ON chatd_channel
+        FOR EACH ROW EXECUTE PROCEDURE chatd_channel_line_state()
+        ''')
+
+    op.execute('''
+        CREATE FUNCTION chatd_endpoint_line_state() RETURNS trigger AS $$
+        BEGIN
+            PERFORM 1 FROM chatd_line WHERE endpoint_name = NEW.name
+            ORDER BY id FOR UPDATE;
+            UPDATE chatd_line SET state = chatd_line_state(id, endpoint_name)
+            WHERE endpoint_name = NEW.name
+            AND state <> chatd_line_state(id, endpoint_name);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''')
+    op.execute('''
+        CREATE TRIGGER chatd_endpoint_line_state_trigger
+        AFTER UPDATE OF state ON chatd_endpoint
+        FOR EACH ROW WHEN (OLD.state IS DISTINCT FROM NEW.state)
+        EXECUTE PROCEDURE chatd_endpoint_line_state()
+        ''')
+
+    op.execute('''
+        CREATE FUNCTION chatd_line_state_on_endpoint() RETURNS trigger AS $$
+        BEGIN
+            -- Waits for a concurrent change of the state of a new endpoint. The
+            -- statements changing the endpoint of a line lock it first: the lock
+            -- is then already held, the endpoint is locked before the line
+            IF TG_OP = 'INSERT' THEN
+                PERFORM 1 FROM chatd_endpoint WHERE name = NEW.endpoint_name FOR SHARE;
+            ELSIF NEW.endpoint_name IS DISTINCT FROM OLD.endpoint_name THEN
+                PERFORM 1 FROM chatd_endpoint WHERE name = NEW.endpoint_name FOR SHARE;
+            END IF;
+            NEW.state := chatd_line_state(NEW.id, NEW.endpoint_name);
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        ''')
+    op.execute('''
+        CREATE TRIGGER chatd_line_state_on_endpoint_trigger
+        BEFORE INSERT OR UPDATE OF endpoint_name ON chatd_line
+        FOR EACH ROW EXECUTE PROCEDURE chatd_line_state_on_endpoint()
+        ''')
+
+    # endpoint_name is listed because a state changed by a BEFORE trigger
+    # doesn't fire the column triggers of state
+    op.execute('''
+        CREATE FUNCTION chatd_user_line_state_on_line() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM chatd_refresh_user_line_state(NEW.user_uuid);
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM chatd_refresh_user_line_state(OLD.user_uuid);
+            ELSE
+                PERFORM chatd_refresh_user_line_state(OLD.user_uuid);
+                IF NEW.user_uuid IS DISTINCT FROM OLD.user_uuid THEN
+                    PERFORM chatd_refresh_user_line_state(NEW.user_uuid);
+                END IF;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        ''')
+    op.execute('''
+        CREATE TRIGGER chatd_user_line_state_on_line_trigger
+        AFTER INSERT OR UPDATE OF state, user_uuid, endpoint_name OR DELETE
+        ON chatd_line
+        FOR EACH ROW EXECUTE PROCEDURE chatd_user_line_state_on_line()
+        ''')
+
+    op.create_index(
+        'chatd_user__idx__tenant_uuid_line_state',
+        'chatd_user',
+        ['tenant_uuid', 'line_state'],
+    )
+
+
+def downgrade():
+    op.drop_index('chatd_user__idx__tenant_uuid_line_state')
+    op.execute('DROP TRIGGER chatd_user_line_state_on_line_trigger ON chatd_line')
+    op.execute('DROP FUNCTION chatd_user_line_state_on_line()')
+    op.execute('DROP TRIGGER chatd_line_state_on_endpoint_trigger ON chatd_line')
+    op.execute('DROP FUNCTION chatd_line_state_on_endpoint()')
+    op.execute('DROP TRIGGER chatd_endpoint_line_state_trigger ON chatd_endpoint')
+    op.execute('DROP FUNCTION chatd_endpoint_line_state()')
+    op.execute('DROP TRIGGER chatd_channel_line_state_trigger ON chatd_channel')
+    op.execute('DROP FUNCTION chatd_channel_line_state()')
+    op.execute('DROP FUNCTION chatd_refresh_user_line_state(uuid)')
+    op.execute('DROP FUNCTION chatd_refresh_line_state(integer)')
+    op.execute('DROP FUNCTION chatd_user_line_state(uuid)')
+    op.execute('DROP FUNCTION chatd_line_state(integer, text)')
+    op.drop_column('chatd_user', 'line_state')
+    op.drop_column('chatd_line', 'state')
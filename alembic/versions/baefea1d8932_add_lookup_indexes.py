@@ -0,0 +1,52 @@
+"""add lookup indexes
+
+Revision ID: baefea1d8932
+Revises: 6ba500c45fcc
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'baefea1d8932'
+down_revision = '6ba500c45fcc'
+
+
+def upgrade():
+    op.create_index('chatd_user__idx__tenant_uuid', 'chatd_user', ['tenant_uuid'])
+    op.create_index('chatd_session__idx__user_uuid', 'chatd_session', ['user_uuid'])
+    op.create_index(
+        'chatd_refresh_token__idx__user_uuid', 'chatd_refresh_token', ['user_uuid']
+    )
+    op.create_index('chatd_line__idx__user_uuid', 'chatd_line', ['user_uuid'])
+    op.create_index(
+        'chatd_line__idx__endpoint_name',
+        'chatd_line',
+        ['endpoint_name'],
+        postgresql_where=sa.text('endpoint_name IS NOT NULL'),
+    )
+    op.create_index('chatd_channel__idx__line_id', 'chatd_channel', ['line_id'])
+    op.create_index('chatd_room__idx__tenant_uuid', 'chatd_room', ['tenant_uuid'])
+    op.create_index(
+        'chatd_room_user__idx__uuid_tenant_uuid',
+        'chatd_room_user',
+        ['uuid', 'tenant_uuid'],
+    )
+    op.create_index(
+        'chatd_room_message__idx__room_uuid_created_at',
+        'chatd_room_message',
+        ['room_uuid', 'created_at'],
+    )
+
+
+def downgrade():
+    op.drop_index('chatd_room_message__idx__room_uuid_created_at')
+    op.drop_index('chatd_room_user__idx__uuid_tenant_uuid')
+    op.drop_index('chatd_room__idx__tenant_uuid')
+    op.drop_index('chatd_channel__idx__line_id')
+    op.drop_index('chatd_line__idx__endpoint_name')
+    op.drop_index('chatd_line__idx__user_uuid')
+    op.drop_index('chatd_refresh_token__idx__user_uuid')
+    op.drop_index('chatd_session__idx__user_uuid')
+    op.drop_index('chatd_user__idx__tenant_uuid')
@@ -0,0 +1,30 @@
+"""add message keyset index
+
+Revision ID: d3a9e2e5f1b7
+Revises: 2cb5e6fcb8a0
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'd3a9e2e5f1b7'
+down_revision = '2cb5e6fcb8a0'
+
+
+def upgrade():
+    op.create_index(
+        'chatd_room_message__idx__room_uuid_created_at_uuid',
+        'chatd_room_message',
+        ['room_uuid', 'created_at', 'uuid'],
+    )
+    op.drop_index('chatd_room_message__idx__room_uuid_created_at')
+
+
+def downgrade():
+    op.create_index(
+        'chatd_room_message__idx__room_uuid_created_at',
+        'chatd_room_message',
+        ['room_uuid', 'created_at'],
+    )
+    op.drop_index('chatd_room_message__idx__room_uuid_created_at_uuid')
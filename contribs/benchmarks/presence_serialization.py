@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Copyright 2021 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import datetime
+import json
+import timeit
+import uuid
+
+from wazo_chatd.database.models import Line, RefreshToken, Session, User
+from wazo_chatd.plugins.presences.schemas import UserPresenceSchema, dump_presences
+
+
+def _make_users(count):
+    tenant_uuid = uuid.uuid4()
+    users = []
+    for i in range(count):
+        user = User(
+            uuid=uuid.uuid4(),
+            tenant_uuid=tenant_uuid,
+            state='available',
+            status='at the office',
+            last_activity=datetime.datetime.utcnow(),
+            line_state='talking',
+            do_not_disturb=False,
+        )
+        user.lines.append(Line(id=i, state='talking'))
+        user.sessions.append(Session(uuid=uuid.uuid4(), mobile=False))
+        user.refresh_tokens.append(RefreshToken(client_id='client', mobile=True))
+        users.append(user)
+    return users
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark presence serialization')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    users = _make_users(args.users)
+
+    schema_json = json.dumps(
+        UserPresenceSchema().dump(users, many=True), sort_keys=True
+    )
+    dumper_json = json.dumps(dump_presences(users), sort_keys=True)
+    if schema_json != dumper_json:
+        raise SystemExit('dump_presences differs from UserPresenceSchema')
+
+    candidates = {
+        'UserPresenceSchema().dump': lambda: UserPresenceSchema().dump(
+            users, many=True
+        ),
+        'dump_presences': lambda: dump_presences(users),
+    }
+    results = {}
+    for name, function in candidates.items():
+        results[name] = min(timeit.repeat(function, number=1, repeat=args.repeat))
+        print('{:<28} {:8.1f} ms'.format(name, results[name] * 1000))
+
+    speedup = results['UserPresenceSchema().dump'] / results['dump_presences']
+    print('{} users, speedup: {:.1f}x'.format(args.users, speedup))
+
+
+if __name__ == '__main__':
+    main()
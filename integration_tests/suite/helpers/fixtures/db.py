@@ -235,6 +235,14 @@ def room(**room_args):
             self._session.add(room)
             self._session.flush()
 
+            if room.messages:
+                last_message = max(
+                    room.messages,
+                    key=lambda message: (message.created_at, message.uuid),
+                )
+                room.last_message_uuid = last_message.uuid
+                self._session.flush()
+
             self._session.commit()
             args = list(args) + [room]
             try:
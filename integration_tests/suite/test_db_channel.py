@@ -1,7 +1,7 @@
-# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2020-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from hamcrest import assert_that, equal_to
+from hamcrest import assert_that, contains, empty, equal_to
 from sqlalchemy.inspection import inspect
 
 from .helpers import fixtures
@@ -40,3 +40,32 @@ class TestChannel(DBIntegrationTest):
 
         assert_that(inspect(channel_1).deleted)
         assert_that(inspect(channel_2).deleted)
+
+    @fixtures.db.channel(state='ringing')
+    @fixtures.db.channel(state='talking')
+    def test_update_states(self, channel, unchanged_channel):
+        channels = [
+            {'name': channel.name, 'state': 'talking'},
+            {'name': unchanged_channel.name, 'state': 'talking'},
+        ]
+
+        result = self._dao.channel.update_states(channels)
+
+        assert_that(result, contains(channel.line.user_uuid))
+        self._session.expire_all()
+        assert_that(channel.state, equal_to('talking'))
+
+    @fixtures.db.channel()
+    @fixtures.db.channel()
+    def test_delete_all_by_names(self, channel, other_channel):
+        user_uuid = channel.line.user_uuid
+
+        result = self._dao.channel.delete_all_by_names([channel.name, UNKNOWN_NAME])
+
+        assert_that(result, contains(user_uuid))
+        self._session.expire_all()
+        assert_that(self._dao.channel.find(channel.name), equal_to(None))
+        assert_that(self._dao.channel.find(other_channel.name), equal_to(other_channel))
+
+        result = self._dao.channel.delete_all_by_names([])
+        assert_that(result, empty())
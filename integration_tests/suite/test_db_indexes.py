@@ -0,0 +1,280 @@
+# Copyright 2021 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import uuid
+
+from contextlib import contextmanager
+
+from hamcrest import assert_that, is_not, contains_string, empty
+from sqlalchemy import event, text
+
+from wazo_chatd.database.models import Room, RoomMessage
+from wazo_chatd.plugins.presences.schemas import UserPresenceSchema
+
+from .helpers.base import DBIntegrationTest, use_asset
+
+SEED_TENANTS = 1000
+SEED_USERS_PER_TENANT = 10
+SEED_MESSAGES_PER_ROOM = 20
+SEED_LINE_ID_OFFSET = 2000000
+
+SEED_QUERIES = [
+    '''
+    INSERT INTO chatd_tenant (uuid) SELECT unnest(CAST(:tenant_uuids AS uuid[]))
+    ''',
+    '''
+    INSERT INTO chatd_user (uuid, tenant_uuid, state)
+    SELECT uuid_generate_v4(), chatd_tenant.uuid, 'available'
+    FROM chatd_tenant, generate_series(1, :users_per_tenant)
+    WHERE chatd_tenant.uuid = ANY(CAST(:tenant_uuids AS uuid[]))
+    ''',
+    '''
+    INSERT INTO chatd_endpoint (name, state)
+    SELECT 'PJSIP/seed-' || n, 'available'
+    FROM generate_series(1, :tenants * :users_per_tenant) AS n
+    ''',
+    '''
+    INSERT INTO chatd_line (id, user_uuid, endpoint_name)
+    SELECT :line_offset + n, uuid, 'PJSIP/seed-' || n
+    FROM (
+        SELECT uuid, row_number() OVER (ORDER BY uuid) AS n FROM chatd_user
+        WHERE tenant_uuid = ANY(CAST(:tenant_uuids AS uuid[]))
+    ) AS users
+    ''',
+    '''
+    INSERT INTO chatd_channel (name, state, line_id)
+    SELECT endpoint_name || '-00000001', 'talking', id
+    FROM chatd_line WHERE id > :line_offset
+    ''',
+    '''
+    INSERT INTO chatd_session (uuid, user_uuid, mobile)
+    SELECT uuid_generate_v4(), uuid, false FROM chatd_user
+    WHERE tenant_uuid = ANY(CAST(:tenant_uuids AS uuid[]))
+    ''',
+    '''
+    INSERT INTO chatd_refresh_token (client_id, user_uuid, mobile)
+    SELECT 'seed', uuid, false FROM chatd_user
+    WHERE tenant_uuid = ANY(CAST(:tenant_uuids AS uuid[]))
+    ''',
+    '''
+    INSERT INTO chatd_room (uuid, tenant_uuid)
+    SELECT uuid, tenant_uuid FROM chatd_user
+    WHERE tenant_uuid = ANY(CAST(:tenant_uuids AS uuid[]))
+    ''',
+    '''
+    INSERT INTO chatd_room_user (room_uuid, uuid, tenant_uuid, wazo_uuid)
+    SELECT uuid, uuid, tenant_uuid, tenant_uuid FROM chatd_room
+    WHERE tenant_uuid = ANY(CAST(:tenant_uuids AS uuid[]))
+    ''',
+    '''
+    INSERT INTO chatd_room_message
+        (room_uuid, content, user_uuid, tenant_uuid, wazo_uuid, created_at)
+    SELECT uuid, 'message ' || n, uuid, tenant_uuid, tenant_uuid, now() - n * interval '1 minute'
+    FROM chatd_room, generate_series(1, :messages_per_room) AS n
+    WHERE tenant_uuid = ANY(CAST(:tenant_uuids AS uuid[]))
+    ''',
+    '''
+    UPDATE chatd_room SET last_message_uuid = latest.uuid
+    FROM (
+        SELECT DISTINCT ON (room_uuid) room_uuid, uuid FROM chatd_room_message
+        WHERE tenant_uuid = ANY(CAST(:tenant_uuids AS uuid[]))
+        ORDER BY room_uuid, created_at DESC, uuid DESC
+    ) AS latest
+    WHERE chatd_room.uuid = latest.room_uuid
+    ''',
+]
+
+CLEANUP_QUERIES = [
+    'DELETE FROM chatd_tenant WHERE uuid = ANY(CAST(:tenant_uuids AS uuid[]))',
+    "DELETE FROM chatd_endpoint WHERE name LIKE 'PJSIP/seed-%'",
+]
+
+
+@use_asset('database')
+class TestIndexes(DBIntegrationTest):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._tenant_uuids = [str(uuid.uuid4()) for _ in range(SEED_TENANTS)]
+        cls._execute(SEED_QUERIES)
+        session = cls._Session()
+        session.execute(text('ANALYZE'))
+        session.commit()
+        cls._Session.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._execute(CLEANUP_QUERIES)
+        super().tearDownClass()
+
+    @classmethod
+    def _execute(cls, queries):
+        session = cls._Session()
+        parameters = {
+            'tenant_uuids': cls._tenant_uuids,
+            'tenants': SEED_TENANTS,
+            'users_per_tenant': SEED_USERS_PER_TENANT,
+            'messages_per_room': SEED_MESSAGES_PER_ROOM,
+            'line_offset': SEED_LINE_ID_OFFSET,
+        }
+        for query in queries:
+            session.execute(text(query), parameters)
+        session.commit()
+        cls._Session.remove()
+
+    def setUp(self):
+        super().setUp()
+        row = self._session.execute(
+            text(
+                'SELECT chatd_line.id, chatd_line.endpoint_name, chatd_user.uuid, '
+                'chatd_user.tenant_uuid FROM chatd_line JOIN chatd_user '
+                'ON chatd_user.uuid = chatd_line.user_uuid WHERE chatd_line.id = :id'
+            ),
+            {'id': SEED_LINE_ID_OFFSET + SEED_TENANTS},
+        ).first()
+        self.line_id = row.id
+        self.endpoint_name = row.endpoint_name
+        self.user_uuid = row.uuid
+        self.tenant_uuid = row.tenant_uuid
+
+    def test_channel_queries(self):
+        name = f'{self.endpoint_name}-00000001'
+        new_name = f'{self.endpoint_name}-00000002'
+        with self._assert_index_scans():
+            self._dao.channel.find(name)
+            self._dao.channel.update_states([{'name': name, 'state': 'holding'}])
+            self._dao.channel.create_or_update_all(
+                [
+                    {
+                        'name': new_name,
+                        'state': 'ringing',
+                        'endpoint_name': self.endpoint_name,
+                    }
+                ]
+            )
+            self._dao.channel.delete_all_by_names([name, new_name])
+
+    def test_endpoint_queries(self):
+        with self._assert_index_scans():
+            self._dao.endpoint.find_by(name=self.endpoint_name)
+            self._dao.endpoint.create_all(
+                [{'name': self.endpoint_name, 'state': 'available'}]
+            )
+
+    def test_line_queries(self):
+        with self._assert_index_scans():
+            self._dao.line.find(self.line_id)
+            self._dao.line.find_by(endpoint_name=self.endpoint_name)
+            self._dao.line.find_owner(self.endpoint_name)
+
+    def test_refresh_token_queries(self):
+        with self._assert_index_scans():
+            self._dao.refresh_token.find(self.user_uuid, 'seed')
+
+    def test_session_queries(self):
+        session_uuid = self._session.execute(
+            text('SELECT uuid FROM chatd_session WHERE user_uuid = :uuid'),
+            {'uuid': str(self.user_uuid)},
+        ).scalar()
+        with self._assert_index_scans():
+            self._dao.session.find(session_uuid)
+
+    def test_tenant_queries(self):
+        with self._assert_index_scans():
+            self._dao.tenant.get(self.tenant_uuid)
+
+    def test_user_queries(self):
+        with self._assert_index_scans():
+            self._dao.user.get([self.tenant_uuid], self.user_uuid)
+            self._dao.user.list_([self.tenant_uuid])
+            self._dao.user.count([self.tenant_uuid])
+            users = self._dao.user.list_presences([self.tenant_uuid])
+            UserPresenceSchema().dump(users, many=True)
+            self._dao.user.list_presences_with_count(
+                [self.tenant_uuid], uuids=[self.user_uuid]
+            )
+
+    def test_room_queries(self):
+        room = self._session.query(Room).filter(Room.uuid == self.user_uuid).first()
+        self._session.expire_all()
+        with self._assert_index_scans():
+            self._dao.room.get([self.tenant_uuid], self.user_uuid)
+            self._dao.room.list_([self.tenant_uuid], user_uuid=self.user_uuid)
+            self._dao.room.list_messages(room, limit=10)
+            self._dao.room.list_messages_with_count(room, limit=10)
+            self._dao.room.list_user_messages(
+                self.tenant_uuid, self.user_uuid, limit=10
+            )
+            self._dao.room.list_user_messages_with_count(
+                self.tenant_uuid, self.user_uuid, limit=10
+            )
+
+    def test_room_message_search_queries(self):
+        room = self._session.query(Room).filter(Room.uuid == self.user_uuid).first()
+        self._session.expire_all()
+        with self._assert_index_scans():
+            self._dao.room.list_messages(room, search='message 1', limit=10)
+            self._dao.room.list_messages_with_count(room, search='message 1', limit=10)
+            self._dao.room.list_user_messages(
+                self.tenant_uuid, self.user_uuid, search='message 1', limit=10
+            )
+            self._dao.room.list_user_messages_with_count(
+                self.tenant_uuid,
+                self.user_uuid,
+                search='message 1',
+                order='rank',
+                limit=10,
+            )
+
+    def test_latest_user_messages_queries(self):
+        with self._assert_index_scans():
+            self._dao.room.list_latest_user_messages(
+                self.tenant_uuid, self.user_uuid, limit=10
+            )
+            self._dao.room.count_latest_user_messages(self.tenant_uuid, self.user_uuid)
+
+    def test_room_message_cursor_queries(self):
+        room = self._session.query(Room).filter(Room.uuid == self.user_uuid).first()
+        message = (
+            self._session.query(RoomMessage)
+            .filter(RoomMessage.room_uuid == self.user_uuid)
+            .order_by(RoomMessage.created_at.desc())
+            .offset(SEED_MESSAGES_PER_ROOM // 2)
+            .first()
+        )
+        cursor = (message.created_at, message.uuid)
+        self._session.expire_all()
+        with self._assert_index_scans():
+            self._dao.room.list_messages(room, before=cursor, limit=10)
+            self._dao.room.list_messages(room, after=cursor, limit=10)
+            self._dao.room.list_user_messages(
+                self.tenant_uuid, self.user_uuid, before=cursor, limit=10
+            )
+            self._dao.room.list_user_messages(
+                self.tenant_uuid,
+                self.user_uuid,
+                after=cursor,
+                direction='asc',
+                limit=10,
+            )
+
+    @contextmanager
+    def _assert_index_scans(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, *args):
+            statements.append((statement, parameters))
+
+        engine = self._session.get_bind()
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+        assert_that(statements, is_not(empty()))
+        cursor = self._session.connection().connection.cursor()
+        for statement, parameters in statements:
+            cursor.execute(f'EXPLAIN {statement}', parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            assert_that(plan, is_not(contains_string('Seq Scan')), statement)
@@ -1,6 +1,8 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import threading
+import time
 import uuid
 
 from hamcrest import (
@@ -14,6 +16,8 @@ from hamcrest import (
     has_properties,
 )
 
+from sqlalchemy import text
+
 from wazo_chatd.database.models import Channel
 from wazo_chatd.exceptions import UnknownLineException
 from xivo_test_helpers.hamcrest.raises import raises
@@ -56,6 +60,20 @@ class TestLine(DBIntegrationTest):
         result = self._dao.line.find_by(endpoint_name='unknown')
         assert_that(result, equal_to(None))
 
+    @fixtures.db.tenant(uuid=TENANT_UUID)
+    @fixtures.db.user(uuid=USER_UUID, tenant_uuid=TENANT_UUID)
+    @fixtures.db.endpoint(name='SIP/owned')
+    @fixtures.db.line(user_uuid=USER_UUID, endpoint_name='SIP/owned')
+    def test_find_owner(self, tenant, user, endpoint, line):
+        result = self._dao.line.find_owner('SIP/owned')
+        assert_that(
+            result,
+            has_properties(id=line.id, user_uuid=USER_UUID, tenant_uuid=TENANT_UUID),
+        )
+
+        result = self._dao.line.find_owner('unknown')
+        assert_that(result, equal_to(None))
+
     @fixtures.db.line()
     @fixtures.db.line()
     def test_list(self, line_1, line_2):
@@ -131,3 +149,132 @@ class TestLine(DBIntegrationTest):
 
         self._session.expire_all()
         assert_that(line.channels, empty())
+
+    @fixtures.db.endpoint(name='PJSIP/line-state', state='available')
+    @fixtures.db.line(endpoint_name='PJSIP/line-state')
+    def test_state(self, endpoint, line):
+        assert_that(line.state, equal_to('available'))
+
+        channel = Channel(name='PJSIP/line-state-1', state='ringing')
+        self._dao.line.add_channel(line, channel)
+        assert_that(line.state, equal_to('ringing'))
+
+        channel.state = 'talking'
+        self._dao.channel.update(channel)
+        assert_that(line.state, equal_to('talking'))
+
+        self._dao.line.remove_channel(line, channel)
+        assert_that(line.state, equal_to('available'))
+
+        endpoint.state = 'unavailable'
+        self._dao.endpoint.update(endpoint)
+        assert_that(line.state, equal_to('unavailable'))
+
+    @fixtures.db.line(id=1)
+    @fixtures.db.channel(line_id=1, state='talking')
+    @fixtures.db.channel(line_id=1, state='holding')
+    @fixtures.db.channel(line_id=1, state='ringing')
+    def test_state_priority(self, line, *_):
+        assert_that(line.state, equal_to('ringing'))
+
+    @fixtures.db.endpoint(name='PJSIP/previous', state='available')
+    @fixtures.db.endpoint(name='PJSIP/next', state='available')
+    @fixtures.db.line(endpoint_name='PJSIP/previous')
+    def test_state_when_endpoint_associated_during_its_change(self, _, __, line):
+        line_id = line.id
+
+        self._run_concurrently(
+            lambda: self._associate_endpoint(line_id, 'PJSIP/next'),
+            lambda: self._update_endpoint_state('PJSIP/next', 'unavailable'),
+        )
+
+        self._session.expire_all()
+        result = self._dao.line.get(line_id)
+        assert_that(
+            result, has_properties(endpoint_name='PJSIP/next', state='unavailable')
+        )
+
+    @fixtures.db.endpoint(name='PJSIP/previous', state='available')
+    @fixtures.db.endpoint(name='PJSIP/next', state='available')
+    @fixtures.db.line(endpoint_name='PJSIP/previous')
+    def test_state_when_endpoint_changed_during_its_association(self, _, __, line):
+        line_id = line.id
+
+        self._run_concurrently(
+            lambda: self._update_endpoint_state('PJSIP/next', 'unavailable'),
+            lambda: self._associate_endpoint(line_id, 'PJSIP/next'),
+        )
+
+        self._session.expire_all()
+        result = self._dao.line.get(line_id)
+        assert_that(
+            result, has_properties(endpoint_name='PJSIP/next', state='unavailable')
+        )
+
+    @fixtures.db.endpoint(name='PJSIP/concurrent', state='available')
+    @fixtures.db.line(endpoint_name='PJSIP/concurrent')
+    def test_line_and_endpoint_changed_concurrently(self, _, line):
+        line_id = line.id
+        query = text(
+            'UPDATE chatd_line SET endpoint_name = endpoint_name WHERE id = :id'
+        )
+
+        def add_channel():
+            line = self._dao.line.get(line_id)
+            channel = Channel(name='PJSIP/concurrent-1', state='talking')
+            self._dao.line.add_channel(line, channel)
+
+        self._run_concurrently(
+            add_channel,
+            lambda: self._update_endpoint_state('PJSIP/concurrent', 'unavailable'),
+            then=lambda: self._session.execute(query, {'id': line_id}),
+        )
+
+        self._session.expire_all()
+        result = self._dao.line.get(line_id)
+        assert_that(result, has_properties(state='talking'))
+
+    def _associate_endpoint(self, line_id, endpoint_name):
+        line = self._dao.line.get(line_id)
+        endpoint = self._dao.endpoint.get_by(name=endpoint_name)
+        self._dao.line.associate_endpoint(line, endpoint)
+
+    def _update_endpoint_state(self, endpoint_name, state):
+        endpoint = self._dao.endpoint.get_by(name=endpoint_name)
+        endpoint.state = state
+        self._dao.endpoint.update(endpoint)
+
+    def _run_concurrently(self, first, second, then=None):
+        # Each function runs in its own thread and transaction. The transaction
+        # of first stays open while second waits for its locks, then runs then
+        errors = []
+        first_ran = threading.Event()
+
+        def hold():
+            first_ran.set()
+            time.sleep(0.5)
+            if then:
+                then()
+
+        def run(function, before_commit=None):
+            try:
+                function()
+                if before_commit:
+                    before_commit()
+                self._session.commit()
+            except Exception as e:
+                errors.append(e)
+                self._session.rollback()
+            finally:
+                first_ran.set()
+                self._Session.remove()
+
+        first_thread = threading.Thread(target=run, args=(first, hold))
+        second_thread = threading.Thread(target=run, args=(second,))
+        first_thread.start()
+        first_ran.wait(timeout=5)
+        second_thread.start()
+        first_thread.join(timeout=10)
+        second_thread.join(timeout=10)
+
+        assert_that(errors, empty())
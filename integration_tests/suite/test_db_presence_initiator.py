@@ -1,17 +1,28 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import uuid
 
 from mock import Mock
-from hamcrest import assert_that, equal_to, has_properties
+from hamcrest import (
+    assert_that,
+    calling,
+    contains,
+    equal_to,
+    has_properties,
+    not_,
+    raises,
+)
 
 from .helpers import fixtures
 from .helpers.base import DBIntegrationTest, use_asset
-from wazo_chatd.plugins.presences.initiator import Initiator
+from wazo_chatd.database.models import Endpoint, User
+from wazo_chatd.exceptions import UnknownUserException
+from wazo_chatd.plugins.presences.initiator import Initiator, UserPages
 
 TENANT_UUID = uuid.uuid4()
 USER_UUID = uuid.uuid4()
+USER_UUID_2 = uuid.uuid4()
 LINE_ID = 42
 ENDPOINT_NAME = 'PJSIP/12345'
 
@@ -20,7 +31,7 @@ ENDPOINT_NAME = 'PJSIP/12345'
 class TestDBPresenceInitiator(DBIntegrationTest):
     def setUp(self):
         super().setUp()
-        self.initiator = Initiator(self._dao, Mock, Mock, Mock)
+        self.initiator = Initiator(self._dao, Mock, Mock, Mock, Mock)
 
     @fixtures.db.tenant(uuid=TENANT_UUID)
     def test_initiate_session_when_no_user_associate(self, tenant):
@@ -96,6 +107,29 @@ class TestDBPresenceInitiator(DBIntegrationTest):
         result = self._dao.channel.find(channel.name)
         assert_that(result, has_properties(name=channel.name, state='talking'))
 
+    @fixtures.db.user(uuid=USER_UUID)
+    @fixtures.db.endpoint(name=ENDPOINT_NAME)
+    @fixtures.db.line(id=LINE_ID, user_uuid=USER_UUID, endpoint_name=ENDPOINT_NAME)
+    @fixtures.db.channel(name=f'{ENDPOINT_NAME}-abcd', line_id=LINE_ID)
+    @fixtures.db.channel(name=f'{ENDPOINT_NAME}-efgh', line_id=LINE_ID)
+    def test_initiate_channels_removes_expired_channels(
+        self, user, endpoint, line, channel, expired_channel
+    ):
+        events = [
+            {
+                'Event': 'CoreShowChannel',
+                'Channel': channel.name,
+                'ChannelStateDesc': 'Ringing',
+            }
+        ]
+
+        self.initiator.initiate_channels(events)
+
+        result = self._dao.channel.find(channel.name)
+        assert_that(result, has_properties(name=channel.name, state='ringing'))
+        result = self._dao.channel.find(expired_channel.name)
+        assert_that(result, equal_to(None))
+
     def test_initiate_channels_when_no_line_associate(self):
         channel_name = 'PJSIP/unknown-channel'
         events = [
@@ -118,11 +152,167 @@ class TestDBPresenceInitiator(DBIntegrationTest):
             {
                 'uuid': USER_UUID,
                 'tenant_uuid': TENANT_UUID,
+                'lines': [],
                 'services': {'dnd': {'enabled': True}},
             },
         ]
 
-        self.initiator._update_services_users(confd_users)
+        self.initiator.initiate_users(confd_users)
 
         result = self._dao.user.get([TENANT_UUID], USER_UUID)
         assert_that(result, has_properties(do_not_disturb=True))
+
+    @fixtures.db.tenant(uuid=TENANT_UUID)
+    @fixtures.db.user(uuid=USER_UUID, tenant_uuid=TENANT_UUID)
+    @fixtures.db.user(tenant_uuid=TENANT_UUID)
+    def test_initiate_users(self, _, user, expired_user):
+        confd_users = [
+            {
+                'uuid': str(USER_UUID),
+                'tenant_uuid': str(TENANT_UUID),
+                'lines': [{'id': LINE_ID, 'name': '12345', 'endpoint_sip': {}}],
+                'services': {'dnd': {'enabled': True}},
+            },
+            {
+                'uuid': str(USER_UUID_2),
+                'tenant_uuid': str(TENANT_UUID),
+                'lines': [],
+                'services': {'dnd': {'enabled': False}},
+            },
+        ]
+
+        try:
+            self.initiator.initiate_users(confd_users)
+
+            result = self._dao.user.get([TENANT_UUID], USER_UUID)
+            assert_that(
+                result,
+                has_properties(
+                    do_not_disturb=True,
+                    lines=contains(
+                        has_properties(id=LINE_ID, endpoint_name=ENDPOINT_NAME)
+                    ),
+                ),
+            )
+            assert_that(
+                calling(self._dao.user.get).with_args([TENANT_UUID], USER_UUID_2),
+                not_(raises(UnknownUserException)),
+            )
+            assert_that(
+                calling(self._dao.user.get).with_args([TENANT_UUID], expired_user.uuid),
+                raises(UnknownUserException),
+            )
+        finally:
+            self._session.query(User).filter(User.uuid == USER_UUID_2).delete()
+            self._session.query(Endpoint).filter(
+                Endpoint.name == ENDPOINT_NAME
+            ).delete()
+            self._session.commit()
+
+    @fixtures.db.tenant(uuid=TENANT_UUID)
+    @fixtures.db.user(uuid=USER_UUID, tenant_uuid=TENANT_UUID)
+    @fixtures.db.user(tenant_uuid=TENANT_UUID)
+    def test_initiate_user_pages(self, _, user, expired_user):
+        pages = [
+            [
+                {
+                    'uuid': str(USER_UUID),
+                    'tenant_uuid': str(TENANT_UUID),
+                    'lines': [{'id': LINE_ID, 'name': '12345', 'endpoint_sip': {}}],
+                    'services': {'dnd': {'enabled': True}},
+                },
+            ],
+            [
+                {
+                    'uuid': str(USER_UUID_2),
+                    'tenant_uuid': str(TENANT_UUID),
+                    'lines': [{'id': LINE_ID, 'name': '12345', 'endpoint_sip': {}}],
+                    'services': {'dnd': {'enabled': False}},
+                },
+            ],
+        ]
+
+        try:
+            self.initiator.initiate_user_pages(iter(pages))
+
+            result = self._dao.line.get(LINE_ID)
+            assert_that(result, has_properties(endpoint_name=ENDPOINT_NAME))
+            assert_that(
+                calling(self._dao.user.get).with_args([TENANT_UUID], USER_UUID_2),
+                not_(raises(UnknownUserException)),
+            )
+            assert_that(
+                calling(self._dao.user.get).with_args([TENANT_UUID], expired_user.uuid),
+                raises(UnknownUserException),
+            )
+        finally:
+            self._session.query(User).filter(User.uuid == USER_UUID_2).delete()
+            self._session.query(Endpoint).filter(
+                Endpoint.name == ENDPOINT_NAME
+            ).delete()
+            self._session.commit()
+
+    @fixtures.db.tenant(uuid=TENANT_UUID)
+    @fixtures.db.user(uuid=USER_UUID, tenant_uuid=TENANT_UUID)
+    @fixtures.db.user(tenant_uuid=TENANT_UUID)
+    def test_initiate_user_pages_when_incomplete(self, _, user, missed_user):
+        confd_user = {
+            'uuid': str(USER_UUID),
+            'tenant_uuid': str(TENANT_UUID),
+            'lines': [],
+            'services': {'dnd': {'enabled': True}},
+        }
+        pages = UserPages(
+            lambda offset, limit: {'items': [confd_user], 'total': 2}, page_size=10
+        )
+
+        self.initiator.initiate_user_pages(pages)
+
+        result = self._dao.user.get([TENANT_UUID], USER_UUID)
+        assert_that(result, has_properties(do_not_disturb=True))
+        assert_that(
+            calling(self._dao.user.get).with_args([TENANT_UUID], missed_user.uuid),
+            not_(raises(UnknownUserException)),
+        )
+
+    @fixtures.db.tenant(uuid=TENANT_UUID)
+    @fixtures.db.user(uuid=USER_UUID, tenant_uuid=TENANT_UUID)
+    @fixtures.db.session(user_uuid=USER_UUID, mobile=False)
+    @fixtures.db.session(user_uuid=USER_UUID)
+    def test_initiate_sessions(self, _, user, session, expired_session):
+        sessions = [
+            {
+                'uuid': str(session.uuid),
+                'user_uuid': str(USER_UUID),
+                'tenant_uuid': str(TENANT_UUID),
+                'mobile': True,
+            }
+        ]
+
+        self.initiator.initiate_sessions(sessions)
+
+        result = self._dao.session.find(session.uuid)
+        assert_that(result, has_properties(mobile=True))
+        result = self._dao.session.find(expired_session.uuid)
+        assert_that(result, equal_to(None))
+
+    @fixtures.db.tenant(uuid=TENANT_UUID)
+    @fixtures.db.user(uuid=USER_UUID, tenant_uuid=TENANT_UUID)
+    @fixtures.db.refresh_token(client_id='kept', user_uuid=USER_UUID)
+    @fixtures.db.refresh_token(client_id='expired', user_uuid=USER_UUID)
+    def test_initiate_refresh_tokens(self, _, user, token, expired_token):
+        refresh_tokens = [
+            {
+                'client_id': 'kept',
+                'user_uuid': str(USER_UUID),
+                'tenant_uuid': str(TENANT_UUID),
+                'mobile': True,
+            },
+        ]
+
+        self.initiator.initiate_refresh_tokens(refresh_tokens)
+
+        result = self._dao.refresh_token.find(USER_UUID, 'kept')
+        assert_that(result, has_properties(mobile=True))
+        result = self._dao.refresh_token.find(USER_UUID, 'expired')
+        assert_that(result, equal_to(None))
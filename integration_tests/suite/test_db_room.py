@@ -1,4 +1,4 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import datetime
@@ -98,6 +98,15 @@ class TestRoom(DBIntegrationTest):
         result = self._dao.room.count([room_1.tenant_uuid], user_uuid=USER_UUID_1)
         assert_that(result, equal_to(2))
 
+    @fixtures.db.room(users=[{'uuid': USER_UUID_1}, {'uuid': USER_UUID_2}])
+    @fixtures.db.room(users=[{'uuid': USER_UUID_1}, {'uuid': USER_UUID_3}])
+    @fixtures.db.room(users=[{'uuid': USER_UUID_2}, {'uuid': USER_UUID_3}])
+    def test_list_with_count(self, room_1, room_2, _):
+        result = self._dao.room.list_with_count(
+            [room_1.tenant_uuid], user_uuid=USER_UUID_1
+        )
+        assert_that(result, contains(contains_inanyorder(room_1, room_2), 2, 2))
+
     def test_create(self):
         room = Room(tenant_uuid=TENANT_1)
         room = self._dao.room.create(room)
@@ -135,6 +144,116 @@ class TestRoom(DBIntegrationTest):
         assert_that(inspect(message).persistent)
         assert_that(room.messages, contains(message))
 
+    @fixtures.db.room(messages=[{'content': 'older'}])
+    def test_add_message_updates_last_message(self, room):
+        message = RoomMessage(user_uuid=UUID, tenant_uuid=UUID, wazo_uuid=UUID)
+
+        self._dao.room.add_message(room, message)
+
+        self._session.expire_all()
+        assert_that(room.last_message, equal_to(message))
+
+    @fixtures.db.room(
+        messages=[{'content': 'newer', 'created_at': datetime.datetime(2030, 1, 1)}]
+    )
+    def test_add_message_keeps_more_recent_last_message(self, room):
+        newer = room.messages[0]
+        message = RoomMessage(
+            user_uuid=UUID,
+            tenant_uuid=UUID,
+            wazo_uuid=UUID,
+            created_at=datetime.datetime(2020, 1, 1),
+        )
+
+        self._dao.room.add_message(room, message)
+
+        self._session.expire_all()
+        assert_that(room.last_message, equal_to(newer))
+
+    def test_import(self):
+        room_uuid = uuid.uuid4()
+        created_at = datetime.datetime(2020, 1, 1)
+        older = self._import_message(room_uuid, 'older', created_at)
+        newer = self._import_message(
+            room_uuid, 'newer', created_at + datetime.timedelta(days=1)
+        )
+        rooms = [
+            {
+                'uuid': room_uuid,
+                'name': 'imported',
+                'users': [
+                    {'uuid': USER_UUID_1, 'tenant_uuid': TENANT_1, 'wazo_uuid': UUID}
+                ],
+                'messages': [older, newer],
+            }
+        ]
+
+        result = self._dao.room.import_(TENANT_1, rooms)
+
+        assert_that(
+            result,
+            contains(
+                contains(str(room_uuid)),
+                contains_inanyorder(str(older['uuid']), str(newer['uuid'])),
+            ),
+        )
+        room = self._dao.room.get([TENANT_1], room_uuid)
+        assert_that(room, has_properties(name='imported', tenant_uuid=TENANT_1))
+        assert_that(room.users, contains(has_properties(uuid=USER_UUID_1)))
+        assert_that(
+            room.messages,
+            contains(
+                has_properties(content='newer'),
+                has_properties(content='older', created_at=created_at),
+            ),
+        )
+        assert_that(room.last_message, has_properties(content='newer'))
+
+    @fixtures.db.room(messages=[{'content': 'existing'}])
+    def test_import_existing(self, room):
+        existing = room.messages[0]
+        created_at = existing.created_at + datetime.timedelta(seconds=1)
+        message = self._import_message(room.uuid, 'imported', created_at)
+        rooms = [
+            {
+                'uuid': room.uuid,
+                'name': None,
+                'users': [],
+                'messages': [
+                    self._import_message(room.uuid, 'ignored', created_at, existing),
+                    message,
+                ],
+            }
+        ]
+
+        result = self._dao.room.import_(TENANT_1, rooms)
+
+        assert_that(result, contains(empty(), contains(str(message['uuid']))))
+        self._session.expire_all()
+        assert_that(existing, has_properties(content='existing'))
+        assert_that(room.last_message, has_properties(uuid=message['uuid']))
+
+    @fixtures.db.room(tenant_uuid=TENANT_2)
+    def test_import_room_of_other_tenant(self, room):
+        rooms = [{'uuid': room.uuid, 'name': None, 'users': [], 'messages': []}]
+
+        assert_that(
+            calling(self._dao.room.import_).with_args(TENANT_1, rooms),
+            raises(UnknownRoomException, has_properties(status_code=404)),
+        )
+
+    def _import_message(self, room_uuid, content, created_at, existing=None):
+        return {
+            'uuid': existing.uuid if existing else uuid.uuid4(),
+            'room_uuid': room_uuid,
+            'content': content,
+            'alias': None,
+            'user_uuid': USER_UUID_1,
+            'tenant_uuid': TENANT_1,
+            'wazo_uuid': UUID,
+            'created_at': created_at,
+        }
+
     @fixtures.db.room(messages=[{'content': 'older'}, {'content': 'newer'}])
     def test_list_messages(self, room):
         message_2, message_1 = room.messages
@@ -175,6 +294,102 @@ class TestRoom(DBIntegrationTest):
 
         assert_that(count, equal_to(2))
 
+    @fixtures.db.room(
+        messages=[
+            {'content': 'msg1'},
+            {'content': 'msg2'},
+            {'content': 'msg3'},
+            {'content': 'msg4'},
+        ]
+    )
+    def test_list_messages_keyset(self, room):
+        message_4, message_3, message_2, message_1 = room.messages
+        key = (message_3.created_at, message_3.uuid)
+
+        messages = self._dao.room.list_messages(room, before=key, limit=1)
+        assert_that(messages, contains(message_2))
+
+        messages = self._dao.room.list_messages(
+            room, before=key, direction='asc', limit=1
+        )
+        assert_that(messages, contains(message_2))
+
+        messages = self._dao.room.list_messages(
+            room, after=(message_1.created_at, message_1.uuid)
+        )
+        assert_that(messages, contains(message_4, message_3, message_2))
+
+        messages = self._dao.room.list_messages(
+            room, after=(message_1.created_at, message_1.uuid), limit=2
+        )
+        assert_that(messages, contains(message_3, message_2))
+
+        messages = self._dao.room.list_messages(
+            room,
+            after=(message_1.created_at, message_1.uuid),
+            direction='asc',
+            limit=2,
+        )
+        assert_that(messages, contains(message_2, message_3))
+
+    @fixtures.db.room(
+        messages=[
+            {'content': 'msg1', 'created_at': datetime.datetime(2021, 1, 1)},
+            {'content': 'msg2', 'created_at': datetime.datetime(2021, 1, 1)},
+            {'content': 'msg3', 'created_at': datetime.datetime(2021, 1, 1)},
+        ]
+    )
+    def test_list_messages_keyset_same_created_at(self, room):
+        first, second, third = sorted(
+            room.messages, key=lambda message: message.uuid, reverse=True
+        )
+
+        messages = self._dao.room.list_messages(
+            room, before=(first.created_at, first.uuid), limit=1
+        )
+        assert_that(messages, contains(second))
+
+        messages = self._dao.room.list_messages(
+            room, before=(second.created_at, second.uuid)
+        )
+        assert_that(messages, contains(third))
+
+    @fixtures.db.room(
+        users=[{'uuid': USER_UUID_1, 'tenant_uuid': UUID}],
+        messages=[{'content': 'older'}],
+    )
+    @fixtures.db.room(
+        users=[{'uuid': USER_UUID_1, 'tenant_uuid': UUID}],
+        messages=[{'content': 'newer'}],
+    )
+    def test_list_user_messages_keyset(self, room_1, room_2):
+        message_1, message_2 = room_1.messages[0], room_2.messages[0]
+
+        messages = self._dao.room.list_user_messages(
+            UUID, USER_UUID_1, before=(message_2.created_at, message_2.uuid)
+        )
+        assert_that(messages, contains(message_1))
+
+        messages = self._dao.room.list_user_messages(
+            UUID, USER_UUID_1, after=(message_1.created_at, message_1.uuid)
+        )
+        assert_that(messages, contains(message_2))
+
+    @fixtures.db.room(
+        messages=[{'content': 'older'}, {'content': 'found'}, {'content': 'newer'}]
+    )
+    def test_list_messages_with_count(self, room):
+        message_3, message_2, message_1 = room.messages
+
+        result = self._dao.room.list_messages_with_count(room, limit=1)
+        assert_that(result, contains(contains(message_3), 3, 3))
+
+        result = self._dao.room.list_messages_with_count(room, search='found')
+        assert_that(result, contains(contains(message_2), 1, 3))
+
+        result = self._dao.room.list_messages_with_count(room, offset=3)
+        assert_that(result, contains(empty(), 3, 3))
+
     @fixtures.db.room(
         users=[{'uuid': USER_UUID_1, 'tenant_uuid': UUID}],
         messages=[{'content': 'older'}],
@@ -274,6 +489,34 @@ class TestRoom(DBIntegrationTest):
 
         assert_that(messages, contains(message_found))
 
+    @fixtures.db.room(
+        users=[{'uuid': USER_UUID_1, 'tenant_uuid': UUID}],
+        messages=[{'content': 'hidden'}, {'content': 'unfounded rumor'}],
+    )
+    def test_list_user_messages_search_substring(self, room):
+        message_found, _ = room.messages
+
+        messages = self._dao.room.list_user_messages(UUID, USER_UUID_1, search='found')
+
+        assert_that(messages, contains(message_found))
+
+    @fixtures.db.room(
+        users=[{'uuid': USER_UUID_1, 'tenant_uuid': UUID}],
+        messages=[
+            {'content': 'found once'},
+            {'content': 'found found found'},
+            {'content': 'hidden'},
+        ],
+    )
+    def test_list_user_messages_search_order_by_rank(self, room):
+        _, message_many, message_once = room.messages
+
+        messages = self._dao.room.list_user_messages(
+            UUID, USER_UUID_1, search='found', order='rank'
+        )
+
+        assert_that(messages, contains(message_many, message_once))
+
     @fixtures.db.room(
         users=[{'uuid': USER_UUID_1, 'tenant_uuid': UUID}],
         messages=[
@@ -329,6 +572,28 @@ class TestRoom(DBIntegrationTest):
 
         assert_that(count, equal_to(1))
 
+    @fixtures.db.room(
+        users=[{'uuid': USER_UUID_1, 'tenant_uuid': UUID}],
+        messages=[{'content': 'hidden'}, {'content': 'found'}],
+    )
+    @fixtures.db.room(
+        users=[{'uuid': USER_UUID_1, 'tenant_uuid': UUID}],
+        messages=[{'content': 'not found'}, {'content': 'hidden'}],
+    )
+    def test_list_user_messages_with_count(self, room_1, room_2):
+        result = self._dao.room.list_user_messages_with_count(
+            UUID, USER_UUID_1, limit=1
+        )
+        assert_that(result, contains(contains(room_2.messages[0]), 4, 4))
+
+        result = self._dao.room.list_user_messages_with_count(
+            UUID, USER_UUID_1, distinct='room_uuid'
+        )
+        assert_that(
+            result,
+            contains(contains(room_2.messages[0], room_1.messages[0]), 2, 4),
+        )
+
     @fixtures.db.room(
         users=[{'uuid': USER_UUID_1, 'tenant_uuid': UUID}],
         messages=[{'content': 'older1'}, {'content': 'newer1'}],
@@ -432,6 +697,23 @@ class TestRoom(DBIntegrationTest):
 
         assert_that(count, equal_to(1))
 
+    @fixtures.db.room(
+        users=[{'uuid': USER_UUID_1, 'tenant_uuid': UUID}],
+        messages=[{'content': 'older1'}, {'content': 'newer1'}],
+    )
+    @fixtures.db.room(
+        users=[{'uuid': USER_UUID_2, 'tenant_uuid': UUID}],
+        messages=[{'content': 'older2'}, {'content': 'newer2'}],
+    )
+    def test_list_latest_user_messages_by_pointer(self, room_1, _):
+        message_1 = room_1.messages[0]
+
+        messages = self._dao.room.list_latest_user_messages(UUID, USER_UUID_1)
+        assert_that(messages, contains(message_1))
+
+        count = self._dao.room.count_latest_user_messages(UUID, USER_UUID_1)
+        assert_that(count, equal_to(1))
+
 
 @use_asset('database')
 class TestRoomRelationships(DBIntegrationTest):
@@ -5,21 +5,34 @@ import datetime
 import random
 import uuid
 
+from contextlib import contextmanager
+
 from hamcrest import (
     assert_that,
     calling,
     contains,
+    contains_inanyorder,
     equal_to,
     empty,
     has_items,
+    has_length,
     has_properties,
     is_not,
     none,
 )
+from sqlalchemy import event
 from sqlalchemy.inspection import inspect
 
-from wazo_chatd.database.models import User, Session, Line, RefreshToken
+from wazo_chatd.database.models import (
+    Channel,
+    Endpoint,
+    Line,
+    RefreshToken,
+    Session,
+    User,
+)
 from wazo_chatd.exceptions import UnknownUserException
+from wazo_chatd.plugins.presences.schemas import UserPresenceSchema
 from xivo_test_helpers.hamcrest.raises import raises
 
 from .helpers import fixtures
@@ -119,6 +132,88 @@ class TestUser(DBIntegrationTest):
         result = self._dao.user.list_(tenant_uuids=None, uuids=[UNKNOWN_UUID])
         assert_that(result, empty())
 
+    @fixtures.db.user(tenant_uuid=TENANT_1)
+    @fixtures.db.user(tenant_uuid=TENANT_2)
+    def test_list_presences(self, user_1, user_2):
+        result = self._dao.user.list_presences([user_1.tenant_uuid])
+        assert_that(result, contains(user_1))
+
+        result = self._dao.user.list_presences(tenant_uuids=None, uuids=[user_2.uuid])
+        assert_that(result, contains(user_2))
+
+    @fixtures.db.user(tenant_uuid=TENANT_1)
+    @fixtures.db.user(tenant_uuid=TENANT_1)
+    def test_list_presences_with_count(self, user_1, user_2):
+        result = self._dao.user.list_presences_with_count([TENANT_1])
+        assert_that(result, contains(has_items(user_1, user_2), 2, 2))
+
+        result = self._dao.user.list_presences_with_count(
+            [TENANT_1], uuids=[user_2.uuid]
+        )
+        assert_that(result, contains(contains(user_2), 1, 2))
+
+        result = self._dao.user.list_presences_with_count(
+            [TENANT_1], uuids=[UNKNOWN_UUID]
+        )
+        assert_that(result, contains(empty(), 0, 2))
+
+    @fixtures.db.user(uuid=USER_UUID, tenant_uuid=TENANT_1)
+    @fixtures.db.user(tenant_uuid=TENANT_1)
+    @fixtures.db.line(id=1, user_uuid=USER_UUID)
+    @fixtures.db.line(id=2, user_uuid=USER_UUID)
+    @fixtures.db.channel(line_id=2, state='talking')
+    def test_list_presences_by_line_state(self, user_1, user_2, *_):
+        assert_that(user_1.line_state, equal_to('talking'))
+        assert_that(user_2.line_state, equal_to('unavailable'))
+
+        result = self._dao.user.list_presences_with_count(
+            [TENANT_1], line_state='talking'
+        )
+        assert_that(result, contains(contains(user_1), 1, 2))
+
+    def test_list_presences_constant_query_count(self):
+        self._create_users_with_presence(2)
+        with self._count_queries() as few_users_queries:
+            users = self._dao.user.list_presences(tenant_uuids=[TENANT_2])
+            UserPresenceSchema().dump(users, many=True)
+        assert_that(users, has_length(2))
+
+        self._create_users_with_presence(20)
+        with self._count_queries() as many_users_queries:
+            users = self._dao.user.list_presences(tenant_uuids=[TENANT_2])
+            UserPresenceSchema().dump(users, many=True)
+        assert_that(users, has_length(22))
+
+        assert_that(many_users_queries, has_length(len(few_users_queries)))
+
+    def _create_users_with_presence(self, count):
+        for _ in range(count):
+            line_id = random.randint(1, 1000000)
+            user = User(uuid=uuid.uuid4(), tenant_uuid=TENANT_2, state='available')
+            endpoint = Endpoint(name=f'PJSIP/{line_id}', state='available')
+            line = Line(id=line_id, endpoint=endpoint)
+            line.channels.append(Channel(name=f'PJSIP/{line_id}-1', state='talking'))
+            user.lines.append(line)
+            user.sessions.append(Session(uuid=uuid.uuid4(), mobile=True))
+            user.refresh_tokens.append(RefreshToken(client_id='client', mobile=False))
+            self._session.add(user)
+        self._session.flush()
+        self._session.expire_all()
+
+    @contextmanager
+    def _count_queries(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = self._session.get_bind()
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
     @fixtures.db.user(tenant_uuid=TENANT_1)
     @fixtures.db.user(tenant_uuid=TENANT_2)
     def test_count(self, user_1, user_2):
@@ -154,6 +249,40 @@ class TestUser(DBIntegrationTest):
             ),
         )
 
+    @fixtures.db.user(tenant_uuid=TENANT_1, status='unchanged')
+    @fixtures.db.user(tenant_uuid=TENANT_1, status='old status')
+    @fixtures.db.user(tenant_uuid=TENANT_2, state='available')
+    def test_update_presences(self, user_1, user_2, user_3):
+        last_activity = datetime.datetime.now()
+        presences = [
+            {'uuid': user_1.uuid, 'state': 'away'},
+            {'uuid': user_2.uuid, 'state': 'invisible', 'status': None},
+        ]
+
+        result = self._dao.user.update_presences([TENANT_1], presences, last_activity)
+
+        assert_that(result, contains_inanyorder(str(user_1.uuid), str(user_2.uuid)))
+        self._session.expire_all()
+        assert_that(
+            user_1,
+            has_properties(
+                state='away', status='unchanged', last_activity=last_activity
+            ),
+        )
+        assert_that(user_2, has_properties(state='invisible', status=None))
+
+        presences = [
+            {'uuid': user_1.uuid, 'state': 'available'},
+            {'uuid': user_3.uuid, 'state': 'away'},
+        ]
+
+        result = self._dao.user.update_presences([TENANT_1], presences, last_activity)
+
+        assert_that(result, empty())
+        self._session.expire_all()
+        assert_that(user_1, has_properties(state='away'))
+        assert_that(user_3, has_properties(state='available', last_activity=None))
+
     @fixtures.db.user()
     def test_add_session(self, user):
         session_uuid = uuid.uuid4()
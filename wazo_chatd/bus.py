@@ -1,13 +1,19 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import json
 import logging
+import queue
+import time
 
+from collections import deque
 from contextlib import contextmanager
-from threading import Thread
+from functools import partial
+from threading import Thread, local
 
 import kombu
 
+from kombu.exceptions import OperationalError
 from kombu.mixins import ConsumerMixin
 
 from xivo.status import Status
@@ -40,6 +46,67 @@ ROUTING_KEY_MAPPING = {
 }
 
 
+def _event_key(event):
+    # Events of the same user or endpoint must be handled in order
+    if event.get('user_uuid'):
+        return event['user_uuid']
+    if isinstance(event.get('user'), dict):
+        return event['user'].get('uuid')
+    if event.get('Device'):
+        return event['Device']
+    if event.get('Channel'):
+        return event['Channel'].rsplit('-', 1)[0]
+    return event.get('uuid')
+
+
+class _Delivery:
+    __slots__ = ('message', 'done', 'deferred')
+
+    def __init__(self, message):
+        self.message = message
+        self.done = False
+        self.deferred = False
+
+    def ack(self):
+        self.done = True
+
+
+class _KeyedDispatcher:
+    def __init__(self, workers, queue_size):
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+
+    def start(self):
+        for index, tasks in enumerate(self._queues):
+            thread_name = 'bus_consumer_worker_{}'.format(index)
+            thread = Thread(target=self._work, args=(tasks,), name=thread_name)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for tasks in self._queues:
+            tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def dispatch(self, key, task):
+        # Blocks when the worker is late, which stops the consumption of
+        # messages once the prefetch count is reached
+        index = hash(key) % len(self._queues) if key is not None else 0
+        self._queues[index].put(task)
+
+    def _work(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            try:
+                task()
+            except Exception:
+                logger.exception('Error while handling bus event')
+
+
 @contextmanager
 def consumer_thread(consumer):
     thread_name = 'bus_consumer_thread'
@@ -57,25 +124,49 @@ def consumer_thread(consumer):
 class Consumer(ConsumerMixin):
     def __init__(self, global_config):
         self._events_pubsub = Pubsub()
+        self._config = global_config['bus']
 
         self._bus_url = 'amqp://{username}:{password}@{host}:{port}//'.format(
-            **global_config['bus']
+            **self._config
         )
         self._exchange = kombu.Exchange(
-            global_config['bus']['exchange_name'],
-            type=global_config['bus']['exchange_type'],
+            self._config['exchange_name'], type=self._config['exchange_type']
         )
-        self._queue = kombu.Queue(exclusive=True)
+        if self._config['consumer_queue_name']:
+            self._queue = kombu.Queue(
+                self._config['consumer_queue_name'], durable=True, auto_delete=False
+            )
+        else:
+            self._queue = kombu.Queue(exclusive=True)
         self._is_running = False
+        self._revived_callbacks = []
+        self._connection_count = 0
+        self._dispatcher = _KeyedDispatcher(
+            self._config['consumer_workers'], self._config['consumer_worker_queue_size']
+        )
+        self._deliveries = deque()
+        self._event_key = None
+        self._handling = local()
+        self._reset_acks()
 
     def run(self):
         logger.info("Running AMQP consumer")
-        with kombu.Connection(self._bus_url) as connection:
-            self.connection = connection
-            super().run()
+        self._dispatcher.start()
+        try:
+            with kombu.Connection(self._bus_url) as connection:
+                self.connection = connection
+                super().run()
+        finally:
+            self._dispatcher.stop()
 
     def get_consumers(self, Consumer, channel):
-        return [Consumer(self._queue, callbacks=[self._on_bus_message])]
+        return [
+            Consumer(
+                self._queue,
+                callbacks=[self._on_bus_message],
+                prefetch_count=self._config['consumer_prefetch_count'],
+            )
+        ]
 
     def on_connection_error(self, exc, interval):
         super().on_connection_error(exc, interval)
@@ -84,6 +175,40 @@ class Consumer(ConsumerMixin):
     def on_connection_revived(self):
         super().on_connection_revived()
         self._is_running = True
+        self._connection_count += 1
+        # Deliveries of the previous channel can't be acked anymore
+        self._deliveries.clear()
+        self._reset_acks()
+        # The exclusive queue is recreated on each connection: events sent
+        # while disconnected are lost
+        if self._connection_count > 1 and self._queue.exclusive:
+            for callback in self._revived_callbacks:
+                callback()
+
+    def on_iteration(self):
+        self._ack_handled()
+        if not self._unacked_message:
+            return
+        elapsed = time.monotonic() - self._unacked_since
+        if elapsed >= self._config['consumer_ack_interval']:
+            self._ack_pending()
+
+    def on_consume_end(self, connection, channel):
+        self._ack_handled()
+        if self._unacked_message:
+            self._ack_pending()
+
+    def on_revived(self, callback):
+        self._revived_callbacks.append(callback)
+
+    def set_event_key(self, callback):
+        # The events with the same key are handled in order, a callback
+        # returning None keeps the default key
+        self._event_key = callback
+
+    def dispatch(self, key, task):
+        # Runs a task in order with the events of the same key
+        self._dispatcher.dispatch(key, task)
 
     def is_running(self):
         return self._is_running
@@ -101,38 +226,259 @@ class Consumer(ConsumerMixin):
         self._events_pubsub.subscribe(event_name, callback)
 
     def _on_bus_message(self, body, message):
+        delivery = _Delivery(message)
+        self._deliveries.append(delivery)
         try:
             event = body['data']
             event_name = body['name']
         except KeyError:
-            logger.error('Invalid event message received: %s', event)
+            logger.error('Invalid event message received: %s', body)
+            delivery.done = True
         else:
+            task = partial(self._handle, event_name, event, delivery)
+            self._dispatcher.dispatch(self._key(event), task)
+        finally:
+            self._ack_handled()
+
+    def _key(self, event):
+        key = None
+        if self._event_key:
+            try:
+                key = self._event_key(event)
+            except Exception:
+                logger.exception('Error while computing the key of a bus event')
+        return key if key is not None else _event_key(event)
+
+    def defer_ack(self):
+        # For a handler applying its event later: the message is acked once
+        # the returned callback is called
+        delivery = self._handling.delivery
+        delivery.deferred = True
+        return delivery.ack
+
+    def _handle(self, event_name, event, delivery):
+        self._handling.delivery = delivery
+        try:
             self._events_pubsub.publish(event_name, event)
         finally:
-            message.ack()
+            self._handling.delivery = None
+            # Handlers commit their transaction before returning
+            if not delivery.deferred:
+                delivery.done = True
+
+    def _ack_handled(self):
+        # Messages are handled out of order by the workers: only the messages
+        # delivered before the first one still being handled can be acked
+        while self._deliveries and self._deliveries[0].done:
+            self._ack_later(self._deliveries.popleft().message)
+
+    def _ack_later(self, message):
+        if not self._unacked_message:
+            self._unacked_since = time.monotonic()
+        self._unacked_message = message
+        self._unacked_count += 1
+        if self._unacked_count >= self._config['consumer_ack_batch_size']:
+            self._ack_pending()
+
+    def _ack_pending(self):
+        # Acknowledge every message delivered up to the last one at once
+        self._unacked_message.ack(multiple=True)
+        self._reset_acks()
+
+    def _reset_acks(self):
+        self._unacked_message = None
+        self._unacked_count = 0
+        self._unacked_since = None
 
     def stop(self):
         self.should_stop = True
 
 
-# Must be recreated for each request
-# TODO can be optimized to be instantiated only once by request
-# when the endpoint need to send many messages
+class _PayloadPlaceholder:
+    # Marshaled in place of an event to build its envelope (name, origin,
+    # required_acl, ...) around a payload that is already serialized
+    placeholder = '__wazo_chatd_payload__'
+
+    def __init__(self, event):
+        self._event = event
+
+    def __getattr__(self, name):
+        return getattr(self._event, name)
+
+    def marshal(self):
+        return self.placeholder
+
+
+class _BatchMarshaler(Marshaler):
+    # Events of a batch usually share the same payload (e.g. one message sent
+    # to every user of a room): serialize it once and reuse it for the batch.
+    # The envelope is built for each event, it contains per event metadata
+    def __init__(self, uuid):
+        super().__init__(uuid)
+        self._cache = {}
+
+    def marshal_message(self, event, *args, **kwargs):
+        if args or kwargs:
+            return super().marshal_message(event, *args, **kwargs)
+
+        data = event.marshal()
+        key = id(data)
+        if key not in self._cache:
+            # keep a reference on data to prevent its id from being reused
+            self._cache[key] = (data, json.dumps(data))
+        envelope = super().marshal_message(_PayloadPlaceholder(event))
+        placeholder = json.dumps(_PayloadPlaceholder.placeholder)
+        return envelope.replace(placeholder, self._cache[key][1], 1)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class _PublisherStopped(Exception):
+    pass
+
+
+@contextmanager
+def publisher_thread(publisher):
+    thread_name = 'bus_publisher_thread'
+    thread = Thread(target=publisher.run, name=thread_name)
+    thread.start()
+    try:
+        yield
+    finally:
+        logger.debug('stopping bus publisher thread')
+        publisher.stop()
+        logger.debug('joining bus publisher thread')
+        thread.join()
+
+
 class Publisher:
+    _latency_samples = 100
+    _queue_poll_interval = 0.5
+
     def __init__(self, config):
         self._config = config['bus']
         self._uuid = config['uuid']
         self._url = 'amqp://{username}:{password}@{host}:{port}//'.format(
             **self._config
         )
+        self._queue = queue.Queue(maxsize=self._config['publisher_queue_size'])
+        self._latencies = deque(maxlen=self._latency_samples)
+        self._dropped = 0
+        self._is_running = False
+        self._should_stop = False
 
-    def publish(self, event, headers=None):
-        bus_connection = kombu.Connection(self._url)
-        bus_exchange = kombu.Exchange(
+    def run(self):
+        logger.info("Running AMQP publisher")
+        exchange = kombu.Exchange(
             self._config['exchange_name'], type=self._config['exchange_type']
         )
-        bus_producer = kombu.Producer(
-            bus_connection, exchange=bus_exchange, auto_declare=True
+        marshaler = _BatchMarshaler(self._uuid)
+        max_retries = self._config['publisher_max_retries']
+        # The channel of the producer is connected with the transport options,
+        # kombu retries forever by default
+        transport_options = {'max_retries': max_retries}
+        with kombu.Connection(
+            self._url, transport_options=transport_options
+        ) as connection:
+            producer = kombu.Producer(connection, exchange=exchange, auto_declare=True)
+            publisher = FailFastPublisher(producer, marshaler)
+            publish = connection.ensure(
+                producer,
+                publisher.publish,
+                errback=self._on_connection_error,
+                max_retries=max_retries,
+            )
+            while not self._should_stop or self._is_running:
+                try:
+                    messages = self._queue.get(timeout=self._queue_poll_interval)
+                except queue.Empty:
+                    if self._should_stop:
+                        break
+                    if not self._is_running:
+                        self._connect(connection, max_retries=1)
+                    continue
+                if not self._is_running and not self._connect(connection, max_retries):
+                    self._drop(messages)
+                    continue
+                self._publish(publish, messages)
+                marshaler.clear()
+
+        # Events can't be published once stopped without a connection
+        while not self._queue.empty():
+            self._drop(self._queue.get_nowait())
+
+    def _connect(self, connection, max_retries):
+        try:
+            connection.ensure_connection(
+                errback=self._on_connection_error,
+                max_retries=max_retries,
+                callback=self._check_stopped,
+            )
+        except (OperationalError, _PublisherStopped):
+            return False
+        self._is_running = True
+        return True
+
+    def _check_stopped(self):
+        # Called while waiting between the connection retries
+        if self._should_stop:
+            raise _PublisherStopped()
+
+    def _drop(self, messages):
+        self._dropped += len(messages)
+        logger.error('Bus publisher not connected, dropping %s event(s)', len(messages))
+
+    def _publish(self, publish, messages):
+        start = time.monotonic()
+        for i, (event, headers) in enumerate(messages):
+            try:
+                publish(event, headers=headers)
+            except _PublisherStopped:
+                self._drop(messages[i:])
+                return
+            except Exception:
+                self._is_running = False
+                logger.exception('Failed to publish event "%s"', event.name)
+            else:
+                self._is_running = True
+        self._latencies.append(time.monotonic() - start)
+
+    def _on_connection_error(self, exc, interval):
+        self._is_running = False
+        # Stop retrying when the publisher is stopped while the broker is down
+        self._check_stopped()
+        logger.error(
+            'Bus publisher connection error: %s. Retrying in %s seconds...',
+            exc,
+            interval,
         )
-        bus_marshaler = Marshaler(self._uuid)
-        FailFastPublisher(bus_producer, bus_marshaler).publish(event, headers=headers)
+
+    def publish(self, event, headers=None):
+        self.publish_many([(event, headers)])
+
+    def publish_many(self, messages):
+        messages = list(messages)
+        try:
+            self._queue.put_nowait(messages)
+        except queue.Full:
+            self._dropped += len(messages)
+            logger.error(
+                'Bus publisher queue is full, dropping %s event(s)', len(messages)
+            )
+
+    def is_running(self):
+        return self._is_running
+
+    def provide_status(self, status):
+        latencies = list(self._latencies)
+        latency = sum(latencies) / len(latencies) if latencies else 0
+        status['bus_publisher']['status'] = (
+            Status.ok if self.is_running() else Status.fail
+        )
+        status['bus_publisher']['queue_size'] = self._queue.qsize()
+        status['bus_publisher']['dropped_events'] = self._dropped
+        status['bus_publisher']['publish_latency_ms'] = round(latency * 1000, 3)
+
+    def stop(self):
+        self._should_stop = True
@@ -1,4 +1,4 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import argparse
@@ -42,6 +42,14 @@ _DEFAULT_CONFIG = {
         'exchange_name': 'xivo',
         'exchange_type': 'topic',
         'exchange_headers_name': 'wazo-headers',
+        'publisher_queue_size': 1024,
+        'publisher_max_retries': 3,
+        'consumer_queue_name': None,
+        'consumer_prefetch_count': 100,
+        'consumer_ack_batch_size': 20,
+        'consumer_ack_interval': 0.5,
+        'consumer_workers': 4,
+        'consumer_worker_queue_size': 10,
     },
     'amid': {'host': 'localhost', 'port': 9491, 'prefix': None, 'https': False},
     'confd': {
@@ -69,7 +77,21 @@ _DEFAULT_CONFIG = {
         'rooms': True,
         'status': True,
     },
-    'initialization': {'enabled': True},
+    'presence_notifications': {'coalesce_window': 0.05},
+    'presence_changes': {'log_size': 10000},
+    'channel_events': {'batch_window': 0.01},
+    'initialization': {
+        'enabled': True,
+        'users_page_size': 500,
+        'timeouts': {
+            'endpoints': 30,
+            'tenants': 30,
+            'users': 120,
+            'sessions': 30,
+            'refresh_tokens': 30,
+            'channels': 30,
+        },
+    },
 }
 
 
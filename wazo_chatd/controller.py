@@ -51,12 +51,14 @@ class Controller:
     def run(self):
         logger.info('wazo-chatd starting...')
         self.status_aggregator.add_provider(self.bus_consumer.provide_status)
+        self.status_aggregator.add_provider(self.bus_publisher.provide_status)
         signal.signal(signal.SIGTERM, partial(_sigterm_handler, self))
 
         with self.thread_manager:
-            with bus.consumer_thread(self.bus_consumer):
-                with ServiceCatalogRegistration(*self._service_discovery_args):
-                    self.rest_api.run()
+            with bus.publisher_thread(self.bus_publisher):
+                with bus.consumer_thread(self.bus_consumer):
+                    with ServiceCatalogRegistration(*self._service_discovery_args):
+                        self.rest_api.run()
 
     def stop(self, reason):
         logger.warning('Stopping wazo-chatd: %s', reason)
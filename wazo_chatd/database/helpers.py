@@ -1,11 +1,14 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from contextlib import contextmanager
+from itertools import chain
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, func, inspect, text
 from sqlalchemy.orm import sessionmaker, scoped_session
 
+from .models import Channel, Endpoint, Line, User
+
 Session = scoped_session(sessionmaker())
 
 
@@ -14,9 +17,84 @@ def init_db(db_uri, echo=False):
     Session.configure(bind=engine)
 
 
+@event.listens_for(Session, 'after_flush')
+def _collect_line_changes(session, flush_context):
+    # Line states are updated by triggers when channels, endpoints or lines change
+    line_ids, endpoint_names, user_uuids = set(), set(), set()
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, Channel):
+            line_ids.update(_history_values(instance, 'line_id'))
+        elif isinstance(instance, Endpoint):
+            endpoint_names.add(instance.name)
+        elif isinstance(instance, Line):
+            line_ids.update(_history_values(instance, 'id'))
+            user_uuids.update(_history_values(instance, 'user_uuid'))
+
+    if line_ids or endpoint_names:
+        changes = session.info.setdefault('line_changes', (set(), set(), set()))
+        for values, changed in zip(changes, (line_ids, endpoint_names, user_uuids)):
+            values.update(changed)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _expire_line_states(session, flush_context):
+    changes = session.info.pop('line_changes', None)
+    if not changes:
+        return
+
+    # Only the lines and users of the changes are expired, the others keep
+    # their loaded state
+    line_ids, endpoint_names, user_uuids = changes
+    resolved_line_ids, resolved_endpoint_names = set(), set()
+    users = []
+    for instance in session.identity_map.values():
+        if isinstance(instance, User):
+            users.append(instance)
+            continue
+        if not isinstance(instance, Line):
+            continue
+        values = inspect(instance).dict
+        if (
+            values.get('id') in line_ids
+            or values.get('endpoint_name') in endpoint_names
+        ):
+            session.expire(instance, ['state'])
+            user_uuids.add(values.get('user_uuid'))
+            resolved_line_ids.add(values.get('id'))
+            resolved_endpoint_names.add(values.get('endpoint_name'))
+
+    if not users:
+        return
+
+    line_ids -= resolved_line_ids
+    endpoint_names -= resolved_endpoint_names
+    if line_ids or endpoint_names:
+        # The owners of the lines that are not loaded
+        query = text('''
+            SELECT user_uuid FROM chatd_line
+            WHERE id = ANY(CAST(:ids AS integer[]))
+            OR endpoint_name = ANY(CAST(:endpoint_names AS text[]))
+            ''')
+        parameters = {'ids': list(line_ids), 'endpoint_names': list(endpoint_names)}
+        user_uuids.update(row.user_uuid for row in session.execute(query, parameters))
+
+    user_uuids = {str(user_uuid) for user_uuid in user_uuids if user_uuid}
+    for user in users:
+        if str(inspect(user).dict.get('uuid')) in user_uuids:
+            session.expire(user, ['line_state'])
+
+
+def _history_values(instance, key):
+    # The previous values are changed too, e.g. the line a channel moved from
+    history = inspect(instance).attrs[key].history
+    return {value for value in history.sum() if value is not None}
+
+
 @contextmanager
-def session_scope():
+def session_scope(bind=None):
     session = Session()
+    if bind is not None:
+        session.bind = bind
     try:
         yield session
         session.commit()
@@ -25,3 +103,57 @@ def session_scope():
         raise
     finally:
         Session.remove()
+
+
+@contextmanager
+def connection_scope():
+    # The sessions bound to this connection share its temporary tables, without
+    # keeping a transaction open between them
+    connection = Session.get_bind().connect()
+    Session.remove()
+    try:
+        yield connection
+    finally:
+        connection.execute(text('DISCARD TEMP').execution_options(autocommit=True))
+        connection.close()
+
+
+def on_commit(callback):
+    # Run once the current transaction is committed, never for a transaction
+    # that is rolled back
+    Session().info.setdefault('on_commit', []).append(callback)
+
+
+@event.listens_for(Session, 'after_commit')
+def _run_on_commit(session):
+    for callback in session.info.pop('on_commit', []):
+        callback()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_on_commit(session, previous_transaction):
+    session.info.pop('on_commit', None)
+
+
+def list_with_count(query, paginate=None, total_query=None):
+    filtered_column = func.count().over().label('filtered')
+    columns = [filtered_column]
+    if total_query is not None:
+        total = total_query.with_entities(func.count()).order_by(None).as_scalar()
+        columns.append(total.label('total'))
+
+    list_query = query.add_columns(*columns)
+    if paginate:
+        list_query = paginate(list_query)
+    rows = list_query.all()
+
+    if not rows:
+        # Counts are carried by the rows, an empty page needs its own queries
+        filtered = query.count()
+        total = filtered if total_query is None else total_query.count()
+        return [], filtered, total
+
+    items = [row[0] for row in rows]
+    filtered = rows[0].filtered
+    total = filtered if total_query is None else rows[0].total
+    return items, filtered, total
@@ -1,4 +1,4 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import datetime
@@ -8,19 +8,24 @@ from sqlalchemy import (
     CheckConstraint,
     Column,
     DateTime,
+    FetchedValue,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
     text,
 )
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy_utils import UUIDType, generic_repr
 
 Base = declarative_base()
 
+LINE_STATES = "('available', 'unavailable', 'holding', 'ringing', 'talking')"
+
 
 @generic_repr
 class Tenant(Base):
@@ -34,6 +39,10 @@ class Tenant(Base):
 class User(Base):
 
     __tablename__ = 'chatd_user'
+    __table_args__ = (
+        Index('chatd_user__idx__tenant_uuid', 'tenant_uuid'),
+        Index('chatd_user__idx__tenant_uuid_line_state', 'tenant_uuid', 'line_state'),
+    )
 
     uuid = Column(UUIDType(), primary_key=True)
     tenant_uuid = Column(
@@ -49,6 +58,14 @@ class User(Base):
     status = Column(Text())
     do_not_disturb = Column(Boolean(), nullable=False, server_default='false')
     last_activity = Column(DateTime())
+    # Maintained by triggers from the state of the lines
+    line_state = Column(
+        String(24),
+        CheckConstraint(f'line_state in {LINE_STATES}'),
+        nullable=False,
+        server_default='unavailable',
+        server_onupdate=FetchedValue(),
+    )
 
     tenant = relationship('Tenant')
     sessions = relationship(
@@ -64,6 +81,7 @@ class User(Base):
 class Session(Base):
 
     __tablename__ = 'chatd_session'
+    __table_args__ = (Index('chatd_session__idx__user_uuid', 'user_uuid'),)
 
     uuid = Column(UUIDType(), primary_key=True)
     mobile = Column(Boolean, nullable=False, default=False)
@@ -81,6 +99,7 @@ class Session(Base):
 class RefreshToken(Base):
 
     __tablename__ = 'chatd_refresh_token'
+    __table_args__ = (Index('chatd_refresh_token__idx__user_uuid', 'user_uuid'),)
 
     client_id = Column(Text, nullable=False, primary_key=True)
     user_uuid = Column(
@@ -99,11 +118,27 @@ class RefreshToken(Base):
 class Line(Base):
 
     __tablename__ = 'chatd_line'
+    __table_args__ = (
+        Index('chatd_line__idx__user_uuid', 'user_uuid'),
+        Index(
+            'chatd_line__idx__endpoint_name',
+            'endpoint_name',
+            postgresql_where=text('endpoint_name IS NOT NULL'),
+        ),
+    )
 
     id = Column(Integer, primary_key=True)
     user_uuid = Column(UUIDType(), ForeignKey('chatd_user.uuid', ondelete='CASCADE'))
     endpoint_name = Column(Text, ForeignKey('chatd_endpoint.name', ondelete='SET NULL'))
     media = Column(String(24), CheckConstraint("media in ('audio', 'video')"))
+    # Maintained by triggers from the states of the endpoint and the channels
+    state = Column(
+        String(24),
+        CheckConstraint(f'state in {LINE_STATES}'),
+        nullable=False,
+        server_default='unavailable',
+        server_onupdate=FetchedValue(),
+    )
     user = relationship('User', viewonly=True)
     tenant_uuid = association_proxy('user', 'tenant_uuid')
 
@@ -135,6 +170,7 @@ class Endpoint(Base):
 class Channel(Base):
 
     __tablename__ = 'chatd_channel'
+    __table_args__ = (Index('chatd_channel__idx__line_id', 'line_id'),)
 
     name = Column(Text, primary_key=True)
     state = Column(
@@ -154,6 +190,7 @@ class Channel(Base):
 class Room(Base):
 
     __tablename__ = 'chatd_room'
+    __table_args__ = (Index('chatd_room__idx__tenant_uuid', 'tenant_uuid'),)
 
     uuid = Column(
         UUIDType(), server_default=text('uuid_generate_v4()'), primary_key=True
@@ -164,6 +201,15 @@ class Room(Base):
         ForeignKey('chatd_tenant.uuid', ondelete='CASCADE'),
         nullable=False,
     )
+    last_message_uuid = Column(
+        UUIDType(),
+        ForeignKey(
+            'chatd_room_message.uuid',
+            ondelete='SET NULL',
+            name='chatd_room_last_message_uuid_fkey',
+            use_alter=True,
+        ),
+    )
 
     users = relationship('RoomUser', cascade='all,delete-orphan', passive_deletes=False)
     messages = relationship(
@@ -171,6 +217,10 @@ class Room(Base):
         cascade='all,delete-orphan',
         passive_deletes=False,
         order_by='desc(RoomMessage.created_at)',
+        foreign_keys='RoomMessage.room_uuid',
+    )
+    last_message = relationship(
+        'RoomMessage', foreign_keys=[last_message_uuid], viewonly=True
     )
 
 
@@ -178,6 +228,9 @@ class Room(Base):
 class RoomUser(Base):
 
     __tablename__ = 'chatd_room_user'
+    __table_args__ = (
+        Index('chatd_room_user__idx__uuid_tenant_uuid', 'uuid', 'tenant_uuid'),
+    )
 
     room_uuid = Column(
         UUIDType(),
@@ -193,6 +246,24 @@ class RoomUser(Base):
 class RoomMessage(Base):
 
     __tablename__ = 'chatd_room_message'
+    __table_args__ = (
+        Index(
+            'chatd_room_message__idx__room_uuid_created_at_uuid',
+            'room_uuid',
+            'created_at',
+            'uuid',
+        ),
+        Index(
+            'chatd_room_message__idx__content_tsvector',
+            'content_tsvector',
+            postgresql_using='gin',
+        ),
+        Index(
+            'chatd_room_message__idx__content_trgm',
+            text('chatd_unaccent(content) gin_trgm_ops'),
+            postgresql_using='gin',
+        ),
+    )
 
     uuid = Column(
         UUIDType(), server_default=text('uuid_generate_v4()'), primary_key=True
@@ -203,10 +274,11 @@ class RoomMessage(Base):
         nullable=False,
     )
     content = Column(Text)
+    content_tsvector = deferred(Column(TSVECTOR))
     alias = Column(String(256))
     user_uuid = Column(UUIDType(), nullable=False)
     tenant_uuid = Column(UUIDType(), nullable=False)
     wazo_uuid = Column(UUIDType(), nullable=False)
     created_at = Column(DateTime(), default=datetime.datetime.utcnow, nullable=False)
 
-    room = relationship('Room', viewonly=True)
+    room = relationship('Room', foreign_keys=[room_uuid], viewonly=True)
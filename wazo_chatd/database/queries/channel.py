@@ -1,4 +1,4 @@
-# Copyright 2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2020-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from sqlalchemy import and_, text
@@ -32,3 +32,67 @@ class ChannelDAO:
     def delete_all(self):
         self.session.query(Channel).delete()
         self.session.flush()
+
+    def create_or_update_all(self, channels):
+        query = text('''
+            WITH changed AS (
+                INSERT INTO chatd_channel (name, state, line_id)
+                SELECT DISTINCT ON (new.name) new.name, new.state, chatd_line.id
+                FROM unnest(
+                    CAST(:names AS text[]),
+                    CAST(:states AS text[]),
+                    CAST(:endpoint_names AS text[])
+                ) AS new(name, state, endpoint_name)
+                JOIN chatd_line ON chatd_line.endpoint_name = new.endpoint_name
+                ON CONFLICT (name) DO UPDATE
+                SET state = excluded.state, line_id = excluded.line_id
+                WHERE (chatd_channel.state, chatd_channel.line_id)
+                    IS DISTINCT FROM (excluded.state, excluded.line_id)
+                RETURNING line_id
+            )
+            SELECT chatd_line.user_uuid FROM changed
+            JOIN chatd_line ON chatd_line.id = changed.line_id
+            ''')
+        parameters = {
+            'names': [channel['name'] for channel in channels],
+            'states': [channel['state'] for channel in channels],
+            'endpoint_names': [channel['endpoint_name'] for channel in channels],
+        }
+        return [row.user_uuid for row in self.session.execute(query, parameters)]
+
+    def update_states(self, channels):
+        query = text('''
+            UPDATE chatd_channel SET state = new.state
+            FROM unnest(
+                CAST(:names AS text[]),
+                CAST(:states AS text[])
+            ) AS new(name, state), chatd_line
+            WHERE chatd_channel.name = new.name
+            AND chatd_channel.state <> new.state
+            AND chatd_line.id = chatd_channel.line_id
+            RETURNING chatd_line.user_uuid
+            ''')
+        parameters = {
+            'names': [channel['name'] for channel in channels],
+            'states': [channel['state'] for channel in channels],
+        }
+        return [row.user_uuid for row in self.session.execute(query, parameters)]
+
+    def delete_all_by_names(self, names):
+        query = text('''
+            DELETE FROM chatd_channel USING chatd_line
+            WHERE chatd_channel.name = ANY(CAST(:names AS text[]))
+            AND chatd_line.id = chatd_channel.line_id
+            RETURNING chatd_line.user_uuid
+            ''')
+        rows = self.session.execute(query, {'names': list(names)})
+        return [row.user_uuid for row in rows]
+
+    def delete_all_except(self, names):
+        query = text('''
+            DELETE FROM chatd_channel WHERE NOT EXISTS (
+                SELECT 1 FROM unnest(CAST(:names AS text[])) AS keep(name)
+                WHERE keep.name = chatd_channel.name
+            )
+            ''')
+        return self.session.execute(query, {'names': list(names)}).rowcount
@@ -1,4 +1,4 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from sqlalchemy import and_, text
@@ -50,3 +50,15 @@ class EndpointDAO:
     def delete_all(self):
         self.session.query(Endpoint).delete()
         self.session.flush()
+
+    def create_all(self, endpoints):
+        query = text('''
+            INSERT INTO chatd_endpoint (name, state)
+            SELECT * FROM unnest(CAST(:names AS text[]), CAST(:states AS text[]))
+            ON CONFLICT DO NOTHING
+            ''')
+        parameters = {
+            'names': [endpoint['name'] for endpoint in endpoints],
+            'states': [endpoint['state'] for endpoint in endpoints],
+        }
+        return self.session.execute(query, parameters).rowcount
@@ -1,10 +1,10 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from sqlalchemy import and_, text
 
 from ...exceptions import UnknownLineException
-from ..models import Line
+from ..models import Line, User
 
 
 class LineDAO:
@@ -37,6 +37,14 @@ class LineDAO:
 
         return self.session.query(Line).filter(filter_).first()
 
+    def find_owner(self, endpoint_name):
+        query = (
+            self.session.query(Line.id, Line.user_uuid, User.tenant_uuid)
+            .join(User, User.uuid == Line.user_uuid)
+            .filter(Line.endpoint_name == endpoint_name)
+        )
+        return query.first()
+
     def list_(self):
         return self.session.query(Line).all()
 
@@ -44,7 +52,100 @@ class LineDAO:
         self.session.add(line)
         self.session.flush()
 
+    def create_staging(self):
+        query = text('''
+            CREATE TEMPORARY TABLE chatd_line_staging (
+                id integer NOT NULL,
+                user_uuid uuid NOT NULL,
+                endpoint_name text
+            )
+            ''')
+        self.session.execute(query)
+
+    def stage(self, lines):
+        query = text('''
+            INSERT INTO chatd_line_staging (id, user_uuid, endpoint_name)
+            SELECT * FROM unnest(
+                CAST(:ids AS integer[]),
+                CAST(:user_uuids AS uuid[]),
+                CAST(:endpoint_names AS text[])
+            )
+            ''')
+        parameters = {
+            'ids': [line['id'] for line in lines],
+            'user_uuids': [str(line['user_uuid']) for line in lines],
+            'endpoint_names': [line['endpoint_name'] for line in lines],
+        }
+        self.session.execute(query, parameters)
+
+    def list_staged_shared_ids(self):
+        query = text('''
+            SELECT id FROM chatd_line_staging
+            GROUP BY id HAVING count(DISTINCT user_uuid) > 1
+            ''')
+        return [row.id for row in self.session.execute(query)]
+
+    def sync_staged(self, delete_missing=True):
+        self.session.execute(text('ANALYZE chatd_line_staging'))
+
+        query = '''
+            DELETE FROM chatd_line WHERE NOT EXISTS (
+                SELECT 1 FROM chatd_line_staging AS staged
+                WHERE staged.id = chatd_line.id
+                AND staged.user_uuid = chatd_line.user_uuid
+            )
+            '''
+        if not delete_missing:
+            # The lines missing from the staging may only have been missed
+            query += 'AND id IN (SELECT id FROM chatd_line_staging)'
+        deleted = self.session.execute(text(query)).rowcount
+
+        query = text('''
+            INSERT INTO chatd_line (id, user_uuid)
+            SELECT DISTINCT ON (staged.id) staged.id, staged.user_uuid
+            FROM chatd_line_staging AS staged
+            JOIN chatd_user ON chatd_user.uuid = staged.user_uuid
+            ON CONFLICT DO NOTHING
+            ''')
+        created = self.session.execute(query).rowcount
+
+        return created, deleted
+
+    def associate_staged_endpoints(self):
+        # Disconnected SCCP endpoints are missing from the AMI snapshot
+        query = text('''
+            INSERT INTO chatd_endpoint (name, state)
+            SELECT DISTINCT endpoint_name, 'unavailable' FROM chatd_line_staging
+            WHERE endpoint_name IS NOT NULL
+            ON CONFLICT DO NOTHING
+            ''')
+        created = self.session.execute(query).rowcount
+
+        # Endpoints are locked before their lines, like the line state triggers
+        query = text('''
+            SELECT 1 FROM chatd_endpoint
+            WHERE name IN (SELECT endpoint_name FROM chatd_line_staging)
+            ORDER BY name
+            FOR SHARE
+            ''')
+        self.session.execute(query)
+
+        query = text('''
+            UPDATE chatd_line SET endpoint_name = staged.endpoint_name
+            FROM chatd_line_staging AS staged
+            WHERE chatd_line.id = staged.id
+            AND chatd_line.user_uuid = staged.user_uuid
+            AND staged.endpoint_name IS NOT NULL
+            AND chatd_line.endpoint_name IS DISTINCT FROM staged.endpoint_name
+            ''')
+        associated = self.session.execute(query).rowcount
+
+        return created, associated
+
     def associate_endpoint(self, line, endpoint):
+        # Endpoints are locked before their lines, like the line state triggers
+        query = text('SELECT 1 FROM chatd_endpoint WHERE name = :name FOR SHARE')
+        self.session.execute(query, {'name': endpoint.name})
         line.endpoint = endpoint
         self.session.flush()
 
@@ -1,4 +1,4 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from sqlalchemy import and_, text
@@ -41,3 +41,43 @@ class RefreshTokenDAO:
     def update(self, refresh_token):
         self.session.add(refresh_token)
         self.session.flush()
+
+    def create_or_update_all(self, refresh_tokens):
+        query = text('''
+            INSERT INTO chatd_refresh_token (client_id, user_uuid, mobile)
+            SELECT new.client_id, new.user_uuid, new.mobile
+            FROM unnest(
+                CAST(:client_ids AS text[]),
+                CAST(:user_uuids AS uuid[]),
+                CAST(:tenant_uuids AS uuid[]),
+                CAST(:mobiles AS boolean[])
+            ) AS new(client_id, user_uuid, tenant_uuid, mobile)
+            JOIN chatd_user ON chatd_user.uuid = new.user_uuid
+                AND chatd_user.tenant_uuid = new.tenant_uuid
+            ON CONFLICT (client_id, user_uuid) DO UPDATE
+            SET mobile = excluded.mobile
+            WHERE chatd_refresh_token.mobile <> excluded.mobile
+            ''')
+        parameters = {
+            'client_ids': [token['client_id'] for token in refresh_tokens],
+            'user_uuids': [str(token['user_uuid']) for token in refresh_tokens],
+            'tenant_uuids': [str(token['tenant_uuid']) for token in refresh_tokens],
+            'mobiles': [token['mobile'] for token in refresh_tokens],
+        }
+        return self.session.execute(query, parameters).rowcount
+
+    def delete_all_except(self, refresh_tokens):
+        query = text('''
+            DELETE FROM chatd_refresh_token WHERE NOT EXISTS (
+                SELECT 1
+                FROM unnest(CAST(:client_ids AS text[]), CAST(:user_uuids AS uuid[]))
+                    AS keep(client_id, user_uuid)
+                WHERE keep.client_id = chatd_refresh_token.client_id
+                AND keep.user_uuid = chatd_refresh_token.user_uuid
+            )
+            ''')
+        parameters = {
+            'client_ids': [token['client_id'] for token in refresh_tokens],
+            'user_uuids': [str(token['user_uuid']) for token in refresh_tokens],
+        }
+        return self.session.execute(query, parameters).rowcount
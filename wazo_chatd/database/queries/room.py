@@ -1,14 +1,17 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from sqlalchemy.sql.functions import ReturnTypeFromArgs
-from sqlalchemy import text
+from sqlalchemy import and_, func, or_, text
 
 from ...exceptions import UnknownRoomException
+from ..helpers import list_with_count
 from ..models import Room, RoomUser, RoomMessage
 
+SEARCH_CONFIGURATION = 'chatd_search'
 
-class unaccent(ReturnTypeFromArgs):
+
+class chatd_unaccent(ReturnTypeFromArgs):
     pass
 
 
@@ -40,6 +43,10 @@ class RoomDAO:
     def count(self, tenant_uuids, **filter_parameters):
         return self._list_query(tenant_uuids, **filter_parameters).count()
 
+    def list_with_count(self, tenant_uuids, **filter_parameters):
+        query = self._list_query(tenant_uuids, **filter_parameters)
+        return list_with_count(query)
+
     def _list_query(self, tenant_uuids=None, user_uuid=None):
         query = self.session.query(Room)
 
@@ -55,41 +62,209 @@ class RoomDAO:
         return query.filter(Room.tenant_uuid.in_(tenant_uuids))
 
     def add_message(self, room, message):
+        # Locked before the next statement reads the last message: a message
+        # committed meanwhile by a concurrent request is then visible
+        query = text('''
+            SELECT 1 FROM chatd_room
+            WHERE uuid = CAST(:room_uuid AS uuid)
+            FOR NO KEY UPDATE
+            ''')
+        self.session.execute(query, {'room_uuid': str(room.uuid)})
         room.messages.append(message)
         self.session.flush()
 
+        # Concurrent messages can be committed out of order, the last message
+        # is only replaced by a more recent one
+        query = text('''
+            UPDATE chatd_room SET last_message_uuid = CAST(:uuid AS uuid)
+            WHERE uuid = CAST(:room_uuid AS uuid)
+            AND NOT EXISTS (
+                SELECT 1 FROM chatd_room_message AS last
+                WHERE last.uuid = chatd_room.last_message_uuid
+                AND (last.created_at, last.uuid)
+                    >= (CAST(:created_at AS timestamp), CAST(:uuid AS uuid))
+            )
+            ''')
+        parameters = {
+            'uuid': str(message.uuid),
+            'room_uuid': str(room.uuid),
+            'created_at': message.created_at,
+        }
+        self.session.execute(query, parameters)
+        self.session.expire(room, ['last_message_uuid', 'last_message'])
+
+    def import_(self, tenant_uuid, rooms):
+        room_uuids = [str(room['uuid']) for room in rooms]
+        # Checked before writing, an error response doesn't rollback the request
+        query = text('''
+            SELECT uuid FROM chatd_room
+            WHERE uuid = ANY(CAST(:uuids AS uuid[]))
+            AND tenant_uuid <> CAST(:tenant_uuid AS uuid)
+            LIMIT 1
+            ''')
+        parameters = {'uuids': room_uuids, 'tenant_uuid': str(tenant_uuid)}
+        for row in self.session.execute(query, parameters):
+            raise UnknownRoomException(row.uuid)
+
+        query = text('''
+            INSERT INTO chatd_room (uuid, name, tenant_uuid)
+            SELECT new.uuid, new.name, CAST(:tenant_uuid AS uuid)
+            FROM unnest(
+                CAST(:uuids AS uuid[]),
+                CAST(:names AS text[])
+            ) AS new(uuid, name)
+            ON CONFLICT DO NOTHING
+            RETURNING uuid
+            ''')
+        parameters['names'] = [room['name'] for room in rooms]
+        created = [row.uuid for row in self.session.execute(query, parameters)]
+
+        users = [(room, user) for room in rooms for user in room['users']]
+        query = text('''
+            INSERT INTO chatd_room_user (room_uuid, uuid, tenant_uuid, wazo_uuid)
+            SELECT * FROM unnest(
+                CAST(:room_uuids AS uuid[]),
+                CAST(:uuids AS uuid[]),
+                CAST(:tenant_uuids AS uuid[]),
+                CAST(:wazo_uuids AS uuid[])
+            )
+            ON CONFLICT DO NOTHING
+            ''')
+        parameters = {
+            'room_uuids': [str(room['uuid']) for room, _ in users],
+            'uuids': [str(user['uuid']) for _, user in users],
+            'tenant_uuids': [str(user['tenant_uuid']) for _, user in users],
+            'wazo_uuids': [str(user['wazo_uuid']) for _, user in users],
+        }
+        self.session.execute(query, parameters)
+
+        messages = [message for room in rooms for message in room['messages']]
+        query = text('''
+            INSERT INTO chatd_room_message (
+                uuid,
+                room_uuid,
+                content,
+                alias,
+                user_uuid,
+                tenant_uuid,
+                wazo_uuid,
+                created_at
+            )
+            SELECT * FROM unnest(
+                CAST(:uuids AS uuid[]),
+                CAST(:room_uuids AS uuid[]),
+                CAST(:contents AS text[]),
+                CAST(:aliases AS varchar[]),
+                CAST(:user_uuids AS uuid[]),
+                CAST(:tenant_uuids AS uuid[]),
+                CAST(:wazo_uuids AS uuid[]),
+                CAST(:created_ats AS timestamp[])
+            )
+            ON CONFLICT DO NOTHING
+            RETURNING uuid
+            ''')
+        parameters = {
+            'uuids': [str(message['uuid']) for message in messages],
+            'room_uuids': [str(message['room_uuid']) for message in messages],
+            'contents': [message['content'] for message in messages],
+            'aliases': [message['alias'] for message in messages],
+            'user_uuids': [str(message['user_uuid']) for message in messages],
+            'tenant_uuids': [str(message['tenant_uuid']) for message in messages],
+            'wazo_uuids': [str(message['wazo_uuid']) for message in messages],
+            'created_ats': [message['created_at'] for message in messages],
+        }
+        created_messages = [row.uuid for row in self.session.execute(query, parameters)]
+
+        query = text('''
+            UPDATE chatd_room SET last_message_uuid = latest.uuid
+            FROM (
+                SELECT DISTINCT ON (room_uuid) room_uuid, uuid
+                FROM chatd_room_message
+                WHERE room_uuid = ANY(CAST(:room_uuids AS uuid[]))
+                ORDER BY room_uuid, created_at DESC, uuid DESC
+            ) AS latest
+            WHERE chatd_room.uuid = latest.room_uuid
+            AND chatd_room.last_message_uuid IS DISTINCT FROM latest.uuid
+            ''')
+        self.session.execute(query, {'room_uuids': room_uuids})
+        return created, created_messages
+
     def list_messages(self, room, **filter_parameters):
         query = self._build_messages_query(room.uuid)
         query = self._list_filter(query, **filter_parameters)
         query = self._paginate(query, **filter_parameters)
-        return query.all()
+        return self._fetch_page(query, **filter_parameters)
 
     def count_messages(self, room, **filter_parameters):
         query = self._build_messages_query(room.uuid)
         query = self._list_filter(query, **filter_parameters)
         return query.count()
 
+    def list_messages_with_count(self, room, **filter_parameters):
+        query = self._build_messages_query(room.uuid)
+        total_query = query if self._is_filtered(**filter_parameters) else None
+        query = self._list_filter(query, **filter_parameters)
+        return list_with_count(
+            query,
+            paginate=lambda query: self._paginate(query, **filter_parameters),
+            total_query=total_query,
+        )
+
     def _build_messages_query(self, room_uuid):
         return self.session.query(RoomMessage).filter(
             RoomMessage.room_uuid == room_uuid
         )
 
     def list_user_messages(self, tenant_uuid, user_uuid, **filter_parameters):
-        query = self._build_user_messages_query(tenant_uuid, user_uuid)
+        query = self._build_user_messages_query(
+            tenant_uuid, user_uuid, **filter_parameters
+        )
         query = self._list_filter(query, **filter_parameters)
         query = self._paginate(query, **filter_parameters)
-        return query.all()
+        return self._fetch_page(query, **filter_parameters)
 
     def count_user_messages(self, tenant_uuid, user_uuid, **filter_parameters):
-        query = self._build_user_messages_query(tenant_uuid, user_uuid)
+        query = self._build_user_messages_query(
+            tenant_uuid, user_uuid, **filter_parameters
+        )
         query = self._list_filter(query, **filter_parameters)
         return query.count()
 
-    def _build_user_messages_query(self, tenant_uuid, user_uuid, *filters):
+    def list_user_messages_with_count(
+        self, tenant_uuid, user_uuid, **filter_parameters
+    ):
+        query = self._build_user_messages_query(
+            tenant_uuid, user_uuid, **filter_parameters
+        )
+        total_query = None
+        if self._is_filtered(**filter_parameters):
+            total_query = self._build_user_messages_query(tenant_uuid, user_uuid)
+        query = self._list_filter(query, **filter_parameters)
+        return list_with_count(
+            query,
+            paginate=lambda query: self._paginate(query, **filter_parameters),
+            total_query=total_query,
+        )
+
+    def list_latest_user_messages(self, tenant_uuid, user_uuid, **filter_parameters):
+        filter_parameters['distinct'] = 'room_uuid'
+        return self.list_user_messages(tenant_uuid, user_uuid, **filter_parameters)
+
+    def count_latest_user_messages(self, tenant_uuid, user_uuid, **filter_parameters):
+        filter_parameters['distinct'] = 'room_uuid'
+        return self.count_user_messages(tenant_uuid, user_uuid, **filter_parameters)
+
+    def _build_user_messages_query(
+        self, tenant_uuid, user_uuid, distinct=None, **ignored
+    ):
+        query = self.session.query(RoomMessage)
+        if distinct == 'room_uuid':
+            query = query.join(Room, Room.last_message_uuid == RoomMessage.uuid)
+        else:
+            query = query.join(Room, Room.uuid == RoomMessage.room_uuid)
+
         return (
-            self.session.query(RoomMessage)
-            .join(Room)
-            .join(RoomUser)
+            query.join(RoomUser)
             .filter(RoomUser.tenant_uuid == tenant_uuid)
             .filter(RoomUser.uuid == user_uuid)
         )
@@ -101,11 +276,48 @@ class RoomDAO:
         offset=None,
         order='created_at',
         direction='desc',
+        search=None,
+        before=None,
+        after=None,
         **ignored
     ):
+        if before is not None:
+            created_at, uuid = before
+            query = query.filter(
+                RoomMessage.created_at <= created_at,
+                or_(
+                    RoomMessage.created_at < created_at,
+                    and_(RoomMessage.created_at == created_at, RoomMessage.uuid < uuid),
+                ),
+            )
+        if after is not None:
+            created_at, uuid = after
+            query = query.filter(
+                RoomMessage.created_at >= created_at,
+                or_(
+                    RoomMessage.created_at > created_at,
+                    and_(RoomMessage.created_at == created_at, RoomMessage.uuid > uuid),
+                ),
+            )
+        if self._is_reversed(direction, before, after):
+            direction = 'asc' if direction == 'desc' else 'desc'
+
+        if order == 'rank':
+            if search is not None:
+                rank_column = func.ts_rank(
+                    RoomMessage.content_tsvector, self._search_query(search)
+                )
+                rank_column = (
+                    rank_column.asc() if direction == 'asc' else rank_column.desc()
+                )
+                query = query.order_by(rank_column)
+            order = 'created_at'
+
         order_column = getattr(RoomMessage, order)
-        order_column = order_column.asc() if direction == 'asc' else order_column.desc()
-        query = query.order_by(order_column)
+        if direction == 'asc':
+            query = query.order_by(order_column.asc(), RoomMessage.uuid.asc())
+        else:
+            query = query.order_by(order_column.desc(), RoomMessage.uuid.desc())
 
         if limit is not None:
             query = query.limit(limit)
@@ -114,23 +326,39 @@ class RoomDAO:
 
         return query
 
-    def _list_filter(
-        self, query, search=None, from_date=None, distinct=None, **ignored
-    ):
-        if distinct is not None:
-            distinct_field = getattr(RoomMessage, distinct)
-            query = (
-                query.distinct(distinct_field)
-                .order_by(distinct_field, RoomMessage.created_at.desc())
-                .from_self()
-            )
+    def _fetch_page(self, query, direction='desc', before=None, after=None, **ignored):
+        items = query.all()
+        if self._is_reversed(direction, before, after):
+            items.reverse()
+        return items
 
+    def _is_reversed(self, direction, before, after):
+        # The rows closest to the cursor must be fetched first for the LIMIT to
+        # apply on the right side of it, then returned in the requested order
+        if after is not None:
+            return direction == 'desc'
+        if before is not None:
+            return direction == 'asc'
+        return False
+
+    def _is_filtered(self, search=None, from_date=None, distinct=None, **ignored):
+        return search is not None or from_date is not None or distinct is not None
+
+    def _list_filter(self, query, search=None, from_date=None, **ignored):
         if search is not None:
             words = [word for word in search.split(' ') if word]
             pattern = '%{}%'.format('%'.join(words))
-            query = query.filter(unaccent(RoomMessage.content).ilike(pattern))
+            query = query.filter(
+                or_(
+                    RoomMessage.content_tsvector.op('@@')(self._search_query(search)),
+                    chatd_unaccent(RoomMessage.content).ilike(chatd_unaccent(pattern)),
+                )
+            )
 
         if from_date is not None:
             query = query.filter(RoomMessage.created_at >= from_date)
 
         return query
+
+    def _search_query(self, search):
+        return func.plainto_tsquery(SEARCH_CONFIGURATION, search)
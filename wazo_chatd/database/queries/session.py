@@ -1,4 +1,4 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from sqlalchemy import and_, text
@@ -39,3 +39,38 @@ class SessionDAO:
     def update(self, session):
         self.session.add(session)
         self.session.flush()
+
+    def create_or_update_all(self, sessions):
+        query = text('''
+            INSERT INTO chatd_session (uuid, user_uuid, mobile)
+            SELECT new.uuid, new.user_uuid, new.mobile
+            FROM unnest(
+                CAST(:uuids AS uuid[]),
+                CAST(:user_uuids AS uuid[]),
+                CAST(:tenant_uuids AS uuid[]),
+                CAST(:mobiles AS boolean[])
+            ) AS new(uuid, user_uuid, tenant_uuid, mobile)
+            JOIN chatd_user ON chatd_user.uuid = new.user_uuid
+                AND chatd_user.tenant_uuid = new.tenant_uuid
+            ON CONFLICT (uuid) DO UPDATE
+            SET user_uuid = excluded.user_uuid, mobile = excluded.mobile
+            WHERE (chatd_session.user_uuid, chatd_session.mobile)
+                IS DISTINCT FROM (excluded.user_uuid, excluded.mobile)
+            ''')
+        parameters = {
+            'uuids': [str(session['uuid']) for session in sessions],
+            'user_uuids': [str(session['user_uuid']) for session in sessions],
+            'tenant_uuids': [str(session['tenant_uuid']) for session in sessions],
+            'mobiles': [session['mobile'] for session in sessions],
+        }
+        return self.session.execute(query, parameters).rowcount
+
+    def delete_all_except(self, session_uuids):
+        query = text('''
+            DELETE FROM chatd_session WHERE NOT EXISTS (
+                SELECT 1 FROM unnest(CAST(:uuids AS uuid[])) AS keep(uuid)
+                WHERE keep.uuid = chatd_session.uuid
+            )
+            ''')
+        uuids = [str(uuid) for uuid in session_uuids]
+        return self.session.execute(query, {'uuids': uuids}).rowcount
@@ -1,6 +1,8 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from sqlalchemy import text
+
 from ...exceptions import UnknownTenantException
 from ..models import Tenant
 
@@ -38,3 +40,22 @@ class TenantDAO:
     def delete(self, tenant):
         self.session.delete(tenant)
         self.session.flush()
+
+    def create_all(self, tenant_uuids):
+        query = text('''
+            INSERT INTO chatd_tenant (uuid)
+            SELECT unnest(CAST(:uuids AS uuid[]))
+            ON CONFLICT DO NOTHING
+            ''')
+        uuids = [str(uuid) for uuid in tenant_uuids]
+        return self.session.execute(query, {'uuids': uuids}).rowcount
+
+    def delete_all_except(self, tenant_uuids):
+        query = text('''
+            DELETE FROM chatd_tenant WHERE NOT EXISTS (
+                SELECT 1 FROM unnest(CAST(:uuids AS uuid[])) AS keep(uuid)
+                WHERE keep.uuid = chatd_tenant.uuid
+            )
+            ''')
+        uuids = [str(uuid) for uuid in tenant_uuids]
+        return self.session.execute(query, {'uuids': uuids}).rowcount
@@ -1,9 +1,11 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from sqlalchemy import text
+from sqlalchemy.orm import selectinload
 
 from ...exceptions import UnknownUserException
+from ..helpers import list_with_count
 from ..models import User
 
 
@@ -42,6 +44,63 @@ class UserDAO:
         )
         return query.all()
 
+    def list_presences(self, tenant_uuids, uuids=None, **filter_parameters):
+        query = self._get_presences_query(
+            tenant_uuids,
+            uuids=uuids,
+            **filter_parameters,
+        )
+        return query.all()
+
+    def list_presences_with_count(self, tenant_uuids, uuids=None, **filter_parameters):
+        query = self._get_presences_query(
+            tenant_uuids,
+            uuids=uuids,
+            **filter_parameters,
+        )
+        filtered = uuids or filter_parameters.get('line_state')
+        total_query = self._get_users_query(tenant_uuids) if filtered else None
+        return list_with_count(query, total_query=total_query)
+
+    def update_presences(self, tenant_uuids, presences, last_activity):
+        # Nothing is updated when one of the users is not found
+        query = text('''
+            UPDATE chatd_user SET
+                state = updated.state,
+                status = CASE
+                    WHEN updated.has_status THEN updated.status
+                    ELSE chatd_user.status
+                END,
+                last_activity = :last_activity
+            FROM unnest(
+                CAST(:uuids AS uuid[]),
+                CAST(:states AS varchar[]),
+                CAST(:statuses AS text[]),
+                CAST(:has_statuses AS boolean[])
+            ) AS updated (uuid, state, status, has_status)
+            WHERE chatd_user.uuid = updated.uuid
+            AND (
+                SELECT count(*) FROM chatd_user
+                WHERE uuid = ANY(CAST(:uuids AS uuid[]))
+                AND (
+                    CAST(:tenant_uuids AS uuid[]) IS NULL
+                    OR tenant_uuid = ANY(CAST(:tenant_uuids AS uuid[]))
+                )
+            ) = cardinality(CAST(:uuids AS uuid[]))
+            RETURNING chatd_user.uuid
+            ''')
+        parameters = {
+            'uuids': [str(presence['uuid']) for presence in presences],
+            'states': [presence['state'] for presence in presences],
+            'statuses': [presence.get('status') for presence in presences],
+            'has_statuses': ['status' in presence for presence in presences],
+            'tenant_uuids': None,
+            'last_activity': last_activity,
+        }
+        if tenant_uuids is not None:
+            parameters['tenant_uuids'] = [str(uuid) for uuid in tenant_uuids]
+        return [row.uuid for row in self.session.execute(query, parameters)]
+
     def count(self, tenant_uuids, **filter_parameters):
         return self._get_users_query(tenant_uuids, **filter_parameters).count()
 
@@ -49,12 +108,91 @@ class UserDAO:
         self.session.delete(user)
         self.session.flush()
 
-    def _get_users_query(self, tenant_uuids=None, uuids=None):
+    def create_staging(self):
+        query = text('''
+            CREATE TEMPORARY TABLE chatd_user_staging (
+                uuid uuid NOT NULL,
+                tenant_uuid uuid NOT NULL,
+                do_not_disturb boolean NOT NULL
+            )
+            ''')
+        self.session.execute(query)
+
+    def stage(self, users):
+        query = text('''
+            INSERT INTO chatd_user_staging (uuid, tenant_uuid, do_not_disturb)
+            SELECT * FROM unnest(
+                CAST(:uuids AS uuid[]),
+                CAST(:tenant_uuids AS uuid[]),
+                CAST(:do_not_disturbs AS boolean[])
+            )
+            ''')
+        parameters = {
+            'uuids': [str(user['uuid']) for user in users],
+            'tenant_uuids': [str(user['tenant_uuid']) for user in users],
+            'do_not_disturbs': [user['do_not_disturb'] for user in users],
+        }
+        self.session.execute(query, parameters)
+
+    def sync_staged(self, delete_missing=True):
+        self.session.execute(text('ANALYZE chatd_user_staging'))
+
+        # Avoid race condition between init tenant and init user
+        query = text('''
+            INSERT INTO chatd_tenant (uuid)
+            SELECT DISTINCT tenant_uuid FROM chatd_user_staging
+            ON CONFLICT DO NOTHING
+            ''')
+        self.session.execute(query)
+
+        # Users that moved to another tenant are deleted before being recreated
+        query = '''
+            DELETE FROM chatd_user WHERE NOT EXISTS (
+                SELECT 1 FROM chatd_user_staging AS staged
+                WHERE staged.uuid = chatd_user.uuid
+                AND staged.tenant_uuid = chatd_user.tenant_uuid
+            )
+            '''
+        if not delete_missing:
+            # The users missing from the staging may only have been missed
+            query += 'AND uuid IN (SELECT uuid FROM chatd_user_staging)'
+        deleted = self.session.execute(text(query)).rowcount
+
+        query = text('''
+            INSERT INTO chatd_user (uuid, tenant_uuid, state, do_not_disturb)
+            SELECT DISTINCT ON (uuid) uuid, tenant_uuid, 'unavailable', do_not_disturb
+            FROM chatd_user_staging
+            ON CONFLICT DO NOTHING
+            ''')
+        created = self.session.execute(query).rowcount
+
+        query = text('''
+            UPDATE chatd_user SET do_not_disturb = staged.do_not_disturb
+            FROM chatd_user_staging AS staged
+            WHERE chatd_user.uuid = staged.uuid
+            AND chatd_user.do_not_disturb <> staged.do_not_disturb
+            ''')
+        updated = self.session.execute(query).rowcount
+
+        return created, deleted, updated
+
+    def _get_presences_query(self, tenant_uuids=None, uuids=None, line_state=None):
+        query = self._get_users_query(tenant_uuids, uuids=uuids, line_state=line_state)
+        return query.options(
+            selectinload('lines'),
+            selectinload('sessions'),
+            selectinload('refresh_tokens'),
+        )
+
+    def _get_users_query(self, tenant_uuids=None, uuids=None, line_state=None):
         query = self.session.query(User)
 
         if uuids:
             query = query.filter(User.uuid.in_(uuids))
 
+        if line_state:
+            query = query.filter(User.line_state == line_state)
+
         if tenant_uuids is None:
             return query
 
@@ -1,6 +1,9 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from flask import request
+from werkzeug.http import http_date, quote_etag
+
 
 def update_model_instance(model_instance, model_instance_data):
     for attribute_name, attribute_value in model_instance_data.items():
@@ -11,3 +14,14 @@ def update_model_instance(model_instance, model_instance_data):
                 )
             )
         setattr(model_instance, attribute_name, attribute_value)
+
+
+def is_not_modified(version):
+    return request.if_none_match.contains_weak(version.etag)
+
+
+def version_headers(version):
+    return {
+        'ETag': quote_etag(version.etag),
+        'Last-Modified': http_date(version.last_modified),
+    }
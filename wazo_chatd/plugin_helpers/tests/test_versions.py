@@ -0,0 +1,53 @@
+# Copyright 2021 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+import uuid
+
+from hamcrest import assert_that, equal_to, greater_than_or_equal_to, is_not
+
+from ..versions import VersionTracker
+
+KEY_1 = uuid.uuid4()
+KEY_2 = uuid.uuid4()
+
+
+class TestVersionTracker(unittest.TestCase):
+    def setUp(self):
+        self.versions = VersionTracker()
+
+    def test_get_is_stable(self):
+        result = self.versions.get([KEY_1, KEY_2])
+
+        assert_that(result, equal_to(self.versions.get([str(KEY_2), str(KEY_1)])))
+
+    def test_bump_changes_etag(self):
+        before = self.versions.get([KEY_1, KEY_2])
+
+        self.versions.bump(KEY_2)
+
+        after = self.versions.get([KEY_1, KEY_2])
+        assert_that(after.etag, is_not(equal_to(before.etag)))
+        assert_that(after.last_modified, greater_than_or_equal_to(before.last_modified))
+        assert_that(self.versions.get([KEY_1]), equal_to(self.versions.get([KEY_1])))
+
+    def test_bump_other_key(self):
+        before = self.versions.get([KEY_1])
+
+        self.versions.bump(KEY_2)
+
+        assert_that(self.versions.get([KEY_1]).etag, equal_to(before.etag))
+
+    def test_keys_change_etag(self):
+        result = self.versions.get([KEY_1])
+
+        assert_that(
+            result.etag, is_not(equal_to(self.versions.get([KEY_1, KEY_2]).etag))
+        )
+
+    def test_reset_changes_etag(self):
+        before = self.versions.get([KEY_1])
+
+        self.versions.reset()
+
+        assert_that(self.versions.get([KEY_1]).etag, is_not(equal_to(before.etag)))
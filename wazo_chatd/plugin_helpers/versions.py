@@ -0,0 +1,52 @@
+# Copyright 2021 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import datetime
+import hashlib
+import threading
+import uuid
+
+from collections import namedtuple
+
+Version = namedtuple('Version', ['etag', 'last_modified'])
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class VersionTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def bump(self, *keys):
+        modified_at = _now()
+        with self._lock:
+            for key in keys:
+                version, _ = self._versions.get(str(key), (0, None))
+                self._versions[str(key)] = (version + 1, modified_at)
+
+    def reset(self):
+        with self._lock:
+            # Versions restart from zero, the epoch prevents an ETag from
+            # matching again after a reset or a restart
+            self._epoch = uuid.uuid4().hex[:8]
+            self._reset_at = _now()
+            self._versions = {}
+
+    def get(self, keys):
+        keys = sorted(set(str(key) for key in keys))
+        with self._lock:
+            epoch = self._epoch
+            versions = [self._versions.get(key, (0, self._reset_at)) for key in keys]
+            reset_at = self._reset_at
+
+        digest = hashlib.sha1()
+        for key, (version, _) in zip(keys, versions):
+            digest.update('{}:{};'.format(key, version).encode())
+        etag = '{}-{}'.format(epoch, digest.hexdigest()[:16])
+        last_modified = max(
+            (modified_at for _, modified_at in versions), default=reset_at
+        )
+        return Version(etag, last_modified)
@@ -1,10 +1,10 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import logging
 
 from wazo_chatd.exceptions import UnknownUserException
-from wazo_chatd.database.helpers import session_scope
+from wazo_chatd.database.helpers import on_commit, session_scope
 from wazo_chatd.database.models import (
     Channel,
     Line,
@@ -19,16 +19,23 @@ from .initiator import (
     extract_endpoint_from_line,
     extract_endpoint_from_channel,
 )
+from .schemas import dump_presence
 
 logger = logging.getLogger(__name__)
 
 
 class BusEventHandler:
-    def __init__(self, dao, notifier):
+    def __init__(self, dao, notifier, store, line_cache, channel_batcher=None):
         self._dao = dao
         self._notifier = notifier
+        self._store = store
+        self._line_cache = line_cache
+        self._channel_batcher = channel_batcher
+        self._defer_ack = None
 
     def subscribe(self, bus_consumer):
+        self._defer_ack = bus_consumer.defer_ack
+        bus_consumer.set_event_key(self._event_key)
         bus_consumer.on_event('auth_tenant_added', self._tenant_created)
         bus_consumer.on_event('auth_tenant_deleted', self._tenant_deleted)
         bus_consumer.on_event('user_created', self._user_created)
@@ -47,6 +54,23 @@ class BusEventHandler:
         bus_consumer.on_event('Hold', self._channel_hold)
         bus_consumer.on_event('Unhold', self._channel_unhold)
 
+    def _event_key(self, event):
+        # The events of an endpoint or a channel must be handled in order with
+        # the events of the user owning them
+        if event.get('Device'):
+            endpoint_name = event['Device']
+        elif event.get('Channel'):
+            endpoint_name = extract_endpoint_from_channel(event['Channel'])
+        else:
+            return
+
+        if not endpoint_name:
+            return
+        with session_scope():
+            owner = self._line_cache.get(endpoint_name)
+        if owner:
+            return str(owner.user_uuid)
+
     def _user_created(self, event):
         user_uuid = event['uuid']
         tenant_uuid = event['tenant_uuid']
@@ -55,6 +79,8 @@ class BusEventHandler:
             logger.debug('Create user "%s"', user_uuid)
             user = User(uuid=user_uuid, tenant=tenant, state='unavailable')
             self._dao.user.create(user)
+            presence = dump_presence(user)
+            on_commit(lambda: self._store.update(presence))
 
     def _user_deleted(self, event):
         user_uuid = event['uuid']
@@ -63,6 +89,8 @@ class BusEventHandler:
             user = self._dao.user.get([tenant_uuid], user_uuid)
             logger.debug('Delete user "%s"', user_uuid)
             self._dao.user.delete(user)
+            self._notifier.deleted(user_uuid)
+        self._line_cache.clear()
 
     def _tenant_created(self, event):
         tenant_uuid = event['uuid']
@@ -77,6 +105,8 @@ class BusEventHandler:
             tenant = self._dao.tenant.get(tenant_uuid)
             logger.debug('Delete tenant "%s"', tenant_uuid)
             self._dao.tenant.delete(tenant)
+            self._notifier.deleted_tenant(tenant_uuid)
+        self._line_cache.clear()
 
     def _session_created(self, event):
         mobile = event['mobile']
@@ -163,6 +193,13 @@ class BusEventHandler:
         user_uuid = event['user']['uuid']
         tenant_uuid = event['user']['tenant_uuid']
         endpoint_name = extract_endpoint_from_line(event['line'])
+        try:
+            self._associate_user_line(user_uuid, tenant_uuid, line_id, endpoint_name)
+        finally:
+            # After the commit, to not cache the previous owner again
+            self._line_cache.discard(line_id, endpoint_name)
+
+    def _associate_user_line(self, user_uuid, tenant_uuid, line_id, endpoint_name):
         with session_scope():
             user = self._dao.user.get([tenant_uuid], user_uuid)
             line = self._dao.line.find(line_id)
@@ -192,6 +229,7 @@ class BusEventHandler:
             logger.debug('Delete line "%s"', line_id)
             self._dao.user.remove_line(user, line)
             self._notifier.updated(user)
+        self._line_cache.discard(line_id)
 
     def _user_dnd_updated(self, event):
         user_uuid = event['user_uuid']
@@ -199,6 +237,9 @@ class BusEventHandler:
         enabled = event['enabled']
         with session_scope():
             user = self._dao.user.get([tenant_uuid], user_uuid)
+            if user.do_not_disturb == enabled:
+                return
+
             logger.debug('Updating DND status of user "%s" to "%s"', user_uuid, enabled)
             user.do_not_disturb = enabled
             self._dao.user.update(user)
@@ -218,16 +259,22 @@ class BusEventHandler:
             )
             self._dao.endpoint.update(endpoint)
 
-            if endpoint.line:
-                self._notifier.updated(endpoint.line.user)
+            owner = self._line_cache.get(endpoint_name)
+            if owner:
+                user = self._dao.user.get([owner.tenant_uuid], owner.user_uuid)
+                self._notifier.updated(user)
 
     def _channel_created(self, event):
         channel_name = event['Channel']
         state = CHANNEL_STATE_MAP.get(event['ChannelStateDesc'], 'undefined')
+        if self._channel_batcher:
+            self._channel_batcher.created(channel_name, state, self._defer_ack())
+            return
+
         endpoint_name = extract_endpoint_from_channel(channel_name)
         with session_scope():
-            line = self._dao.line.find_by(endpoint_name=endpoint_name)
-            if not line:
+            owner = self._line_cache.get(endpoint_name)
+            if not owner:
                 logger.debug(
                     'Unknown line with endpoint "%s" for channel "%s"',
                     endpoint_name,
@@ -235,14 +282,19 @@ class BusEventHandler:
                 )
                 return
 
-            channel = Channel(name=channel_name, state=state)
-            logger.debug('Create channel "%s" for line "%s"', channel.name, line.id)
-            self._dao.line.add_channel(line, channel)
+            channel = Channel(name=channel_name, state=state, line_id=owner.id)
+            logger.debug('Create channel "%s" for line "%s"', channel.name, owner.id)
+            self._dao.channel.update(channel)
 
-            self._notifier.updated(channel.line.user)
+            user = self._dao.user.get([owner.tenant_uuid], owner.user_uuid)
+            self._notifier.updated(user)
 
     def _channel_deleted(self, event):
         channel_name = event['Channel']
+        if self._channel_batcher:
+            self._channel_batcher.deleted(channel_name, self._defer_ack())
+            return
+
         with session_scope():
             channel = self._dao.channel.find(channel_name)
             if not channel:
@@ -257,12 +309,19 @@ class BusEventHandler:
     def _channel_updated(self, event):
         channel_name = event['Channel']
         state = CHANNEL_STATE_MAP.get(event['ChannelStateDesc'], 'undefined')
+        if self._channel_batcher:
+            self._channel_batcher.updated(channel_name, state, self._defer_ack())
+            return
+
         with session_scope():
             channel = self._dao.channel.find(channel_name)
             if not channel:
                 logger.debug('Unknown channel "%s"', channel_name)
                 return
 
+            if channel.state == state:
+                return
+
             logger.debug('Update channel "%s" with state "%s"', channel_name, state)
             channel.state = state
             self._dao.channel.update(channel)
@@ -271,12 +330,19 @@ class BusEventHandler:
 
     def _channel_hold(self, event):
         channel_name = event['Channel']
+        if self._channel_batcher:
+            self._channel_batcher.updated(channel_name, 'holding', self._defer_ack())
+            return
+
         with session_scope():
             channel = self._dao.channel.find(channel_name)
             if not channel:
                 logger.debug('Unknown channel "%s"', channel_name)
                 return
 
+            if channel.state == 'holding':
+                return
+
             logger.debug('Update channel "%s" with state "holding"', channel_name)
             channel.state = 'holding'
             self._dao.channel.update(channel)
@@ -286,12 +352,19 @@ class BusEventHandler:
     def _channel_unhold(self, event):
         channel_name = event['Channel']
         state = CHANNEL_STATE_MAP.get(event['ChannelStateDesc'], 'undefined')
+        if self._channel_batcher:
+            self._channel_batcher.updated(channel_name, state, self._defer_ack())
+            return
+
         with session_scope():
             channel = self._dao.channel.find(channel_name)
             if not channel:
                 logger.debug('Unknown channel "%s"', channel_name)
                 return
 
+            if channel.state == state:
+                return
+
             logger.debug('Update channel "%s" with state "%s"', channel_name, state)
             channel.state = state
             self._dao.channel.update(channel)
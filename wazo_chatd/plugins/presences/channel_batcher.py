@@ -0,0 +1,171 @@
+# Copyright 2021 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import threading
+
+from functools import partial
+
+from wazo_chatd.database.helpers import session_scope
+
+from .initiator import extract_endpoint_from_channel
+
+logger = logging.getLogger(__name__)
+
+
+class ChannelEventBatcher:
+    def __init__(self, dao, notifier, window, max_attempts=3, dispatch=None):
+        self._dao = dao
+        self._notifier = notifier
+        self._dispatch = dispatch
+        self._window = window
+        self._max_attempts = max_attempts
+        self._changes = {}
+        self._acks = []
+        self._attempts = 0
+        self._timer = None
+        self._lock = threading.Lock()
+        # Batches are applied one at a time, in order
+        self._flush_lock = threading.Lock()
+
+    def created(self, channel_name, state, ack=None):
+        with self._lock:
+            self._add_ack(ack)
+            change = self._change(channel_name)
+            change.update(created=True, deleted=False, state=state)
+            self._schedule()
+
+    def updated(self, channel_name, state, ack=None):
+        with self._lock:
+            self._add_ack(ack)
+            change = self._change(channel_name)
+            if change['deleted']:
+                return
+            change['state'] = state
+            self._schedule()
+
+    def deleted(self, channel_name, ack=None):
+        with self._lock:
+            self._add_ack(ack)
+            change = self._change(channel_name)
+            change.update(created=False, deleted=True, state=None)
+            self._schedule()
+
+    def _add_ack(self, ack):
+        # The events are acked once their batch is committed
+        if ack:
+            self._acks.append(ack)
+
+    def _change(self, channel_name):
+        # Only the result of the events of a channel within a batch is applied
+        if channel_name not in self._changes:
+            self._changes[channel_name] = {
+                'name': channel_name,
+                'created': False,
+                'deleted': False,
+                'state': None,
+            }
+        return self._changes[channel_name]
+
+    def _schedule(self):
+        if not self._timer:
+            self._timer = threading.Timer(self._window, self._flush)
+            self._timer.start()
+
+    def _flush(self):
+        with self._flush_lock:
+            with self._lock:
+                changes, self._changes = self._changes, {}
+                acks, self._acks = self._acks, []
+                self._timer = None
+
+            try:
+                user_uuids = self._apply(list(changes.values()))
+            except Exception:
+                logger.exception('Error while applying %s channel events', len(changes))
+                self._retry(changes, acks)
+            else:
+                self._attempts = 0
+                self._ack(acks)
+                self._notify(user_uuids)
+
+    def _retry(self, changes, acks):
+        self._attempts += 1
+        if self._attempts >= self._max_attempts:
+            logger.error(
+                'Dropping %s channel events after %s attempts',
+                len(changes),
+                self._attempts,
+            )
+            self._attempts = 0
+            self._ack(acks)
+            return
+
+        with self._lock:
+            self._acks = acks + self._acks
+            # The events received since are more recent than the failed batch
+            newer, self._changes = self._changes, changes
+            for name, change in newer.items():
+                if change['created'] or change['deleted']:
+                    self._changes[name] = change
+                    continue
+                failed = self._change(name)
+                if not failed['deleted']:
+                    failed['state'] = change['state']
+            self._schedule()
+
+    def _ack(self, acks):
+        for ack in acks:
+            ack()
+
+    def _apply(self, changes):
+        deleted = [change['name'] for change in changes if change['deleted']]
+        created = [
+            {
+                'name': change['name'],
+                'state': change['state'],
+                'endpoint_name': extract_endpoint_from_channel(change['name']),
+            }
+            for change in changes
+            if change['created']
+        ]
+        updated = [
+            {'name': change['name'], 'state': change['state']}
+            for change in changes
+            if not change['created'] and not change['deleted']
+        ]
+
+        with session_scope():
+            user_uuids = set()
+            if deleted:
+                user_uuids.update(self._dao.channel.delete_all_by_names(deleted))
+            if created:
+                user_uuids.update(self._dao.channel.create_or_update_all(created))
+            if updated:
+                user_uuids.update(self._dao.channel.update_states(updated))
+            logger.debug(
+                'Channel events applied: %s created, %s updated, %s deleted',
+                len(created),
+                len(updated),
+                len(deleted),
+            )
+        return user_uuids
+
+    def _notify(self, user_uuids):
+        # The batch is committed outside of the event handlers of its users: a
+        # presence dumped by a handler before this commit could be applied
+        # after the presence of the batch. The presences are dumped again in
+        # order with the events of each user
+        if not self._dispatch:
+            self._update_presences(user_uuids)
+            return
+        for user_uuid in user_uuids:
+            user_uuid = str(user_uuid)
+            self._dispatch(user_uuid, partial(self._update_presences, [user_uuid]))
+
+    def _update_presences(self, user_uuids):
+        if not user_uuids:
+            return
+        with session_scope():
+            users = self._dao.user.list_presences(None, uuids=list(user_uuids))
+            self._notifier.updated_many(users)
@@ -1,4 +1,4 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from flask import request
@@ -6,10 +6,19 @@ from flask import request
 from xivo.auth_verifier import required_acl
 
 from wazo_chatd.http import AuthResource
-from wazo_chatd.plugin_helpers.http import update_model_instance
+from wazo_chatd.plugin_helpers.http import (
+    is_not_modified,
+    update_model_instance,
+    version_headers,
+)
 from wazo_chatd.plugin_helpers.tenant import get_tenant_uuids
 
-from .schemas import ListRequestSchema, UserPresenceSchema
+from .schemas import (
+    BulkUpdateRequestSchema,
+    ChangesRequestSchema,
+    ListRequestSchema,
+    UserPresenceSchema,
+)
 from .validator import status_validator
 
 
@@ -23,13 +32,53 @@ class PresenceListResource(AuthResource):
         parameters = ListRequestSchema().load(request.args)
         tenant_uuids = get_tenant_uuids(parameters.pop('recurse'))
 
-        presences = self._service.list_(tenant_uuids, **parameters)
-        total = self._service.count(tenant_uuids)
-        filtered = self._service.count(tenant_uuids, **parameters)
+        headers = {}
+        version = self._service.presences_version(tenant_uuids)
+        if version:
+            headers = version_headers(version)
+            if is_not_modified(version):
+                return '', 304, headers
+
+        presences, filtered, total = self._service.list_presences(
+            tenant_uuids, **parameters
+        )
+        return (
+            {
+                'items': presences,
+                'filtered': filtered,
+                'total': total,
+            },
+            200,
+            headers,
+        )
+
+    @required_acl('chatd.users.presences.update')
+    @status_validator.presence_initialization
+    def put(self):
+        tenant_uuids = get_tenant_uuids(recurse=True)
+        parameters = BulkUpdateRequestSchema().load(request.get_json())
+        self._service.update_many(tenant_uuids, parameters['items'])
+        return '', 204
+
+
+class PresenceChangesResource(AuthResource):
+    def __init__(self, service):
+        self._service = service
+
+    @required_acl('chatd.users.presences.read')
+    @status_validator.presence_initialization
+    def get(self):
+        parameters = ChangesRequestSchema().load(request.args)
+        tenant_uuids = get_tenant_uuids(parameters['recurse'])
+
+        presences, deleted, cursor, snapshot = self._service.list_presence_changes(
+            tenant_uuids, since=parameters['since']
+        )
         return {
-            'items': UserPresenceSchema().dump(presences, many=True),
-            'filtered': filtered,
-            'total': total,
+            'items': presences,
+            'deleted': deleted,
+            'cursor': cursor,
+            'snapshot': snapshot,
         }
 
 
@@ -41,8 +90,8 @@ class PresenceItemResource(AuthResource):
     @status_validator.presence_initialization
     def get(self, user_uuid):
         tenant_uuids = get_tenant_uuids(recurse=True)
-        presence = self._service.get(tenant_uuids, user_uuid)
-        return UserPresenceSchema().dump(presence), 200
+        presence = self._service.get_presence(tenant_uuids, user_uuid)
+        return presence, 200
 
     @required_acl('chatd.users.{user_uuid}.presences.update')
     @status_validator.presence_initialization
@@ -2,27 +2,13 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 from xivo.status import Status
 
-from wazo_chatd.database.models import (
-    Channel,
-    Endpoint,
-    Line,
-    RefreshToken,
-    Session,
-    Tenant,
-    User,
-)
-from wazo_chatd.database.helpers import session_scope
-from wazo_chatd.exceptions import (
-    UnknownEndpointException,
-    UnknownLineException,
-    UnknownRefreshTokenException,
-    UnknownSessionException,
-    UnknownTenantException,
-    UnknownUserException,
-)
+from wazo_chatd.database.helpers import connection_scope, session_scope
 
 logger = logging.getLogger(__name__)
 
@@ -72,358 +58,361 @@ def extract_endpoint_from_line(line):
         return line['name']
 
 
+class UserPages:
+    # Users are paged by offset: a user deleted from an already fetched page
+    # shifts the next pages and the first user of the next page is missed. Each
+    # page overlaps the previous one by one user to detect it, the users missing
+    # from an incomplete walk must not be deleted
+    def __init__(self, fetch_page, page_size):
+        self._fetch_page = fetch_page
+        self._page_size = page_size
+        self.complete = True
+
+    def __iter__(self):
+        self.complete = True
+        offset = 0
+        count = 0
+        last_uuid = None
+        while True:
+            overlap = 1 if last_uuid else 0
+            limit = self._page_size + overlap
+            response = self._fetch_page(offset - overlap, limit)
+            users = response['items']
+            if last_uuid:
+                if users and users[0]['uuid'] == last_uuid:
+                    users = users[1:]
+                else:
+                    self.complete = False
+            if users:
+                count += len(users)
+                last_uuid = users[-1]['uuid']
+                yield users
+            if len(response['items']) < limit:
+                break
+            offset += len(response['items']) - overlap
+
+        if count != response['total']:
+            self.complete = False
+        if not self.complete:
+            logger.warning('Users changed while being fetched, some may be missing')
+
+
 class Initiator:
-    def __init__(self, dao, auth, amid, confd):
+    def __init__(
+        self,
+        dao,
+        auth,
+        amid,
+        confd,
+        store,
+        notifier=None,
+        line_cache=None,
+        timeouts=None,
+        users_page_size=500,
+    ):
         self._dao = dao
         self._auth = auth
         self._amid = amid
         self._confd = confd
+        self._store = store
+        self._notifier = notifier
+        self._line_cache = line_cache
+        self._timeouts = timeouts or {}
+        self._users_page_size = users_page_size
+        self._fetch_durations = {}
         self._is_initialized = False
 
     def provide_status(self, status):
         status['presence_initialization']['status'] = (
             Status.ok if self.is_initialized() else Status.fail
         )
+        status['presence_initialization']['fetch_duration_ms'] = dict(
+            self._fetch_durations
+        )
 
     def is_initialized(self):
         return self._is_initialized
 
     def initiate(self):
-        token = self._auth.token.new(expiration=120)['token']
-        self._auth.set_token(token)
-        self._amid.set_token(token)
-        self._confd.set_token(token)
-
-        endpoint_events = self._amid.action('DeviceStateList')
-        tenants = self._auth.tenants.list()['items']
-        users = self._confd.users.list(recurse=True)['items']
-        sessions = self._auth.sessions.list(recurse=True)['items']
-        refresh_tokens = self._auth.refresh_tokens.list(recurse=True)['items']
-        channel_events = self._amid.action('CoreShowChannels')
-
-        self.initiate_endpoints(endpoint_events)
-        self.initiate_tenants(tenants)
-        self.initiate_users(users)
-        self.initiate_sessions(sessions)
-        self.initiate_refresh_tokens(refresh_tokens)
+        self._set_token()
+
+        results = self._fetch_all(
+            {
+                'endpoints': lambda: self._amid.action('DeviceStateList'),
+                'tenants': lambda: self._auth.tenants.list()['items'],
+                'sessions': lambda: self._auth.sessions.list(recurse=True)['items'],
+                'refresh_tokens': lambda: self._auth.refresh_tokens.list(recurse=True)[
+                    'items'
+                ],
+                'users': self._fetch_users,
+            }
+        )
+        # Fetched after the endpoints to be at least as recent as their states
+        channel_events = self._fetch_all(
+            {'channels': lambda: self._amid.action('CoreShowChannels')}
+        )['channels']
+
+        self.initiate_endpoints(results['endpoints'])
+        self.initiate_tenants(results['tenants'])
+        user_pages, users_complete = results['users']
+        self.initiate_user_pages(user_pages, complete=users_complete)
+        self.initiate_sessions(results['sessions'])
+        self.initiate_refresh_tokens(results['refresh_tokens'])
         self.initiate_channels(channel_events)
+        self.initiate_store()
         self._is_initialized = True
         logger.debug('Initialized completed')
 
-    def initiate_tenants(self, tenants):
-        tenants = set(tenant['uuid'] for tenant in tenants)
-        tenants_cached = set(str(tenant.uuid) for tenant in self._dao.tenant.list_())
+    def resync(self):
+        # Bus events are lost while the consumer is disconnected. Only the
+        # resources updated from those events are synced, without putting the
+        # presences back to an uninitialized state
+        self._set_token()
+
+        results = self._fetch_all(
+            {
+                'tenants': lambda: self._auth.tenants.list()['items'],
+                'users': self._fetch_users,
+            }
+        )
+        self.initiate_tenants(results['tenants'])
+        user_pages, users_complete = results['users']
+        self.initiate_user_pages(user_pages, complete=users_complete)
+        channel_events = self._fetch_all(
+            {'channels': lambda: self._amid.action('CoreShowChannels')}
+        )['channels']
+        self.initiate_channels(channel_events)
+        self.resync_store()
+        logger.debug('Resync completed')
 
-        tenants_missing = tenants - tenants_cached
-        with session_scope():
-            for uuid in tenants_missing:
-                logger.debug('Create tenant "%s"', uuid)
-                tenant = Tenant(uuid=uuid)
-                self._dao.tenant.create(tenant)
+    def _set_token(self):
+        token = self._auth.token.new(expiration=120)['token']
+        self._auth.set_token(token)
+        self._amid.set_token(token)
+        self._confd.set_token(token)
 
-        tenants_expired = tenants_cached - tenants
-        with session_scope():
-            for uuid in tenants_expired:
+    def _fetch_all(self, fetchers):
+        executor = ThreadPoolExecutor(max_workers=len(fetchers))
+        try:
+            started_at = time.monotonic()
+            futures = {
+                name: executor.submit(self._timed_fetch, name, fetch)
+                for name, fetch in fetchers.items()
+            }
+
+            results = {}
+            for name, future in futures.items():
+                timeout = self._timeouts.get(name)
+                if timeout is not None:
+                    timeout = max(timeout - (time.monotonic() - started_at), 0)
                 try:
-                    tenant = self._dao.tenant.get(uuid)
-                except UnknownTenantException as e:
-                    logger.warning(e)
-                    continue
-                logger.debug('Delete tenant "%s"', uuid)
-                self._dao.tenant.delete(tenant)
-
-    def initiate_users(self, users):
-        self._add_and_remove_users(users)
-        self._add_and_remove_lines(users)
-        self._add_missing_endpoints(users)  # disconnected SCCP endpoints are missing
-        self._associate_line_endpoint(users)
-        self._update_services_users(users)
-
-    def _add_and_remove_users(self, users):
-        users = set((user['uuid'], user['tenant_uuid']) for user in users)
-        users_cached = set(
-            (str(u.uuid), str(u.tenant_uuid))
-            for u in self._dao.user.list_(tenant_uuids=None)
+                    results[name] = future.result(timeout=timeout)
+                except TimeoutError:
+                    logger.warning('Timeout while fetching %s for initialization', name)
+                    raise
+            return results
+        finally:
+            # A timed out request keeps running until the client timeout
+            executor.shutdown(wait=False)
+
+    def _fetch_users(self):
+        # All the pages are fetched with the other sources, the users timeout
+        # covers the whole walk
+        pages = self._fetch_user_pages()
+        return list(pages), pages.complete
+
+    def _fetch_user_pages(self):
+        return UserPages(self._fetch_user_page, self._users_page_size)
+
+    def _fetch_user_page(self, offset, limit):
+        return self._confd.users.list(
+            recurse=True,
+            order='uuid',
+            direction='asc',
+            limit=limit,
+            offset=offset,
         )
 
-        users_missing = users - users_cached
+    def _timed_fetch(self, name, fetch):
+        started_at = time.monotonic()
+        try:
+            return fetch()
+        finally:
+            duration = (time.monotonic() - started_at) * 1000
+            self._fetch_durations[name] = round(duration, 3)
+            logger.debug('Fetched %s for initialization in %.0f ms', name, duration)
+
+    def initiate_store(self):
+        # The presences updated while loading are more recent than the list
+        since = self._store.sequence()
         with session_scope():
-            for uuid, tenant_uuid in users_missing:
-                # Avoid race condition between init tenant and init user
-                tenant = self._dao.tenant.find_or_create(tenant_uuid)
+            logger.debug('Load presence store')
+            users = self._dao.user.list_presences(tenant_uuids=None)
+            self._store.load(users, since=since)
 
-                logger.debug('Create user "%s"', uuid)
-                user = User(uuid=uuid, tenant=tenant, state='unavailable')
-                self._dao.user.create(user)
+    def resync_store(self):
+        since = self._store.sequence()
+        with session_scope():
+            users = self._dao.user.list_presences(tenant_uuids=None)
+            updated_users = self._store.reload(users, since=since)
+            if self._notifier:
+                for user in updated_users:
+                    self._notifier.updated(user)
+        logger.debug('Presence store resynced: %s updated', len(updated_users))
 
-        users_expired = users_cached - users
+    def initiate_tenants(self, tenants):
+        tenant_uuids = set(tenant['uuid'] for tenant in tenants)
         with session_scope():
-            for uuid, tenant_uuid in users_expired:
-                try:
-                    user = self._dao.user.get([tenant_uuid], uuid)
-                except UnknownUserException as e:
-                    logger.warning(e)
-                    continue
-                logger.debug('Delete user "%s"', uuid)
-                self._dao.user.delete(user)
-
-    def _add_and_remove_lines(self, users):
-        lines = set(
-            (line['id'], user['uuid'], user['tenant_uuid'])
-            for user in users
-            for line in user['lines']
+            created = self._dao.tenant.create_all(tenant_uuids)
+            deleted = self._dao.tenant.delete_all_except(tenant_uuids)
+        logger.debug('Tenants initiated: %s created, %s deleted', created, deleted)
+
+    def initiate_users(self, users):
+        self.initiate_user_pages([users])
+
+    def initiate_user_pages(self, pages, complete=True):
+        # The pages are staged in their own transactions, the staging tables
+        # are kept by the connection
+        with connection_scope() as connection:
+            with session_scope(bind=connection):
+                self._dao.user.create_staging()
+                self._dao.line.create_staging()
+            for users in pages:
+                with session_scope(bind=connection):
+                    self._stage_users(users)
+            delete_missing = complete and getattr(pages, 'complete', True)
+
+            with session_scope(bind=connection):
+                self._sync_staged(delete_missing)
+
+        if self._line_cache:
+            self._line_cache.clear()
+
+    def _sync_staged(self, delete_missing):
+        for line_id in self._dao.line.list_staged_shared_ids():
+            logger.warning(
+                'Line "%s" already created. Line multi-users not supported',
+                line_id,
+            )
+
+        created, deleted, updated = self._dao.user.sync_staged(delete_missing)
+        logger.debug(
+            'Users initiated: %s created, %s deleted, %s DND status updated',
+            created,
+            deleted,
+            updated,
         )
-        lines_cached = set(
-            (line.id, str(line.user_uuid), str(line.tenant_uuid))
-            for line in self._dao.line.list_()
+        created, deleted = self._dao.line.sync_staged(delete_missing)
+        logger.debug('Lines initiated: %s created, %s deleted', created, deleted)
+        created, associated = self._dao.line.associate_staged_endpoints()
+        logger.debug(
+            'Missing endpoints initiated: %s created, %s lines associated',
+            created,
+            associated,
         )
 
-        lines_missing = lines - lines_cached
-        with session_scope():
-            for id_, user_uuid, tenant_uuid in lines_missing:
-                try:
-                    user = self._dao.user.get([tenant_uuid], user_uuid)
-                except UnknownUserException as e:
-                    logger.warning(e)
-                    continue
-                if self._dao.line.find(id_):
-                    logger.warning(
-                        'Line "%s" already created. Line multi-users not supported', id_
-                    )
-                    continue
-                line = Line(id=id_)
-                logger.debug('Create line "%s"', id_)
-                self._dao.user.add_line(user, line)
-
-        lines_expired = lines_cached - lines
-        with session_scope():
-            for id_, user_uuid, tenant_uuid in lines_expired:
-                try:
-                    user = self._dao.user.get([tenant_uuid], user_uuid)
-                    line = self._dao.line.get(id_)
-                except UnknownUserException:
-                    logger.debug('Line "%s" already deleted', id_)
-                    continue
-                logger.debug('Delete line "%s"', id_)
-                self._dao.user.remove_session(user, line)
-
-    def _add_missing_endpoints(self, users):
-        lines = set(
-            (line['id'], extract_endpoint_from_line(line))
-            for user in users
-            for line in user['lines']
-        )
-        with session_scope():
-            for line_id, endpoint_name in lines:
+    def _stage_users(self, users):
+        staged_users = []
+        staged_lines = []
+        for user in users:
+            staged_users.append(
+                {
+                    'uuid': user['uuid'],
+                    'tenant_uuid': user['tenant_uuid'],
+                    'do_not_disturb': user['services']['dnd']['enabled'],
+                }
+            )
+            for line in user['lines']:
+                endpoint_name = extract_endpoint_from_line(line)
                 if not endpoint_name:
-                    logger.warning('Line "%s" doesn\'t have name', line_id)
-                    continue
-
-                endpoint = self._dao.endpoint.find_by(name=endpoint_name)
-                if endpoint:
-                    continue
-
-                logger.debug('Create endpoint "%s"', endpoint_name)
-                self._dao.endpoint.create(Endpoint(name=endpoint_name))
-
-    def _associate_line_endpoint(self, users):
-        lines = set(
-            (line['id'], extract_endpoint_from_line(line))
-            for user in users
-            for line in user['lines']
-        )
-        with session_scope():
-            for line_id, endpoint_name in lines:
-                try:
-                    line = self._dao.line.get(line_id)
-                    endpoint = self._dao.endpoint.get_by(name=endpoint_name)
-                except (UnknownLineException, UnknownEndpointException):
-                    logger.debug(
-                        'Unable to associate line "%s" with endpoint "%s"',
-                        line_id,
-                        endpoint_name,
-                    )
-                    continue
-                logger.debug(
-                    'Associate line "%s" with endpoint "%s"', line.id, endpoint.name
+                    logger.warning('Line "%s" doesn\'t have name', line['id'])
+                staged_lines.append(
+                    {
+                        'id': line['id'],
+                        'user_uuid': user['uuid'],
+                        'endpoint_name': endpoint_name,
+                    }
                 )
-                self._dao.line.associate_endpoint(line, endpoint)
 
-    def _update_services_users(self, users):
-        with session_scope() as session:
-            for confd_user in users:
-                try:
-                    user = self._dao.user.get(
-                        [confd_user['tenant_uuid']], confd_user['uuid']
-                    )
-                except UnknownUserException as e:
-                    logger.warning(e)
-                    continue
-                do_not_disturb_status = confd_user['services']['dnd']['enabled']
-                logger.debug(
-                    'Updating user "%s" DND status to "%s"',
-                    user.uuid,
-                    do_not_disturb_status,
-                )
-                user.do_not_disturb = do_not_disturb_status
-                session.flush()
+        self._dao.user.stage(staged_users)
+        self._dao.line.stage(staged_lines)
 
     def initiate_sessions(self, sessions):
-        self._add_and_remove_sessions(sessions)
-        self._update_sessions(sessions)
-
-    def _add_and_remove_sessions(self, sessions):
-        sessions = set(
-            (session['uuid'], session['user_uuid'], session['tenant_uuid'])
+        sessions = {
+            session['uuid']: {
+                'uuid': session['uuid'],
+                'user_uuid': session['user_uuid'],
+                'tenant_uuid': session['tenant_uuid'],
+                'mobile': session.get('mobile', False),
+            }
             for session in sessions
-        )
-        sessions_cached = set(
-            (str(session.uuid), str(session.user_uuid), str(session.tenant_uuid))
-            for session in self._dao.session.list_()
-        )
-
-        sessions_missing = sessions - sessions_cached
+        }
         with session_scope():
-            for uuid, user_uuid, tenant_uuid in sessions_missing:
-                try:
-                    user = self._dao.user.get([tenant_uuid], user_uuid)
-                except UnknownUserException:
-                    logger.debug('Session "%s" has no valid user "%s"', uuid, user_uuid)
-                    continue
-
-                logger.debug('Create session "%s" for user "%s"', uuid, user_uuid)
-                session = Session(uuid=uuid, user_uuid=user_uuid)
-                self._dao.user.add_session(user, session)
-
-        sessions_expired = sessions_cached - sessions
-        with session_scope():
-            for uuid, user_uuid, tenant_uuid in sessions_expired:
-                try:
-                    user = self._dao.user.get([tenant_uuid], user_uuid)
-                    session = self._dao.session.get(uuid)
-                except (UnknownUserException, UnknownSessionException) as e:
-                    logger.warning(e)
-                    continue
-
-                logger.debug('Delete session "%s" for user "%s"', uuid, user_uuid)
-                self._dao.user.remove_session(user, session)
-
-    def _update_sessions(self, sessions):
-        with session_scope():
-            for session in sessions:
-                cached_session = self._dao.session.find(session['uuid'])
-                if cached_session and session['mobile'] != cached_session.mobile:
-                    cached_session.mobile = session['mobile']
-                    self._dao.session.update(cached_session)
+            deleted = self._dao.session.delete_all_except(sessions.keys())
+            created = self._dao.session.create_or_update_all(list(sessions.values()))
+        logger.debug(
+            'Sessions initiated: %s created or updated, %s deleted', created, deleted
+        )
 
     def initiate_refresh_tokens(self, tokens):
-        self._add_and_remove_refresh_tokens(tokens)
-        self._update_refresh_tokens(tokens)
-
-    def _add_and_remove_refresh_tokens(self, tokens):
-        tokens = set(
-            (token['client_id'], token['user_uuid'], token['tenant_uuid'])
+        tokens = {
+            (token['client_id'], token['user_uuid']): {
+                'client_id': token['client_id'],
+                'user_uuid': token['user_uuid'],
+                'tenant_uuid': token['tenant_uuid'],
+                'mobile': token.get('mobile', False),
+            }
             for token in tokens
-        )
-        tokens_cached = set(
-            (token.client_id, str(token.user_uuid), str(token.tenant_uuid))
-            for token in self._dao.refresh_token.list_()
-        )
-
-        tokens_missing = tokens - tokens_cached
-        with session_scope():
-            for client_id, user_uuid, tenant_uuid in tokens_missing:
-                try:
-                    user = self._dao.user.get([tenant_uuid], user_uuid)
-                except UnknownUserException:
-                    logger.debug(
-                        'Refresh token "%s" has no valid user "%s"',
-                        client_id,
-                        user_uuid,
-                    )
-                    continue
-
-                logger.debug(
-                    'Create refresh token "%s" for user "%s"', client_id, user_uuid
-                )
-                token = RefreshToken(client_id=client_id, user_uuid=user_uuid)
-                self._dao.user.add_refresh_token(user, token)
-
-        tokens_expired = tokens_cached - tokens
-        with session_scope():
-            for client_id, user_uuid, tenant_uuid in tokens_expired:
-                try:
-                    user = self._dao.user.get([tenant_uuid], user_uuid)
-                    token = self._dao.refresh_token.get(user_uuid, client_id)
-                except (UnknownUserException, UnknownRefreshTokenException) as e:
-                    logger.warning(e)
-                    continue
-
-                logger.debug(
-                    'Delete refresh token "%s" for user "%s"', client_id, user_uuid
-                )
-                self._dao.user.remove_refresh_token(user, token)
-
-    def _update_refresh_tokens(self, tokens):
+        }
+        tokens = list(tokens.values())
         with session_scope():
-            for token in tokens:
-                cached_token = self._dao.refresh_token.find(
-                    token['user_uuid'], token['client_id']
-                )
-                if cached_token and token['mobile'] != cached_token.mobile:
-                    cached_token.mobile = token['mobile']
-                    self._dao.refresh_token.update(cached_token)
+            deleted = self._dao.refresh_token.delete_all_except(tokens)
+            created = self._dao.refresh_token.create_or_update_all(tokens)
+        logger.debug(
+            'Refresh tokens initiated: %s created or updated, %s deleted',
+            created,
+            deleted,
+        )
 
     def initiate_endpoints(self, events):
+        endpoints = [
+            {
+                'name': event['Device'],
+                'state': DEVICE_STATE_MAP.get(event['State'], 'unavailable'),
+            }
+            for event in events
+            if event.get('Event') == 'DeviceStateChange'
+        ]
         with session_scope():
             logger.debug('Delete all endpoints')
             self._dao.endpoint.delete_all()
-            for event in events:
-                if event.get('Event') != 'DeviceStateChange':
-                    continue
-
-                endpoint_args = {
-                    'name': event['Device'],
-                    'state': DEVICE_STATE_MAP.get(event['State'], 'unavailable'),
-                }
-                logger.debug(
-                    'Create endpoint "%s" with state "%s"',
-                    endpoint_args['name'],
-                    endpoint_args['state'],
-                )
-                self._dao.endpoint.create(Endpoint(**endpoint_args))
+            created = self._dao.endpoint.create_all(endpoints)
+        logger.debug('Endpoints initiated: %s created', created)
 
     def initiate_channels(self, events):
+        channels = {}
+        for event in events:
+            if event.get('Event') != 'CoreShowChannel':
+                continue
+
+            channel_name = event['Channel']
+            state = CHANNEL_STATE_MAP.get(event['ChannelStateDesc'], 'undefined')
+            if event.get('ChanVariable', {}).get('XIVO_ON_HOLD') == '1':
+                state = 'holding'
+
+            channels[channel_name] = {
+                'name': channel_name,
+                'state': state,
+                'endpoint_name': extract_endpoint_from_channel(channel_name),
+            }
+
         with session_scope():
-            logger.debug('Delete all channels')
-            self._dao.channel.delete_all()
-            for event in events:
-                if event.get('Event') != 'CoreShowChannel':
-                    continue
-
-                channel_name = event['Channel']
-                endpoint_name = extract_endpoint_from_channel(channel_name)
-                line = self._dao.line.find_by(endpoint_name=endpoint_name)
-                if not line:
-                    logger.debug(
-                        'Unknown line with endpoint "%s" for channel "%s"',
-                        endpoint_name,
-                        channel_name,
-                    )
-                    continue
-
-                state = CHANNEL_STATE_MAP.get(event['ChannelStateDesc'], 'undefined')
-                if event['ChanVariable'].get('XIVO_ON_HOLD') == '1':
-                    state = 'holding'
-
-                channel_args = {
-                    'name': channel_name,
-                    'state': state,
-                }
-                logger.debug(
-                    'Create channel "%s" with state "%s"',
-                    channel_args['name'],
-                    channel_args['state'],
-                )
-                channel = Channel(**channel_args)
-                self._dao.line.add_channel(line, channel)
+            deleted = self._dao.channel.delete_all_except(channels.keys())
+            created = len(
+                self._dao.channel.create_or_update_all(list(channels.values()))
+            )
+        logger.debug(
+            'Channels initiated: %s created or updated, %s deleted',
+            created,
+            deleted,
+        )
@@ -1,10 +1,11 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import itertools
 import logging
 import threading
 
+from concurrent.futures import TimeoutError
 from sqlalchemy.exc import SQLAlchemyError
 import requests
 
@@ -16,10 +17,7 @@ class InitiatorThread(object):
         self._initiator = initiator
         self._started = False
         self._stopped = threading.Event()
-        self._retry_time = 0
-        self._retry_time_failed = itertools.chain(
-            (1, 2, 4, 8, 16), itertools.repeat(32)
-        )
+        self._resync_requested = threading.Event()
 
     def start(self):
         if self._started:
@@ -32,28 +30,37 @@ class InitiatorThread(object):
 
     def stop(self):
         self._stopped.set()
+        self._resync_requested.set()
         logger.debug('joining presence initialization thread...')
         self._thread.join()
 
+    def resync(self):
+        self._resync_requested.set()
+
     def _run(self):
-        self._initiate()
+        logger.debug('Starting presence initialization')
+        self._retry_until_success(self._initiator.initiate)
         while True:
-            self._stopped.wait(self._retry_time)
+            self._resync_requested.wait()
             if self._stopped.is_set():
                 return
 
-            self._initiate()
+            self._resync_requested.clear()
+            logger.debug('Starting presence resync')
+            self._retry_until_success(self._initiator.resync)
 
-    def _initiate(self):
-        logger.debug('Starting presence initialization')
-        try:
-            self._initiator.initiate()
-        except (requests.RequestException, SQLAlchemyError) as e:
-            self._retry_time = next(self._retry_time_failed)
-            logger.warning(
-                'Error to fetch data for initialization (%s). Retrying in %s seconds...',
-                e,
-                self._retry_time,
-            )
-        else:
-            self._stopped.set()
+    def _retry_until_success(self, function):
+        retry_times = itertools.chain((1, 2, 4, 8, 16), itertools.repeat(32))
+        while not self._stopped.is_set():
+            try:
+                function()
+            except (requests.RequestException, SQLAlchemyError, TimeoutError) as e:
+                retry_time = next(retry_times)
+                logger.warning(
+                    'Error to fetch data for initialization (%s). Retrying in %s seconds...',
+                    e,
+                    retry_time,
+                )
+                self._stopped.wait(retry_time)
+            else:
+                return
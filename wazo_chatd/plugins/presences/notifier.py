@@ -1,16 +1,98 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import threading
+
 from xivo_bus.resources.chatd.events import PresenceUpdatedEvent
 
-from .schemas import UserPresenceSchema
+from wazo_chatd.database.helpers import on_commit
+
+from .schemas import dump_presence
 
 
 class PresenceNotifier:
-    def __init__(self, bus):
+    def __init__(self, bus, store, coalesce_window=0):
         self._bus = bus
+        self._store = store
+        self._coalesce_window = coalesce_window
+        self._pending = {}
+        self._last_sent = {}
+        self._timer = None
+        self._lock = threading.Lock()
 
     def updated(self, user):
-        user_json = UserPresenceSchema().dump(user)
-        event = PresenceUpdatedEvent(user_json)
-        self._bus.publish(event)
+        self.updated_many([user])
+
+    def updated_many(self, users):
+        # Dumped in the transaction but only applied once committed, a rolled
+        # back presence must not reach the store nor the bus
+        user_jsons = [dump_presence(user) for user in users]
+        on_commit(lambda: self._updated(user_jsons))
+
+    def deleted(self, user_uuid):
+        on_commit(lambda: self._deleted(str(user_uuid)))
+
+    def deleted_tenant(self, tenant_uuid):
+        on_commit(lambda: self._deleted_tenant(str(tenant_uuid)))
+
+    def _deleted(self, user_uuid):
+        self._store.delete(user_uuid)
+        with self._lock:
+            self._pending.pop(user_uuid, None)
+            self._last_sent.pop(user_uuid, None)
+
+    def _deleted_tenant(self, tenant_uuid):
+        self._store.delete_tenant(tenant_uuid)
+        with self._lock:
+            for presences in (self._pending, self._last_sent):
+                uuids = [
+                    uuid
+                    for uuid, presence in presences.items()
+                    if presence['tenant_uuid'] == tenant_uuid
+                ]
+                for uuid in uuids:
+                    del presences[uuid]
+
+    def _updated(self, user_jsons):
+        # The presences of many users are published as one batch
+        for user_json in user_jsons:
+            self._store.update(user_json)
+        with self._lock:
+            for user_json in user_jsons:
+                self._add_pending(user_json)
+            if not self._pending:
+                return
+
+            if self._coalesce_window:
+                if not self._timer:
+                    self._timer = threading.Timer(self._coalesce_window, self._flush)
+                    self._timer.start()
+                return
+        self._flush()
+
+    def _add_pending(self, user_json):
+        uuid = user_json['uuid']
+        # Many events (e.g. a second channel ringing) don't change the
+        # presence as seen by the users
+        if uuid not in self._pending and self._last_sent.get(uuid) == user_json:
+            return
+
+        # A burst of events for the same user only sends its final state
+        self._pending[uuid] = user_json
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._timer = None
+            presences = [
+                presence
+                for uuid, presence in pending.items()
+                if self._last_sent.get(uuid) != presence
+            ]
+            self._last_sent.update(
+                (presence['uuid'], presence) for presence in presences
+            )
+
+        if presences:
+            events = [(PresenceUpdatedEvent(presence), None) for presence in presences]
+            self._bus.publish_many(events)
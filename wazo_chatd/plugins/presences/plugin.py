@@ -1,4 +1,4 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import logging
@@ -8,9 +8,15 @@ from wazo_auth_client import Client as AuthClient
 from wazo_confd_client import Client as ConfdClient
 
 from .bus_consume import BusEventHandler
-from .http import PresenceListResource, PresenceItemResource
+from .channel_batcher import ChannelEventBatcher
+from .http import (
+    PresenceChangesResource,
+    PresenceListResource,
+    PresenceItemResource,
+)
 from .notifier import PresenceNotifier
 from .services import PresenceService
+from .store import LineOwnerCache, PresenceStore
 from .initiator import Initiator
 from .initiator_thread import InitiatorThread
 from .validator import status_validator
@@ -28,28 +34,59 @@ class Plugin:
         status_aggregator = dependencies['status_aggregator']
         status_validator.set_config(status_aggregator, config)
 
-        notifier = PresenceNotifier(bus_publisher)
-        service = PresenceService(dao, notifier)
+        store = PresenceStore(change_log_size=config['presence_changes']['log_size'])
+        line_cache = LineOwnerCache(dao)
+        notifier = PresenceNotifier(
+            bus_publisher,
+            store,
+            coalesce_window=config['presence_notifications']['coalesce_window'],
+        )
+        service = PresenceService(dao, notifier, store)
         initialization = config['initialization']
 
         auth = AuthClient(**config['auth'])
         amid = AmidClient(**config['amid'])
         confd = ConfdClient(**config['confd'])
-        initiator = Initiator(dao, auth, amid, confd)
+        initiator = Initiator(
+            dao,
+            auth,
+            amid,
+            confd,
+            store,
+            notifier=notifier,
+            line_cache=line_cache,
+            timeouts=initialization['timeouts'],
+            users_page_size=initialization['users_page_size'],
+        )
         status_aggregator.add_provider(initiator.provide_status)
 
         if initialization['enabled']:
             thread_manager = dependencies['thread_manager']
             initiator_thread = InitiatorThread(initiator)
             thread_manager.manage(initiator_thread)
+            bus_consumer.on_revived(initiator_thread.resync)
 
-        bus_event_handler = BusEventHandler(dao, notifier)
+        channel_batcher = None
+        batch_window = config['channel_events']['batch_window']
+        if batch_window:
+            channel_batcher = ChannelEventBatcher(
+                dao, notifier, batch_window, dispatch=bus_consumer.dispatch
+            )
+        bus_event_handler = BusEventHandler(
+            dao, notifier, store, line_cache, channel_batcher
+        )
         bus_event_handler.subscribe(bus_consumer)
 
         api.add_resource(
             PresenceListResource, '/users/presences', resource_class_args=[service]
         )
 
+        api.add_resource(
+            PresenceChangesResource,
+            '/users/presences/changes',
+            resource_class_args=[service],
+        )
+
         api.add_resource(
             PresenceItemResource,
             '/users/<uuid:user_uuid>/presences',
@@ -1,31 +1,22 @@
 # Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from marshmallow import post_dump, pre_load
+import datetime
+import uuid
+
+from marshmallow import EXCLUDE, post_dump, pre_load
 
 from xivo.mallow import fields
-from xivo.mallow.validate import OneOf
+from xivo.mallow.validate import Length, OneOf
 from xivo.mallow_helpers import Schema
 
+LINE_STATES = ['available', 'unavailable', 'holding', 'ringing', 'talking']
+
 
 class LinePresenceSchema(Schema):
     id = fields.Integer(dump_only=True)
     state = fields.String(dump_only=True)
 
-    @post_dump(pass_original=True)
-    def _set_state(self, data, raw_data):
-        if 'ringing' in raw_data.channels_state:
-            merged_state = 'ringing'
-        elif 'holding' in raw_data.channels_state:
-            merged_state = 'holding'
-        elif 'talking' in raw_data.channels_state:
-            merged_state = 'talking'
-        else:
-            merged_state = raw_data.endpoint_state or 'unavailable'
-
-        data['state'] = merged_state
-        return data
-
 
 class SessionPresenceSchema(Schema):
     uuid = fields.UUID(dump_only=True)
@@ -49,24 +40,6 @@ class UserPresenceSchema(Schema):
     sessions = fields.Nested('SessionPresenceSchema', many=True, dump_only=True)
     lines = fields.Nested('LinePresenceSchema', many=True, dump_only=True)
 
-    @post_dump
-    def _set_line_state(self, user):
-        line_states = [line['state'] for line in user['lines']]
-
-        if 'ringing' in line_states:
-            merged_state = 'ringing'
-        elif 'holding' in line_states:
-            merged_state = 'holding'
-        elif 'talking' in line_states:
-            merged_state = 'talking'
-        elif 'available' in line_states:
-            merged_state = 'available'
-        else:
-            merged_state = 'unavailable'
-
-        user['line_state'] = merged_state
-        return user
-
     @post_dump(pass_original=True)
     def _set_mobile(self, user, raw_user):
         for token in raw_user.refresh_tokens:
@@ -88,10 +61,105 @@ class UserPresenceSchema(Schema):
         return user
 
 
+def dump_presence(user):
+    # Same result as UserPresenceSchema().dump(user), without the per field
+    # overhead of marshmallow that dominates when dumping thousands of users
+    return {
+        'uuid': _dump_uuid(user.uuid),
+        'tenant_uuid': _dump_uuid(user.tenant_uuid),
+        'state': _dump_string(user.state),
+        'status': _dump_string(user.status),
+        'last_activity': _dump_datetime(user.last_activity),
+        'line_state': _dump_string(user.line_state),
+        'mobile': _is_mobile(user),
+        'do_not_disturb': _dump_boolean(user.do_not_disturb),
+        'connected': True if user.sessions else False,
+        'sessions': [
+            {'uuid': _dump_uuid(session.uuid), 'mobile': _dump_boolean(session.mobile)}
+            for session in user.sessions
+        ],
+        'lines': [
+            {'id': _dump_integer(line.id), 'state': _dump_string(line.state)}
+            for line in user.lines
+        ],
+    }
+
+
+def dump_presences(users):
+    return [dump_presence(user) for user in users]
+
+
+def _is_mobile(user):
+    for token in user.refresh_tokens:
+        if token.mobile is True:
+            return True
+    for session in user.sessions:
+        if session.mobile is True:
+            return True
+    return False
+
+
+def _dump_uuid(value):
+    if value is None:
+        return None
+    if not isinstance(value, uuid.UUID):
+        value = uuid.UUID(value)
+    return str(value)
+
+
+def _dump_string(value):
+    return None if value is None else str(value)
+
+
+def _dump_integer(value):
+    return None if value is None else int(value)
+
+
+def _dump_boolean(value):
+    if value is None:
+        return None
+    if value in fields.Boolean.truthy:
+        return True
+    if value in fields.Boolean.falsy:
+        return False
+    return bool(value)
+
+
+def _dump_datetime(value):
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    else:
+        value = value.astimezone(datetime.timezone.utc)
+    return value.isoformat()
+
+
+class UserPresenceUpdateSchema(UserPresenceSchema):
+    uuid = fields.UUID(required=True)
+
+
+class BulkUpdateRequestSchema(Schema):
+    items = fields.Nested(
+        'UserPresenceUpdateSchema',
+        many=True,
+        required=True,
+        validate=Length(min=1),
+        unknown=EXCLUDE,
+    )
+
+
+class ChangesRequestSchema(Schema):
+
+    recurse = fields.Boolean(missing=False)
+    since = fields.String(missing=None)
+
+
 class ListRequestSchema(Schema):
 
     recurse = fields.Boolean(missing=False)
     user_uuid = fields.List(fields.UUID(), missing=[], attribute='uuids')
+    line_state = fields.String(validate=OneOf(LINE_STATES))
 
     @pre_load
     def convert_user_uuid_to_list(self, data):
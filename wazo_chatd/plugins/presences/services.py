@@ -1,25 +1,70 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import datetime
 
+from wazo_chatd.exceptions import UnknownUserException
+
+from .schemas import dump_presence, dump_presences
+
 
 class PresenceService:
-    def __init__(self, dao, notifier):
+    def __init__(self, dao, notifier, store):
         self._dao = dao
         self._notifier = notifier
-
-    def list_(self, tenant_uuids, **filter_parameters):
-        return self._dao.user.list_(tenant_uuids, **filter_parameters)
-
-    def count(self, tenant_uuids, **filter_parameters):
-        return self._dao.user.count(tenant_uuids, **filter_parameters)
+        self._store = store
 
     def get(self, tenant_uuids, user_uuid):
         return self._dao.user.get(tenant_uuids, user_uuid)
 
+    def list_presences(self, tenant_uuids, **filter_parameters):
+        if self._store.is_loaded():
+            presences = self._store.list_(tenant_uuids, **filter_parameters)
+            filtered = total = len(presences)
+            if filter_parameters.get('uuids') or filter_parameters.get('line_state'):
+                total = self._store.count(tenant_uuids)
+            return presences, filtered, total
+
+        users, filtered, total = self._dao.user.list_presences_with_count(
+            tenant_uuids, **filter_parameters
+        )
+        return dump_presences(users), filtered, total
+
+    def presences_version(self, tenant_uuids):
+        # Only the presences served from the store are versioned
+        if self._store.is_loaded():
+            return self._store.version(tenant_uuids)
+
+    def list_presence_changes(self, tenant_uuids, since=None):
+        if self._store.is_loaded():
+            return self._store.changes(tenant_uuids, since)
+
+        # Without the store, changes are not tracked and the cursor is never valid
+        presences, _, _ = self.list_presences(tenant_uuids)
+        return presences, [], None, True
+
+    def get_presence(self, tenant_uuids, user_uuid):
+        if self._store.is_loaded():
+            return self._store.get(tenant_uuids, user_uuid)
+        user = self._dao.user.get(tenant_uuids, user_uuid)
+        return dump_presence(user)
+
     def update(self, user):
         user.last_activity = datetime.datetime.utcnow()
         self._dao.user.update(user)
         self._notifier.updated(user)
         return user
+
+    def update_many(self, tenant_uuids, presences):
+        # The last presence of a user wins
+        presences = {str(presence['uuid']): presence for presence in presences}
+        updated_uuids = self._dao.user.update_presences(
+            tenant_uuids, list(presences.values()), datetime.datetime.utcnow()
+        )
+        if len(updated_uuids) != len(presences):
+            users = self._dao.user.list_presences(tenant_uuids, uuids=list(presences))
+            unknown_uuids = set(presences) - set(str(user.uuid) for user in users)
+            raise UnknownUserException(sorted(unknown_uuids)[0])
+
+        users = self._dao.user.list_presences(tenant_uuids, uuids=updated_uuids)
+        self._notifier.updated_many(users)
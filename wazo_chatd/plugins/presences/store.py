@@ -0,0 +1,257 @@
+# Copyright 2021 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import collections
+import logging
+import threading
+import uuid
+
+from wazo_chatd.exceptions import UnknownUserException
+from wazo_chatd.plugin_helpers.versions import VersionTracker
+
+from .schemas import dump_presences
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceStore:
+    def __init__(self, change_log_size=10000):
+        self._presences = {}
+        self._lock = threading.Lock()
+        self._is_loaded = False
+        self._versions = VersionTracker()
+        self._changes = collections.deque(maxlen=change_log_size)
+        self._sequence = 0
+        self._epoch = uuid.uuid4().hex[:8]
+
+    def is_loaded(self):
+        return self._is_loaded
+
+    def sequence(self):
+        return self._sequence
+
+    def load(self, users, since=None):
+        presences = dump_presences(users)
+        with self._lock:
+            self._presences = self._merge(presences, since)
+            self._is_loaded = True
+            # Previous cursors can't be followed, they will get a snapshot
+            self._changes.clear()
+            self._epoch = uuid.uuid4().hex[:8]
+        self._versions.reset()
+        logger.debug('Presence store loaded with %s users', len(presences))
+
+    def reload(self, users, since=None):
+        presences = dump_presences(users)
+        with self._lock:
+            previous_presences = self._presences
+            self._presences = self._merge(presences, since)
+            self._is_loaded = True
+
+            changed_presences = [
+                presence
+                for uuid_, presence in self._presences.items()
+                if previous_presences.get(uuid_) != presence
+            ]
+            deleted_presences = [
+                presence
+                for uuid_, presence in previous_presences.items()
+                if uuid_ not in self._presences
+            ]
+            for presence in changed_presences + deleted_presences:
+                self._log_change(presence)
+
+        self._versions.bump(
+            *set(
+                presence['tenant_uuid']
+                for presence in changed_presences + deleted_presences
+            )
+        )
+        changed_uuids = set(presence['uuid'] for presence in changed_presences)
+        return [
+            user
+            for user, presence in zip(users, presences)
+            if presence['uuid'] in changed_uuids
+        ]
+
+    def _merge(self, presences, since):
+        # The snapshot is older than the changes applied while it was loaded
+        # (since the sequence `since`), they are kept instead of its values
+        snapshot = {presence['uuid']: presence for presence in presences}
+        if since is None:
+            return snapshot
+
+        for sequence, uuid_, _ in self._changes:
+            if sequence <= since:
+                continue
+            presence = self._presences.get(uuid_)
+            if presence:
+                snapshot[uuid_] = presence
+            else:
+                snapshot.pop(uuid_, None)
+        return snapshot
+
+    def update(self, presence):
+        with self._lock:
+            previous_presence = self._presences.get(presence['uuid'])
+            self._presences[presence['uuid']] = presence
+            if presence != previous_presence:
+                self._log_change(presence)
+        if presence != previous_presence:
+            self._versions.bump(presence['tenant_uuid'])
+        return presence
+
+    def delete(self, user_uuid):
+        with self._lock:
+            presence = self._presences.pop(str(user_uuid), None)
+            if presence:
+                self._log_change(presence)
+        if presence:
+            self._versions.bump(presence['tenant_uuid'])
+
+    def delete_tenant(self, tenant_uuid):
+        tenant_uuid = str(tenant_uuid)
+        with self._lock:
+            presences = self._presences
+            self._presences = {
+                uuid_: presence
+                for uuid_, presence in presences.items()
+                if presence['tenant_uuid'] != tenant_uuid
+            }
+            for uuid_, presence in presences.items():
+                if uuid_ not in self._presences:
+                    self._log_change(presence)
+        self._versions.bump(tenant_uuid)
+
+    def _log_change(self, presence):
+        self._sequence += 1
+        self._changes.append(
+            (self._sequence, presence['uuid'], presence['tenant_uuid'])
+        )
+
+    def changes(self, tenant_uuids, since=None):
+        tenant_uuids = self._tenants(tenant_uuids)
+        with self._lock:
+            cursor = '{}-{}'.format(self._epoch, self._sequence)
+            sequence = self._parse_cursor(since)
+            if sequence is None:
+                presences = list(self._presences.values())
+                return self._filter_tenants(presences, tenant_uuids), [], cursor, True
+
+            changed_tenants = collections.defaultdict(set)
+            for change_sequence, uuid_, tenant_uuid in reversed(self._changes):
+                if change_sequence <= sequence:
+                    break
+                changed_tenants[uuid_].add(tenant_uuid)
+
+            presences = []
+            deleted_uuids = []
+            for uuid_, tenants in changed_tenants.items():
+                presence = self._presences.get(uuid_)
+                if presence and self._filter_tenants([presence], tenant_uuids):
+                    presences.append(presence)
+                elif tenant_uuids is None or tenants & tenant_uuids:
+                    # Also a user that moved out of the visible tenants
+                    deleted_uuids.append(uuid_)
+
+        return presences, deleted_uuids, cursor, False
+
+    def _parse_cursor(self, cursor):
+        # Returns None when the changes since the cursor are not all known
+        if not cursor:
+            return None
+        epoch, _, sequence = cursor.partition('-')
+        if epoch != self._epoch or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        if sequence > self._sequence:
+            return None
+        oldest_sequence = self._changes[0][0] if self._changes else self._sequence + 1
+        if sequence < oldest_sequence - 1:
+            return None
+        return sequence
+
+    def get(self, tenant_uuids, user_uuid):
+        presence = self._presences.get(str(user_uuid))
+        if not presence or presence['tenant_uuid'] not in self._tenants(tenant_uuids):
+            raise UnknownUserException(user_uuid)
+        return presence
+
+    def list_(self, tenant_uuids, uuids=None, line_state=None, **ignored):
+        tenant_uuids = self._tenants(tenant_uuids)
+        with self._lock:
+            presences = list(self._presences.values())
+
+        if uuids:
+            uuids = set(str(uuid) for uuid in uuids)
+            presences = [
+                presence for presence in presences if presence['uuid'] in uuids
+            ]
+
+        if line_state:
+            presences = [
+                presence
+                for presence in presences
+                if presence['line_state'] == line_state
+            ]
+
+        return self._filter_tenants(presences, tenant_uuids)
+
+    def count(self, tenant_uuids, **filter_parameters):
+        return len(self.list_(tenant_uuids, **filter_parameters))
+
+    def version(self, tenant_uuids):
+        return self._versions.get(tenant_uuids)
+
+    def _filter_tenants(self, presences, tenant_uuids):
+        if tenant_uuids is None:
+            return presences
+
+        return [
+            presence
+            for presence in presences
+            if presence['tenant_uuid'] in tenant_uuids
+        ]
+
+    def _tenants(self, tenant_uuids):
+        if tenant_uuids is None:
+            return None
+        return set(str(tenant_uuid) for tenant_uuid in tenant_uuids)
+
+
+class LineOwnerCache:
+    _missing = object()
+
+    def __init__(self, dao):
+        self._dao = dao
+        self._owners = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, endpoint_name):
+        owner = self._owners.get(endpoint_name, self._missing)
+        if owner is not self._missing:
+            return owner
+
+        generation = self._generation
+        # Endpoints without line (e.g. trunks) are cached too
+        owner = self._dao.line.find_owner(endpoint_name)
+        with self._lock:
+            # Don't cache a result that was invalidated while being fetched
+            if generation == self._generation:
+                self._owners[endpoint_name] = owner
+        return owner
+
+    def discard(self, line_id, endpoint_name=None):
+        with self._lock:
+            self._generation += 1
+            self._owners = {
+                name: owner
+                for name, owner in self._owners.items()
+                if name != endpoint_name and (not owner or owner.id != line_id)
+            }
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._owners = {}
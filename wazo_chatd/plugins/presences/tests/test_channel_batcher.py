@@ -0,0 +1,154 @@
+# Copyright 2021 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+
+from hamcrest import assert_that, equal_to
+from mock import Mock, patch, sentinel as s
+
+from ..channel_batcher import ChannelEventBatcher
+
+
+@patch('wazo_chatd.plugins.presences.channel_batcher.session_scope')
+@patch('wazo_chatd.plugins.presences.channel_batcher.threading.Timer')
+class TestChannelEventBatcher(unittest.TestCase):
+    def setUp(self):
+        self.dao = Mock()
+        self.dao.channel.delete_all_by_names.return_value = []
+        self.dao.channel.create_or_update_all.return_value = []
+        self.dao.channel.update_states.return_value = []
+        self.notifier = Mock()
+        self.batcher = ChannelEventBatcher(self.dao, self.notifier, 0.01)
+
+    def test_events_applied_in_one_batch(self, Timer, session_scope):
+        self.batcher.created('PJSIP/abcd-00000001', 'undefined')
+        self.batcher.updated('PJSIP/abcd-00000001', 'talking')
+        self.batcher.updated('PJSIP/efgh-00000002', 'holding')
+        self.batcher.deleted('PJSIP/ijkl-00000003')
+
+        Timer.assert_called_once_with(0.01, self.batcher._flush)
+        self.batcher._flush()
+
+        self.dao.channel.create_or_update_all.assert_called_once_with(
+            [
+                {
+                    'name': 'PJSIP/abcd-00000001',
+                    'state': 'talking',
+                    'endpoint_name': 'PJSIP/abcd',
+                }
+            ]
+        )
+        self.dao.channel.update_states.assert_called_once_with(
+            [{'name': 'PJSIP/efgh-00000002', 'state': 'holding'}]
+        )
+        self.dao.channel.delete_all_by_names.assert_called_once_with(
+            ['PJSIP/ijkl-00000003']
+        )
+        session_scope.assert_called_once_with()
+
+    def test_update_after_delete_is_ignored(self, Timer, session_scope):
+        self.batcher.created('PJSIP/abcd-00000001', 'talking')
+        self.batcher.deleted('PJSIP/abcd-00000001')
+        self.batcher.updated('PJSIP/abcd-00000001', 'talking')
+
+        self.batcher._flush()
+
+        self.dao.channel.delete_all_by_names.assert_called_once_with(
+            ['PJSIP/abcd-00000001']
+        )
+        self.dao.channel.create_or_update_all.assert_not_called()
+        self.dao.channel.update_states.assert_not_called()
+
+    def test_users_notified_after_batch(self, Timer, session_scope):
+        self.dao.channel.update_states.return_value = [s.user_uuid, s.user_uuid]
+        self.dao.user.list_presences.return_value = [s.user]
+        self.batcher.updated('PJSIP/abcd-00000001', 'talking')
+
+        self.batcher._flush()
+
+        self.dao.user.list_presences.assert_called_once_with(None, uuids=[s.user_uuid])
+        self.notifier.updated_many.assert_called_once_with([s.user])
+
+    def test_users_notified_in_order_with_their_events(self, Timer, session_scope):
+        dispatch = Mock()
+        batcher = ChannelEventBatcher(self.dao, self.notifier, 0.01, dispatch=dispatch)
+        self.dao.channel.update_states.return_value = ['user-uuid']
+        self.dao.user.list_presences.return_value = [s.user]
+        batcher.updated('PJSIP/abcd-00000001', 'talking')
+
+        batcher._flush()
+
+        self.notifier.updated_many.assert_not_called()
+        dispatch.assert_called_once()
+        key, task = dispatch.call_args[0]
+        assert_that(key, equal_to('user-uuid'))
+
+        task()
+
+        self.dao.user.list_presences.assert_called_once_with(None, uuids=['user-uuid'])
+        self.notifier.updated_many.assert_called_once_with([s.user])
+
+    def test_no_notification_when_nothing_changed(self, Timer, session_scope):
+        self.batcher.updated('PJSIP/abcd-00000001', 'talking')
+
+        self.batcher._flush()
+
+        self.dao.user.list_presences.assert_not_called()
+        self.notifier.updated_many.assert_not_called()
+
+    def test_failed_batch_is_retried_before_newer_events(self, Timer, session_scope):
+        self.dao.channel.update_states.side_effect = [Exception, []]
+        self.batcher.created('PJSIP/abcd-00000001', 'ringing')
+        self.batcher.updated('PJSIP/efgh-00000002', 'ringing')
+        self.batcher._flush()
+
+        self.batcher.updated('PJSIP/abcd-00000001', 'talking')
+        self.batcher.updated('PJSIP/efgh-00000002', 'talking')
+        self.batcher._flush()
+
+        self.dao.channel.create_or_update_all.assert_called_with(
+            [
+                {
+                    'name': 'PJSIP/abcd-00000001',
+                    'state': 'talking',
+                    'endpoint_name': 'PJSIP/abcd',
+                }
+            ]
+        )
+        self.dao.channel.update_states.assert_called_with(
+            [{'name': 'PJSIP/efgh-00000002', 'state': 'talking'}]
+        )
+
+    def test_failed_batch_is_dropped_after_max_attempts(self, Timer, session_scope):
+        self.dao.channel.update_states.side_effect = Exception
+        self.batcher.updated('PJSIP/abcd-00000001', 'talking')
+
+        for _ in range(3):
+            self.batcher._flush()
+        self.batcher._flush()
+
+        assert_that(self.dao.channel.update_states.call_count, equal_to(3))
+
+    def test_events_acked_after_commit(self, Timer, session_scope):
+        ack = Mock()
+        session_scope.return_value.__exit__.side_effect = lambda *args: (
+            ack.assert_not_called()
+        )
+        self.batcher.updated('PJSIP/abcd-00000001', 'talking', ack)
+
+        self.batcher._flush()
+
+        ack.assert_called_once_with()
+
+    def test_failed_events_acked_with_their_retry(self, Timer, session_scope):
+        ack, newer_ack = Mock(), Mock()
+        self.dao.channel.update_states.side_effect = [Exception, []]
+        self.batcher.updated('PJSIP/abcd-00000001', 'talking', ack)
+        self.batcher._flush()
+        ack.assert_not_called()
+
+        self.batcher.updated('PJSIP/efgh-00000002', 'talking', newer_ack)
+        self.batcher._flush()
+
+        ack.assert_called_once_with()
+        newer_ack.assert_called_once_with()
@@ -0,0 +1,194 @@
+# Copyright 2021 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import threading
+import unittest
+
+from collections import defaultdict
+from concurrent.futures import TimeoutError
+
+from hamcrest import assert_that, calling, equal_to, has_entries, has_key, raises
+from mock import Mock, sentinel as s
+
+from ..initiator import Initiator
+
+
+class TestInitiatorFetch(unittest.TestCase):
+    def setUp(self):
+        self.auth = Mock()
+        self.amid = Mock()
+        self.confd = Mock()
+        self.initiator = Initiator(Mock(), self.auth, self.amid, self.confd, Mock())
+
+    def test_fetch_all_returns_results_by_name(self):
+        result = self.initiator._fetch_all(
+            {'tenants': lambda: s.tenants, 'users': lambda: s.users}
+        )
+
+        assert_that(result, equal_to({'tenants': s.tenants, 'users': s.users}))
+
+    def test_fetch_all_runs_fetchers_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        result = self.initiator._fetch_all(
+            {'tenants': barrier.wait, 'users': barrier.wait}
+        )
+
+        assert_that(result, has_key('users'))
+
+    def test_fetch_all_timeout(self):
+        release = threading.Event()
+        self.initiator._timeouts = {'users': 0.01}
+
+        try:
+            assert_that(
+                calling(self.initiator._fetch_all).with_args(
+                    {'users': lambda: release.wait(5)}
+                ),
+                raises(TimeoutError),
+            )
+        finally:
+            release.set()
+
+    def test_fetch_durations_in_status(self):
+        self.initiator._fetch_all({'tenants': lambda: s.tenants})
+
+        status = defaultdict(dict)
+        self.initiator.provide_status(status)
+
+        assert_that(
+            status['presence_initialization'],
+            has_entries(fetch_duration_ms=has_key('tenants')),
+        )
+
+    def test_initiate_fetches_channels_after_endpoints(self):
+        calls = []
+        self.amid.action.side_effect = lambda action: calls.append(action) or []
+        self.auth.token.new.return_value = {'token': s.token}
+        self.auth.tenants.list.return_value = {'items': []}
+        self.auth.sessions.list.return_value = {'items': []}
+        self.auth.refresh_tokens.list.return_value = {'items': []}
+        self.confd.users.list.return_value = {'items': [], 'total': 0}
+        self.initiator._fetch_all = Mock(wraps=self.initiator._fetch_all)
+        for name in (
+            'initiate_endpoints',
+            'initiate_tenants',
+            'initiate_user_pages',
+            'initiate_sessions',
+            'initiate_refresh_tokens',
+            'initiate_channels',
+            'initiate_store',
+        ):
+            setattr(self.initiator, name, Mock())
+
+        self.initiator.initiate()
+
+        assert_that(calls, equal_to(['DeviceStateList', 'CoreShowChannels']))
+        assert_that(self.initiator.is_initialized(), equal_to(True))
+
+    def test_initiate_fetches_users_with_the_other_sources(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wait(result):
+            barrier.wait()
+            return result
+
+        self.auth.token.new.return_value = {'token': s.token}
+        self.auth.tenants.list.side_effect = lambda: wait({'items': []})
+        self.auth.sessions.list.return_value = {'items': []}
+        self.auth.refresh_tokens.list.return_value = {'items': []}
+        self.amid.action.return_value = []
+        self.confd.users.list.side_effect = lambda **kwargs: wait(
+            {'items': [{'uuid': s.user_uuid}], 'total': 1}
+        )
+        for name in (
+            'initiate_endpoints',
+            'initiate_tenants',
+            'initiate_user_pages',
+            'initiate_sessions',
+            'initiate_refresh_tokens',
+            'initiate_channels',
+            'initiate_store',
+        ):
+            setattr(self.initiator, name, Mock())
+
+        self.initiator.initiate()
+
+        self.initiator.initiate_user_pages.assert_called_once_with(
+            [[{'uuid': s.user_uuid}]], complete=True
+        )
+
+    def test_fetch_user_pages(self):
+        self.initiator._users_page_size = 2
+        self.confd.users.list.side_effect = [
+            {'items': [{'uuid': 1}, {'uuid': 2}], 'total': 3},
+            {'items': [{'uuid': 2}, {'uuid': 3}], 'total': 3},
+        ]
+
+        pages = self.initiator._fetch_user_pages()
+
+        assert_that(list(pages), equal_to([[{'uuid': 1}, {'uuid': 2}], [{'uuid': 3}]]))
+        assert_that(pages.complete, equal_to(True))
+        self.confd.users.list.assert_called_with(
+            recurse=True, order='uuid', direction='asc', limit=3, offset=1
+        )
+
+    def test_fetch_user_pages_stops_on_empty_page(self):
+        self.initiator._users_page_size = 2
+        self.confd.users.list.side_effect = [
+            {'items': [{'uuid': 1}, {'uuid': 2}], 'total': 2},
+            {'items': [{'uuid': 2}], 'total': 2},
+        ]
+
+        pages = self.initiator._fetch_user_pages()
+
+        assert_that(list(pages), equal_to([[{'uuid': 1}, {'uuid': 2}]]))
+        assert_that(pages.complete, equal_to(True))
+
+    def test_fetch_user_pages_when_a_fetched_user_is_deleted(self):
+        self.initiator._users_page_size = 2
+        self.confd.users.list.side_effect = [
+            {'items': [{'uuid': 1}, {'uuid': 2}], 'total': 4},
+            {'items': [{'uuid': 3}, {'uuid': 4}], 'total': 3},
+        ]
+
+        pages = self.initiator._fetch_user_pages()
+
+        assert_that(
+            list(pages),
+            equal_to([[{'uuid': 1}, {'uuid': 2}], [{'uuid': 3}, {'uuid': 4}]]),
+        )
+        assert_that(pages.complete, equal_to(False))
+
+    def test_fetch_user_pages_when_total_changes(self):
+        self.initiator._users_page_size = 2
+        self.confd.users.list.side_effect = [
+            {'items': [{'uuid': 1}, {'uuid': 2}], 'total': 3},
+            {'items': [{'uuid': 2}, {'uuid': 4}], 'total': 4},
+        ]
+
+        pages = self.initiator._fetch_user_pages()
+        list(pages)
+
+        assert_that(pages.complete, equal_to(False))
+
+    def test_resync_does_not_reset_initialization(self):
+        self.auth.token.new.return_value = {'token': s.token}
+        self.auth.tenants.list.return_value = {'items': []}
+        self.confd.users.list.return_value = {'items': [], 'total': 0}
+        self.amid.action.return_value = []
+        self.initiator._is_initialized = True
+        for name in (
+            'initiate_tenants',
+            'initiate_user_pages',
+            'initiate_channels',
+            'resync_store',
+        ):
+            setattr(self.initiator, name, Mock())
+
+        self.initiator.resync()
+
+        self.amid.action.assert_called_once_with('CoreShowChannels')
+        self.initiator.initiate_channels.assert_called_once_with([])
+        self.initiator.resync_store.assert_called_once_with()
+        assert_that(self.initiator.is_initialized(), equal_to(True))
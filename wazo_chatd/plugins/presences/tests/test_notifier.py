@@ -0,0 +1,148 @@
+# Copyright 2021 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+
+from hamcrest import assert_that, contains, equal_to, has_properties
+from mock import Mock, patch
+
+from ..notifier import PresenceNotifier
+
+
+class TestPresenceNotifier(unittest.TestCase):
+    def setUp(self):
+        self.bus = Mock()
+        self.store = Mock()
+        self.notifier = PresenceNotifier(self.bus, self.store)
+        self.on_commit = patch(
+            'wazo_chatd.plugins.presences.notifier.on_commit',
+            side_effect=lambda callback: callback(),
+        ).start()
+        patch(
+            'wazo_chatd.plugins.presences.notifier.dump_presence', side_effect=dict
+        ).start()
+        self.addCleanup(patch.stopall)
+
+    def _published_presences(self):
+        return [
+            event.marshal()
+            for call in self.bus.publish_many.call_args_list
+            for event, _ in call[0][0]
+        ]
+
+    def test_updated_without_window_publishes_immediately(self):
+        self.notifier.updated({'uuid': 'user-1', 'state': 'available'})
+
+        assert_that(
+            self._published_presences(),
+            contains(equal_to({'uuid': 'user-1', 'state': 'available'})),
+        )
+
+    def test_updated_with_same_presence_is_not_published_twice(self):
+        self.notifier.updated({'uuid': 'user-1', 'state': 'available'})
+        self.notifier.updated({'uuid': 'user-1', 'state': 'available'})
+
+        assert_that(self.bus.publish_many.call_count, equal_to(1))
+
+    @patch('wazo_chatd.plugins.presences.notifier.threading.Timer')
+    def test_updated_with_window_publishes_final_state(self, Timer):
+        self.notifier = PresenceNotifier(self.bus, self.store, coalesce_window=0.05)
+
+        self.notifier.updated({'uuid': 'user-1', 'state': 'available'})
+        self.notifier.updated({'uuid': 'user-1', 'state': 'away'})
+        self.notifier.updated({'uuid': 'user-2', 'state': 'available'})
+
+        Timer.assert_called_once_with(0.05, self.notifier._flush)
+        self.bus.publish_many.assert_not_called()
+
+        self.notifier._flush()
+
+        assert_that(
+            self._published_presences(),
+            contains(
+                equal_to({'uuid': 'user-1', 'state': 'away'}),
+                equal_to({'uuid': 'user-2', 'state': 'available'}),
+            ),
+        )
+        assert_that(self.notifier, has_properties(_timer=None))
+
+    @patch('wazo_chatd.plugins.presences.notifier.threading.Timer')
+    def test_updated_with_unchanged_presence_is_not_scheduled(self, Timer):
+        self.notifier = PresenceNotifier(self.bus, self.store, coalesce_window=0.05)
+        self.notifier.updated({'uuid': 'user-1', 'state': 'available'})
+        self.notifier._flush()
+        Timer.reset_mock()
+
+        self.notifier.updated({'uuid': 'user-1', 'state': 'available'})
+
+        Timer.assert_not_called()
+
+    @patch('wazo_chatd.plugins.presences.notifier.threading.Timer')
+    def test_updated_back_to_last_sent_presence_within_window(self, Timer):
+        self.notifier = PresenceNotifier(self.bus, self.store, coalesce_window=0.05)
+        self.notifier.updated({'uuid': 'user-1', 'state': 'available'})
+        self.notifier._flush()
+
+        self.notifier.updated({'uuid': 'user-1', 'state': 'away'})
+        self.notifier.updated({'uuid': 'user-1', 'state': 'available'})
+        self.notifier._flush()
+
+        assert_that(self.bus.publish_many.call_count, equal_to(1))
+
+    def test_updated_many_publishes_one_batch(self):
+        self.notifier.updated_many(
+            [
+                {'uuid': 'user-1', 'state': 'available'},
+                {'uuid': 'user-2', 'state': 'away'},
+            ]
+        )
+
+        self.bus.publish_many.assert_called_once()
+        assert_that(
+            self._published_presences(),
+            contains(
+                equal_to({'uuid': 'user-1', 'state': 'available'}),
+                equal_to({'uuid': 'user-2', 'state': 'away'}),
+            ),
+        )
+
+    def test_updated_is_applied_on_commit(self):
+        self.on_commit.side_effect = None
+
+        self.notifier.updated({'uuid': 'user-1', 'state': 'available'})
+
+        self.store.update.assert_not_called()
+        self.bus.publish_many.assert_not_called()
+
+        callback = self.on_commit.call_args[0][0]
+        callback()
+
+        self.store.update.assert_called_once_with(
+            {'uuid': 'user-1', 'state': 'available'}
+        )
+        self.bus.publish_many.assert_called_once()
+
+    def test_deleted_forgets_last_sent_presence(self):
+        self.notifier.updated({'uuid': 'user-1', 'state': 'available'})
+
+        self.notifier.deleted('user-1')
+        self.notifier.updated({'uuid': 'user-1', 'state': 'available'})
+
+        self.store.delete.assert_called_once_with('user-1')
+        assert_that(self.bus.publish_many.call_count, equal_to(2))
+
+    def test_deleted_tenant_forgets_last_sent_presences(self):
+        self.notifier.updated_many(
+            [
+                {'uuid': 'user-1', 'tenant_uuid': 'tenant-1'},
+                {'uuid': 'user-2', 'tenant_uuid': 'tenant-2'},
+            ]
+        )
+
+        self.notifier.deleted_tenant('tenant-1')
+
+        self.store.delete_tenant.assert_called_once_with('tenant-1')
+        assert_that(
+            self.notifier._last_sent,
+            equal_to({'user-2': {'uuid': 'user-2', 'tenant_uuid': 'tenant-2'}}),
+        )
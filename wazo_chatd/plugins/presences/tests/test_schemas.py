@@ -1,6 +1,7 @@
-# Copyright 2019-2020 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import datetime
 import uuid
 import unittest
 
@@ -12,11 +13,17 @@ from hamcrest import (
     calling,
     contains,
     empty,
+    equal_to,
     has_entries,
     raises,
 )
 
-from ..schemas import UserPresenceSchema, LinePresenceSchema, ListRequestSchema
+from ..schemas import (
+    BulkUpdateRequestSchema,
+    ListRequestSchema,
+    UserPresenceSchema,
+    dump_presence,
+)
 
 UUID = uuid.uuid4()
 
@@ -26,82 +33,23 @@ class TestUserPresenceSchema(unittest.TestCase):
     schema = UserPresenceSchema
 
     def setUp(self):
-        self.line_ringing = Mock(
-            id=1, channels_state=['ringing'], endpoint_state='available'
-        )
-        self.line_holding = Mock(
-            id=2, channels_state=['holding'], endpoint_state='available'
-        )
-        self.line_talking = Mock(
-            id=3, channels_state=['talking'], endpoint_state='available'
-        )
-        self.line_available = Mock(
-            id=4, channels_state=['undefined'], endpoint_state='available'
-        )
-        self.line_unavailable = Mock(
-            id=5, channels_state=['undefined'], endpoint_state='unavailable'
-        )
         self.user = Mock(
-            uuid=UUID, tenant_uuid=UUID, sessions=[], lines=[], refresh_tokens=[]
+            uuid=UUID,
+            tenant_uuid=UUID,
+            line_state='talking',
+            sessions=[],
+            lines=[Mock(id=1, state='talking')],
+            refresh_tokens=[],
         )
 
-    def test_set_line_state_ringing(self):
-        self.user.lines = [
-            self.line_unavailable,
-            self.line_available,
-            self.line_talking,
-            self.line_holding,
-            self.line_ringing,
-            self.line_holding,
-            self.line_talking,
-            self.line_available,
-            self.line_unavailable,
-        ]
-
-        result = self.schema().dump(self.user)
-        assert_that(result, has_entries(line_state='ringing'))
-
-    def test_set_line_state_holding(self):
-        self.user.lines = [
-            self.line_unavailable,
-            self.line_available,
-            self.line_talking,
-            self.line_holding,
-            self.line_talking,
-            self.line_available,
-            self.line_unavailable,
-        ]
-
-        result = self.schema().dump(self.user)
-        assert_that(result, has_entries(line_state='holding'))
-
-    def test_set_line_state_talking(self):
-        self.user.lines = [
-            self.line_unavailable,
-            self.line_available,
-            self.line_talking,
-            self.line_available,
-            self.line_unavailable,
-        ]
-
-        result = self.schema().dump(self.user)
-        assert_that(result, has_entries(line_state='talking'))
-
-    def test_set_line_state_available(self):
-        self.user.lines = [
-            self.line_unavailable,
-            self.line_available,
-            self.line_unavailable,
-        ]
-
+    def test_line_states(self):
         result = self.schema().dump(self.user)
-        assert_that(result, has_entries(line_state='available'))
-
-    def test_set_line_state_unavailable(self):
-        self.user.lines = [self.line_unavailable]
-
-        result = self.schema().dump(self.user)
-        assert_that(result, has_entries(line_state='unavailable'))
+        assert_that(
+            result,
+            has_entries(
+                line_state='talking', lines=contains(has_entries(state='talking'))
+            ),
+        )
 
     def test_set_mobile_when_no_refresh_token_and_no_session(self):
         self.user.refresh_tokens = []
@@ -160,62 +108,58 @@ class TestUserPresenceSchema(unittest.TestCase):
         assert_that(result, has_entries(mobile=False))
 
 
-class TestLinePresenceSchema(unittest.TestCase):
+class TestDumpPresence(unittest.TestCase):
+    def setUp(self):
+        self.user = Mock(
+            uuid=UUID,
+            tenant_uuid=str(UUID),
+            state='away',
+            status=None,
+            last_activity=datetime.datetime(2021, 3, 1, 12, 30, 15, 123456),
+            line_state='ringing',
+            do_not_disturb=True,
+            sessions=[Mock(uuid=UUID, mobile=False)],
+            lines=[Mock(id=1, state='ringing'), Mock(id=2, state='available')],
+            refresh_tokens=[Mock(mobile=True)],
+        )
 
-    schema = LinePresenceSchema
+    def test_same_as_schema(self):
+        result = dump_presence(self.user)
+        assert_that(result, equal_to(UserPresenceSchema().dump(self.user)))
 
-    def setUp(self):
-        self.line = Mock(id=42, channels_state=[], endpoint_state=None)
-
-    def test_set_state_ringing(self):
-        self.line.channels_state = [
-            'undefined',
-            'talking',
-            'holding',
-            'ringing',
-            'holding',
-            'talking',
-            'undefined',
-        ]
-
-        result = self.schema().dump(self.line)
-        assert_that(result, has_entries(state='ringing'))
-
-    def test_set_state_holding(self):
-        self.line.channels_state = [
-            'undefined',
-            'talking',
-            'holding',
-            'talking',
-            'undefined',
-        ]
-
-        result = self.schema().dump(self.line)
-        assert_that(result, has_entries(state='holding'))
-
-    def test_set_state_talking(self):
-        self.line.channels_state = [
-            'undefined',
-            'talking',
-            'undefined',
-        ]
-
-        result = self.schema().dump(self.line)
-        assert_that(result, has_entries(state='talking'))
-
-    def test_set_state_to_endpoint_state(self):
-        self.line.endpoint_state = 'available'
-        self.line.channels_state = ['undefined']
-
-        result = self.schema().dump(self.line)
-        assert_that(result, has_entries(state='available'))
-
-    def test_set_state_default_to_unavalaible(self):
-        self.line.endpoint_state = None
-        self.line.channels_state = []
-
-        result = self.schema().dump(self.line)
-        assert_that(result, has_entries(state='unavailable'))
+    def test_same_as_schema_without_relations(self):
+        self.user.last_activity = datetime.datetime(
+            2021, 3, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=-5))
+        )
+        self.user.sessions = []
+        self.user.lines = []
+        self.user.refresh_tokens = []
+
+        result = dump_presence(self.user)
+        assert_that(result, equal_to(UserPresenceSchema().dump(self.user)))
+
+
+class TestBulkUpdateRequestSchema(unittest.TestCase):
+
+    schema = BulkUpdateRequestSchema
+
+    def test_load(self):
+        body = {
+            'items': [{'uuid': str(UUID), 'state': 'away', 'line_state': 'talking'}]
+        }
+
+        result = self.schema().load(body)
+        assert_that(result, equal_to({'items': [{'uuid': UUID, 'state': 'away'}]}))
+
+    def test_load_invalid(self):
+        for body in (
+            {'items': []},
+            {'items': [{'state': 'away'}]},
+            {'items': [{'uuid': str(UUID), 'state': 'invalid'}]},
+        ):
+            assert_that(
+                calling(self.schema().load).with_args(body), raises(ValidationError)
+            )
 
 
 class TestListRequestSchema(unittest.TestCase):
@@ -250,6 +194,15 @@ class TestListRequestSchema(unittest.TestCase):
         result = self.schema().load(self.request_args)
         assert_that(result, has_entries(uuids=empty()))
 
+    def test_line_state_invalid(self):
+        self.request_args.to_dict.return_value = {'line_state': 'invalid'}
+        self.request_args.get.return_value = None
+
+        assert_that(
+            calling(self.schema().load).with_args(self.request_args),
+            raises(ValidationError),
+        )
+
     def test_get_user_uuid_with_wrong_ending(self):
         uuid_1 = uuid.uuid4()
         user_uuid = f'{uuid_1},'
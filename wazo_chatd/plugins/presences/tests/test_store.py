@@ -0,0 +1,271 @@
+# Copyright 2021 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import uuid
+import unittest
+
+from mock import Mock
+from hamcrest import (
+    assert_that,
+    calling,
+    contains,
+    contains_inanyorder,
+    empty,
+    equal_to,
+    has_entries,
+    has_length,
+    is_not,
+    raises,
+)
+
+from wazo_chatd.exceptions import UnknownUserException
+
+from ..schemas import dump_presence
+from ..store import LineOwnerCache, PresenceStore
+
+TENANT_UUID_1 = uuid.uuid4()
+TENANT_UUID_2 = uuid.uuid4()
+
+
+def user(tenant_uuid=TENANT_UUID_1, **kwargs):
+    kwargs.setdefault('uuid', uuid.uuid4())
+    kwargs.setdefault('state', 'available')
+    kwargs.setdefault('line_state', 'unavailable')
+    return Mock(
+        tenant_uuid=tenant_uuid,
+        status=None,
+        last_activity=None,
+        do_not_disturb=False,
+        sessions=[],
+        lines=[],
+        refresh_tokens=[],
+        **kwargs,
+    )
+
+
+class TestPresenceStore(unittest.TestCase):
+    def setUp(self):
+        self.store = PresenceStore()
+        self.user_1 = user(TENANT_UUID_1)
+        self.user_2 = user(TENANT_UUID_2)
+
+    def test_load(self):
+        assert_that(self.store.is_loaded(), equal_to(False))
+
+        self.store.load([self.user_1, self.user_2])
+
+        assert_that(self.store.is_loaded(), equal_to(True))
+        assert_that(
+            self.store.list_(None),
+            contains_inanyorder(
+                has_entries(uuid=str(self.user_1.uuid)),
+                has_entries(uuid=str(self.user_2.uuid)),
+            ),
+        )
+
+    def test_load_keeps_presences_changed_while_loading(self):
+        self.store.load([self.user_1, self.user_2])
+        since = self.store.sequence()
+        snapshot = [self.user_1, self.user_2]
+        updated_user = user(TENANT_UUID_1, uuid=self.user_1.uuid, state='away')
+        self.store.update(dump_presence(updated_user))
+        self.store.delete(self.user_2.uuid)
+
+        self.store.load(snapshot, since=since)
+
+        assert_that(
+            self.store.list_(None),
+            contains(has_entries(uuid=str(self.user_1.uuid), state='away')),
+        )
+
+    def test_reload_keeps_presences_changed_while_loading(self):
+        self.store.load([self.user_1])
+        since = self.store.sequence()
+        updated_user = user(TENANT_UUID_1, uuid=self.user_1.uuid, state='away')
+        self.store.update(dump_presence(updated_user))
+
+        result = self.store.reload([self.user_1], since=since)
+
+        assert_that(result, empty())
+        assert_that(
+            self.store.get([TENANT_UUID_1], self.user_1.uuid), has_entries(state='away')
+        )
+
+    def test_reload_returns_changed_users(self):
+        self.store.load([self.user_1, self.user_2])
+        self.user_2.state = 'away'
+        user_3 = user(TENANT_UUID_1)
+
+        result = self.store.reload([self.user_1, self.user_2, user_3])
+
+        assert_that(result, contains_inanyorder(self.user_2, user_3))
+        assert_that(
+            self.store.get([TENANT_UUID_2], self.user_2.uuid), has_entries(state='away')
+        )
+
+    def test_reload_removes_missing_users(self):
+        self.store.load([self.user_1, self.user_2])
+
+        self.store.reload([self.user_1])
+
+        assert_that(
+            self.store.list_(None),
+            contains(has_entries(uuid=str(self.user_1.uuid))),
+        )
+
+    def test_update(self):
+        self.store.load([self.user_1])
+        self.user_1.state = 'away'
+
+        result = self.store.update(dump_presence(self.user_1))
+
+        assert_that(result, has_entries(uuid=str(self.user_1.uuid), state='away'))
+        assert_that(
+            self.store.get([TENANT_UUID_1], self.user_1.uuid),
+            has_entries(state='away', line_state='unavailable', connected=False),
+        )
+
+    def test_get_wrong_tenant(self):
+        self.store.load([self.user_1])
+
+        assert_that(
+            calling(self.store.get).with_args([TENANT_UUID_2], self.user_1.uuid),
+            raises(UnknownUserException),
+        )
+
+    def test_list_filtered(self):
+        self.store.load([self.user_1, self.user_2])
+
+        result = self.store.list_([str(TENANT_UUID_1)])
+        assert_that(result, contains(has_entries(uuid=str(self.user_1.uuid))))
+
+        result = self.store.list_(None, uuids=[self.user_2.uuid])
+        assert_that(result, contains(has_entries(uuid=str(self.user_2.uuid))))
+
+        result = self.store.count([TENANT_UUID_1], uuids=[self.user_2.uuid])
+        assert_that(result, equal_to(0))
+
+    def test_list_filtered_by_line_state(self):
+        self.user_2.line_state = 'talking'
+        self.store.load([self.user_1, self.user_2])
+
+        result = self.store.list_(None, line_state='talking')
+        assert_that(result, contains(has_entries(uuid=str(self.user_2.uuid))))
+
+    def test_version_bumped_on_change(self):
+        self.store.load([self.user_1, self.user_2])
+        version_1 = self.store.version([TENANT_UUID_1])
+        version_2 = self.store.version([TENANT_UUID_2])
+
+        self.store.update(dump_presence(self.user_1))
+        assert_that(self.store.version([TENANT_UUID_1]), equal_to(version_1))
+
+        self.user_1.state = 'away'
+        self.store.update(dump_presence(self.user_1))
+        assert_that(self.store.version([TENANT_UUID_1]), is_not(equal_to(version_1)))
+        assert_that(self.store.version([TENANT_UUID_2]), equal_to(version_2))
+
+        self.store.delete(self.user_2.uuid)
+        assert_that(self.store.version([TENANT_UUID_2]), is_not(equal_to(version_2)))
+
+    def test_changes_without_cursor_is_snapshot(self):
+        self.store.load([self.user_1, self.user_2])
+
+        presences, deleted, _, snapshot = self.store.changes([TENANT_UUID_1])
+
+        assert_that(presences, contains(has_entries(uuid=str(self.user_1.uuid))))
+        assert_that(deleted, empty())
+        assert_that(snapshot, equal_to(True))
+
+    def test_changes_since_cursor(self):
+        user_3 = user(TENANT_UUID_1)
+        self.store.load([self.user_1, self.user_2, user_3])
+        _, _, cursor, _ = self.store.changes(None)
+
+        self.user_1.state = 'away'
+        self.store.update(dump_presence(self.user_1))
+        self.store.update(dump_presence(self.user_2))
+        self.store.delete(user_3.uuid)
+
+        presences, deleted, next_cursor, snapshot = self.store.changes(
+            [TENANT_UUID_1], since=cursor
+        )
+        assert_that(
+            presences, contains(has_entries(uuid=str(self.user_1.uuid), state='away'))
+        )
+        assert_that(deleted, contains(str(user_3.uuid)))
+        assert_that(snapshot, equal_to(False))
+
+        result = self.store.changes([TENANT_UUID_1], since=next_cursor)
+        assert_that(result, contains(empty(), empty(), next_cursor, False))
+
+    def test_changes_since_evicted_cursor_is_snapshot(self):
+        self.store = PresenceStore(change_log_size=1)
+        self.store.load([self.user_1, self.user_2])
+        _, _, cursor, _ = self.store.changes(None)
+
+        self.user_1.state = 'away'
+        self.store.update(dump_presence(self.user_1))
+        self.user_2.state = 'away'
+        self.store.update(dump_presence(self.user_2))
+
+        presences, _, _, snapshot = self.store.changes(None, since=cursor)
+        assert_that(presences, has_length(2))
+        assert_that(snapshot, equal_to(True))
+
+    def test_changes_since_cursor_before_load_is_snapshot(self):
+        self.store.load([self.user_1])
+        _, _, cursor, _ = self.store.changes(None)
+
+        self.store.load([self.user_1])
+
+        _, _, _, snapshot = self.store.changes(None, since=cursor)
+        assert_that(snapshot, equal_to(True))
+
+    def test_delete(self):
+        self.store.load([self.user_1, self.user_2])
+
+        self.store.delete(self.user_1.uuid)
+        self.store.delete_tenant(TENANT_UUID_2)
+
+        assert_that(self.store.list_(None), empty())
+
+
+class TestLineOwnerCache(unittest.TestCase):
+    def setUp(self):
+        self.dao = Mock()
+        self.cache = LineOwnerCache(self.dao)
+
+    def test_get_is_cached(self):
+        owner = Mock(id=1)
+        self.dao.line.find_owner.return_value = owner
+
+        self.cache.get('PJSIP/abcd')
+        result = self.cache.get('PJSIP/abcd')
+
+        assert_that(result, equal_to(owner))
+        self.dao.line.find_owner.assert_called_once_with('PJSIP/abcd')
+
+    def test_get_unknown_endpoint_is_cached(self):
+        self.dao.line.find_owner.return_value = None
+
+        self.cache.get('PJSIP/trunk')
+        result = self.cache.get('PJSIP/trunk')
+
+        assert_that(result, equal_to(None))
+        self.dao.line.find_owner.assert_called_once_with('PJSIP/trunk')
+
+    def test_discard(self):
+        self.dao.line.find_owner.side_effect = lambda name: (
+            Mock(id=1) if name == 'PJSIP/abcd' else None
+        )
+        self.cache.get('PJSIP/abcd')
+        self.cache.get('PJSIP/efgh')
+        self.cache.get('PJSIP/ijkl')
+
+        self.cache.discard(1, 'PJSIP/efgh')
+        self.cache.get('PJSIP/abcd')
+        self.cache.get('PJSIP/efgh')
+        self.cache.get('PJSIP/ijkl')
+
+        assert_that(self.dao.line.find_owner.call_count, equal_to(5))
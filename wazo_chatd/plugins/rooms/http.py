@@ -1,4 +1,4 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from marshmallow import ValidationError
@@ -6,20 +6,41 @@ from flask import request
 
 from xivo.auth_verifier import required_acl
 from xivo.mallow.validate import Length
-from xivo.tenant_flask_helpers import token
+from xivo.tenant_flask_helpers import Tenant, token
 
 from wazo_chatd.http import AuthResource
+from wazo_chatd.plugin_helpers.http import is_not_modified, version_headers
 from wazo_chatd.database.models import Room, RoomUser, RoomMessage
 
 from .exceptions import DuplicateUserException
 from .schemas import (
+    Cursor,
+    ImportRequestSchema,
     ListRequestSchema,
     MessageListRequestSchema,
     MessageSchema,
     RoomSchema,
+    message_schema,
+    room_schema,
 )
 
 
+def _is_keyset(filter_parameters):
+    return (
+        filter_parameters.get('before') is not None
+        or filter_parameters.get('after') is not None
+    )
+
+
+def _keyset_page(messages):
+    page = {'items': message_schema.dump(messages, many=True)}
+    if messages:
+        keys = [(message.created_at, message.uuid) for message in messages]
+        page['before'] = Cursor().serialize('before', {'before': min(keys)})
+        page['after'] = Cursor().serialize('after', {'after': max(keys)})
+    return page
+
+
 class UserRoomListResource(AuthResource):
     def __init__(self, service):
         self._service = service
@@ -44,7 +65,7 @@ class UserRoomListResource(AuthResource):
         room = Room(**room_args)
 
         room = self._service.create(room)
-        return RoomSchema().dump(room), 201
+        return room_schema.dump(room), 201
 
     def _current_user_is_in_room(self, current_user_uuid, room_args):
         return any(
@@ -62,14 +83,24 @@ class UserRoomListResource(AuthResource):
 
     @required_acl('chatd.users.me.rooms.read')
     def get(self):
+        version = self._service.rooms_version(token.user_uuid)
+        headers = version_headers(version)
+        if is_not_modified(version):
+            return '', 304, headers
+
         filter_parameters = {'user_uuid': token.user_uuid}
-        rooms = self._service.list_([token.tenant_uuid], **filter_parameters)
-        filtered = total = self._service.count([token.tenant_uuid], **filter_parameters)
-        return {
-            'items': RoomSchema().dump(rooms, many=True),
-            'filtered': filtered,
-            'total': total,
-        }
+        rooms, filtered, total = self._service.list_with_count(
+            [token.tenant_uuid], **filter_parameters
+        )
+        return (
+            {
+                'items': room_schema.dump(rooms, many=True),
+                'filtered': filtered,
+                'total': total,
+            },
+            200,
+            headers,
+        )
 
 
 class UserMessageListResource(AuthResource):
@@ -79,18 +110,20 @@ class UserMessageListResource(AuthResource):
     @required_acl('chatd.users.me.rooms.messages.read')
     def get(self):
         filter_parameters = MessageListRequestSchema().load(request.args)
-        messages = self._service.list_user_messages(
+        if _is_keyset(filter_parameters):
+            messages = self._service.list_user_messages(
+                token.tenant_uuid, token.user_uuid, **filter_parameters
+            )
+            return _keyset_page(messages)
+
+        messages, filtered, total = self._service.list_user_messages_with_count(
             token.tenant_uuid, token.user_uuid, **filter_parameters
         )
-        filtered = self._service.count_user_messages(
-            token.tenant_uuid, token.user_uuid, **filter_parameters
+        return dict(
+            _keyset_page(messages),
+            filtered=filtered,
+            total=total,
         )
-        total = self._service.count_user_messages(token.tenant_uuid, token.user_uuid)
-        return {
-            'items': MessageSchema().dump(messages, many=True),
-            'filtered': filtered,
-            'total': total,
-        }
 
 
 class UserRoomMessageListResource(AuthResource):
@@ -106,17 +139,32 @@ class UserRoomMessageListResource(AuthResource):
         message = RoomMessage(**message_args)
 
         message = self._service.create_message(room, message)
-        return MessageSchema().dump(message), 201
+        return message_schema.dump(message), 201
 
     @required_acl('chatd.users.me.rooms.{room_uuid}.messages.read')
     def get(self, room_uuid):
         filter_parameters = ListRequestSchema().load(request.args)
         room = self._service.get([token.tenant_uuid], room_uuid)
-        messages = self._service.list_messages(room, **filter_parameters)
-        filtered = self._service.count_messages(room, **filter_parameters)
-        total = self._service.count_messages(room)
-        return {
-            'items': MessageSchema().dump(messages, many=True),
-            'filtered': filtered,
-            'total': total,
-        }
+        if _is_keyset(filter_parameters):
+            messages = self._service.list_messages(room, **filter_parameters)
+            return _keyset_page(messages)
+
+        messages, filtered, total = self._service.list_messages_with_count(
+            room, **filter_parameters
+        )
+        return dict(
+            _keyset_page(messages),
+            filtered=filtered,
+            total=total,
+        )
+
+
+class RoomImportResource(AuthResource):
+    def __init__(self, service):
+        self._service = service
+
+    @required_acl('chatd.rooms.import.create')
+    def post(self):
+        tenant_uuid = Tenant.autodetect().uuid
+        parameters = ImportRequestSchema().load(request.get_json())
+        return self._service.import_(tenant_uuid, **parameters), 201
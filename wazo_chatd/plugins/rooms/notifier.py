@@ -1,12 +1,16 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from itertools import islice
+
 from xivo_bus.resources.chatd.events import (
     UserRoomCreatedEvent,
     UserRoomMessageCreatedEvent,
 )
 
-from .schemas import RoomSchema, MessageSchema
+from .schemas import room_schema, message_schema
+
+IMPORT_EVENTS_BATCH_SIZE = 1000
 
 
 class RoomNotifier:
@@ -14,17 +18,57 @@ class RoomNotifier:
         self._bus = bus
 
     def created(self, room):
-        room_json = RoomSchema().dump(room)
-        for user in room_json['users']:
-            event = UserRoomCreatedEvent(user['uuid'], room_json)
-            self._bus.publish(
-                event, headers={'user_uuid:{uuid}'.format(uuid=user['uuid']): True}
+        room_json = room_schema.dump(room)
+        events = [
+            (
+                UserRoomCreatedEvent(user['uuid'], room_json),
+                {'user_uuid:{uuid}'.format(uuid=user['uuid']): True},
             )
+            for user in room_json['users']
+        ]
+        self._bus.publish_many(events)
 
     def message_created(self, room, message):
-        message_json = MessageSchema().dump(message)
-        for user in room.users:
-            event = UserRoomMessageCreatedEvent(user.uuid, room.uuid, message_json)
-            self._bus.publish(
-                event, headers={'user_uuid:{uuid}'.format(uuid=user.uuid): True}
+        message_json = message_schema.dump(message)
+        events = [
+            (
+                UserRoomMessageCreatedEvent(user.uuid, room.uuid, message_json),
+                {'user_uuid:{uuid}'.format(uuid=user.uuid): True},
             )
+            for user in room.users
+        ]
+        self._bus.publish_many(events)
+
+    def imported(self, rooms, created_room_uuids, created_message_uuids):
+        events = self._imported_events(
+            rooms,
+            set(str(uuid) for uuid in created_room_uuids),
+            set(str(uuid) for uuid in created_message_uuids),
+        )
+        # A large import is published in bounded batches
+        while True:
+            batch = list(islice(events, IMPORT_EVENTS_BATCH_SIZE))
+            if not batch:
+                return
+            self._bus.publish_many(batch)
+
+    def _imported_events(self, rooms, created_room_uuids, created_message_uuids):
+        for room in rooms:
+            room_json = room_schema.dump(room)
+            if room_json['uuid'] in created_room_uuids:
+                for user in room_json['users']:
+                    yield (
+                        UserRoomCreatedEvent(user['uuid'], room_json),
+                        {'user_uuid:{uuid}'.format(uuid=user['uuid']): True},
+                    )
+            for message in room['messages']:
+                if str(message['uuid']) not in created_message_uuids:
+                    continue
+                message_json = message_schema.dump(dict(message, room=room))
+                for user in room_json['users']:
+                    yield (
+                        UserRoomMessageCreatedEvent(
+                            user['uuid'], room_json['uuid'], message_json
+                        ),
+                        {'user_uuid:{uuid}'.format(uuid=user['uuid']): True},
+                    )
@@ -1,7 +1,10 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from wazo_chatd.plugin_helpers.versions import VersionTracker
+
 from .http import (
+    RoomImportResource,
     UserRoomListResource,
     UserMessageListResource,
     UserRoomMessageListResource,
@@ -18,7 +21,7 @@ class Plugin:
         bus_publisher = dependencies['bus_publisher']
 
         notifier = RoomNotifier(bus_publisher)
-        service = RoomService(config['uuid'], dao, notifier)
+        service = RoomService(config['uuid'], dao, notifier, VersionTracker())
 
         api.add_resource(
             UserRoomListResource, '/users/me/rooms', resource_class_args=[service]
@@ -33,3 +36,6 @@ class Plugin:
             '/users/me/rooms/<uuid:room_uuid>/messages',
             resource_class_args=[service],
         )
+        api.add_resource(
+            RoomImportResource, '/rooms/import', resource_class_args=[service]
+        )
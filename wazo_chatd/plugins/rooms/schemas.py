@@ -1,6 +1,11 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import base64
+import binascii
+import datetime
+import uuid
+
 from marshmallow import EXCLUDE, validates_schema
 from xivo.mallow import fields, validate
 from xivo.mallow_helpers import Schema, ListSchema as _ListSchema, ValidationError
@@ -33,7 +38,78 @@ class MessageSchema(Schema):
     room = fields.Nested('RoomSchema', dump_only=True, only=['uuid'])
 
 
-class ListRequestSchema(_ListSchema):
+class ImportRoomUserSchema(RoomUserSchema):
+    uuid = fields.UUID(required=True)
+
+
+class ImportMessageSchema(Schema):
+    uuid = fields.UUID()
+    content = fields.String(required=True)
+    alias = fields.String(validate=validate.Length(max=256), allow_none=True)
+    user_uuid = fields.UUID(required=True)
+    created_at = fields.DateTime()
+
+
+class ImportRoomSchema(Schema):
+    uuid = fields.UUID()
+    name = fields.String(allow_none=True)
+
+    users = fields.Nested(
+        'ImportRoomUserSchema', many=True, missing=[], unknown=EXCLUDE
+    )
+    messages = fields.Nested(
+        'ImportMessageSchema', many=True, missing=[], unknown=EXCLUDE
+    )
+
+
+class ImportRequestSchema(Schema):
+    rooms = fields.Nested(
+        'ImportRoomSchema',
+        many=True,
+        required=True,
+        validate=validate.Length(min=1),
+        unknown=EXCLUDE,
+    )
+    notify = fields.Boolean(missing=False)
+
+
+# Building a schema copies all its fields, the instances are reused to dump
+room_schema = RoomSchema()
+message_schema = MessageSchema()
+
+
+class Cursor(fields.Field):
+    default_error_messages = {'invalid': 'Not a valid cursor.'}
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        if value is None:
+            return None
+        created_at, uuid_ = value
+        raw = '{}|{}'.format(created_at.isoformat(), uuid_)
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        try:
+            raw = base64.urlsafe_b64decode(value.encode()).decode()
+            created_at, uuid_ = raw.split('|')
+            return datetime.datetime.fromisoformat(created_at), uuid.UUID(uuid_)
+        except (binascii.Error, UnicodeError, ValueError):
+            self.fail('invalid')
+
+
+class _CursorListSchema(_ListSchema):
+    before = Cursor()
+    after = Cursor()
+
+    @validates_schema
+    def single_cursor(self, data):
+        if data.get('before') and data.get('after'):
+            raise ValidationError('Only one of before or after can be used')
+        if (data.get('before') or data.get('after')) and data.get('order') == 'rank':
+            raise ValidationError('Cannot use before or after when ordering by rank')
+
+
+class ListRequestSchema(_CursorListSchema):
     default_sort_column = 'created_at'
     sort_columns = ['created_at']
     searchable_columns = []
@@ -41,9 +117,9 @@ class ListRequestSchema(_ListSchema):
     from_date = fields.DateTime()
 
 
-class MessageListRequestSchema(_ListSchema):
+class MessageListRequestSchema(_CursorListSchema):
     default_sort_column = 'created_at'
-    sort_columns = ['created_at']
+    sort_columns = ['created_at', 'rank']
     searchable_columns = []
     default_direction = 'desc'
 
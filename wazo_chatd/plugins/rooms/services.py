@@ -1,19 +1,39 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import datetime
+import logging
+import time
+import uuid
+
+from wazo_chatd.database.helpers import on_commit
+
+logger = logging.getLogger(__name__)
+
 
 class RoomService:
-    def __init__(self, wazo_uuid, dao, notifier):
+    def __init__(self, wazo_uuid, dao, notifier, versions):
         self._dao = dao
         self._notifier = notifier
         self._wazo_uuid = wazo_uuid
+        self._versions = versions
 
     def create(self, room):
         self._set_default_room_values(room)
         self._dao.room.create(room)
         self._notifier.created(room)
+        self._bump_versions(room)
         return room
 
+    def _bump_versions(self, room):
+        # A version bumped before the commit could be returned with the
+        # previous content and then never change
+        user_uuids = [user.uuid for user in room.users]
+        on_commit(lambda: self._versions.bump(*user_uuids))
+
+    def rooms_version(self, user_uuid):
+        return self._versions.get([user_uuid])
+
     def _set_default_room_values(self, room):
         for user in room.users:
             if user.tenant_uuid is None:
@@ -27,6 +47,9 @@ class RoomService:
     def count(self, tenant_uuids, **filter_parameters):
         return self._dao.room.count(tenant_uuids, **filter_parameters)
 
+    def list_with_count(self, tenant_uuids, **filter_parameters):
+        return self._dao.room.list_with_count(tenant_uuids, **filter_parameters)
+
     def get(self, tenant_uuids, room_uuid):
         return self._dao.room.get(tenant_uuids, room_uuid)
 
@@ -34,17 +57,73 @@ class RoomService:
         self._set_default_message_values(message)
         self._dao.room.add_message(room, message)
         self._notifier.message_created(room, message)
+        self._bump_versions(room)
         return message
 
     def _set_default_message_values(self, message):
         message.wazo_uuid = self._wazo_uuid
 
+    def import_(self, tenant_uuid, rooms, notify=False):
+        started_at = time.monotonic()
+        for room in rooms:
+            self._set_default_import_values(tenant_uuid, room)
+        created_rooms, created_messages = self._dao.room.import_(tenant_uuid, rooms)
+        if notify:
+            # A rolled back import must not be notified
+            on_commit(
+                lambda: self._notifier.imported(rooms, created_rooms, created_messages)
+            )
+
+        user_uuids = [user['uuid'] for room in rooms for user in room['users']]
+        on_commit(lambda: self._versions.bump(*user_uuids))
+
+        duration = time.monotonic() - started_at
+        # The clock resolution can be coarser than a small import
+        messages_per_second = len(created_messages) / duration if duration else 0
+        logger.info(
+            'Imported %s rooms and %s messages in %.0f ms (%.0f messages/s)',
+            len(created_rooms),
+            len(created_messages),
+            duration * 1000,
+            messages_per_second,
+        )
+        return {
+            'rooms_created': len(created_rooms),
+            'messages_created': len(created_messages),
+            'duration_ms': round(duration * 1000, 3),
+            'messages_per_second': round(messages_per_second, 3),
+        }
+
+    def _set_default_import_values(self, tenant_uuid, room):
+        room.setdefault('uuid', uuid.uuid4())
+        room.setdefault('name', None)
+        room['tenant_uuid'] = tenant_uuid
+        for user in room['users']:
+            user.setdefault('tenant_uuid', tenant_uuid)
+            user.setdefault('wazo_uuid', self._wazo_uuid)
+        for message in room['messages']:
+            message.setdefault('uuid', uuid.uuid4())
+            message.setdefault('alias', None)
+            # As for a created message, the sender is in the tenant of the room
+            message['tenant_uuid'] = tenant_uuid
+            message['wazo_uuid'] = self._wazo_uuid
+            message['room_uuid'] = room['uuid']
+            created_at = message.get('created_at') or datetime.datetime.utcnow()
+            # The messages are stored in UTC without timezone
+            if created_at.tzinfo:
+                created_at = created_at.astimezone(datetime.timezone.utc)
+                created_at = created_at.replace(tzinfo=None)
+            message['created_at'] = created_at
+
     def list_messages(self, room, **filter_parameters):
         return self._dao.room.list_messages(room, **filter_parameters)
 
     def count_messages(self, room, **filter_parameters):
         return self._dao.room.count_messages(room, **filter_parameters)
 
+    def list_messages_with_count(self, room, **filter_parameters):
+        return self._dao.room.list_messages_with_count(room, **filter_parameters)
+
     def list_user_messages(self, tenant_uuid, user_uuid, **filter_parameters):
         return self._dao.room.list_user_messages(
             tenant_uuid, user_uuid, **filter_parameters
@@ -55,6 +134,13 @@ class RoomService:
             tenant_uuid, user_uuid, **filter_parameters
         )
 
+    def list_user_messages_with_count(
+        self, tenant_uuid, user_uuid, **filter_parameters
+    ):
+        return self._dao.room.list_user_messages_with_count(
+            tenant_uuid, user_uuid, **filter_parameters
+        )
+
     def list_latest_user_messages(self, tenant_uuid, user_uuid, **filter_parameters):
         return self._dao.room.list_latest_user_messages(
             tenant_uuid, user_uuid, **filter_parameters
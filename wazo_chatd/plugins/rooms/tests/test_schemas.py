@@ -1,12 +1,21 @@
-# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2019-2021 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import datetime
 import unittest
+import uuid
 
-from hamcrest import assert_that, calling, has_entries, not_, raises
+from hamcrest import assert_that, calling, contains, has_entries, not_, raises
 from xivo.mallow_helpers import ValidationError
 
-from ..schemas import ListRequestSchema, MessageListRequestSchema
+from ..schemas import (
+    Cursor,
+    ImportRequestSchema,
+    ListRequestSchema,
+    MessageListRequestSchema,
+)
+
+MESSAGE_KEY = (datetime.datetime(2021, 1, 2, 3, 4, 5, 6789), uuid.uuid4())
 
 
 class TestListRequestSchema(unittest.TestCase):
@@ -21,6 +30,27 @@ class TestListRequestSchema(unittest.TestCase):
         result = self.schema().load({})
         assert_that(result, has_entries(order='created_at'))
 
+    def test_load_cursor(self):
+        cursor = Cursor().serialize('before', {'before': MESSAGE_KEY})
+
+        result = self.schema().load({'before': cursor})
+
+        assert_that(result, has_entries(before=contains(*MESSAGE_KEY)))
+
+    def test_load_cursor_invalid(self):
+        assert_that(
+            calling(self.schema().load).with_args({'after': 'invalid'}),
+            raises(ValidationError),
+        )
+
+    def test_load_before_and_after(self):
+        cursor = Cursor().serialize('before', {'before': MESSAGE_KEY})
+
+        assert_that(
+            calling(self.schema().load).with_args({'before': cursor, 'after': cursor}),
+            raises(ValidationError, pattern='before or after'),
+        )
+
 
 class TestMessageListRequestSchema(unittest.TestCase):
 
@@ -35,3 +65,54 @@ class TestMessageListRequestSchema(unittest.TestCase):
             calling(self.schema().load).with_args({'search': 'ok'}),
             not_(raises(ValidationError, pattern='search or distinct')),
         )
+
+
+class TestImportRequestSchema(unittest.TestCase):
+
+    schema = ImportRequestSchema
+
+    def test_load(self):
+        user_uuid = uuid.uuid4()
+        body = {
+            'rooms': [
+                {
+                    'users': [{'uuid': str(user_uuid)}],
+                    'messages': [
+                        {
+                            'content': 'hello',
+                            'user_uuid': str(user_uuid),
+                            'created_at': '2021-01-02T03:04:05+00:00',
+                        }
+                    ],
+                },
+            ],
+        }
+
+        result = self.schema().load(body)
+
+        assert_that(
+            result,
+            has_entries(
+                notify=False,
+                rooms=contains(
+                    has_entries(
+                        users=contains(has_entries(uuid=user_uuid)),
+                        messages=contains(
+                            has_entries(content='hello', user_uuid=user_uuid)
+                        ),
+                    )
+                ),
+            ),
+        )
+
+    def test_load_invalid(self):
+        for body in (
+            {},
+            {'rooms': []},
+            {'rooms': [{'users': [{}]}]},
+            {'rooms': [{'messages': [{'content': 'hello'}]}]},
+        ):
+            assert_that(
+                calling(self.schema().load).with_args(body),
+                raises(ValidationError),
+            )
@@ -0,0 +1,295 @@
+# Copyright 2021 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import threading
+import time
+import unittest
+
+from collections import defaultdict
+
+from hamcrest import assert_that, equal_to, has_entries, has_length
+from mock import ANY, Mock, patch, sentinel as s
+from xivo.status import Status
+
+from ..bus import Consumer, Publisher, _BatchMarshaler, _event_key
+
+CONFIG = {
+    'uuid': 'wazo-uuid',
+    'bus': {
+        'username': 'guest',
+        'password': 'guest',
+        'host': 'localhost',
+        'port': 5672,
+        'exchange_name': 'xivo',
+        'exchange_type': 'topic',
+        'publisher_queue_size': 2,
+        'publisher_max_retries': 3,
+        'consumer_queue_name': None,
+        'consumer_prefetch_count': 10,
+        'consumer_ack_batch_size': 2,
+        'consumer_ack_interval': 0,
+        'consumer_workers': 2,
+        'consumer_worker_queue_size': 10,
+    },
+}
+
+
+class TestConsumer(unittest.TestCase):
+    def setUp(self):
+        self.consumer = Consumer(CONFIG)
+        self.callback = Mock()
+        self.consumer.on_revived(self.callback)
+
+    def test_first_connection_does_not_call_revived_callbacks(self):
+        self.consumer.on_connection_revived()
+
+        self.callback.assert_not_called()
+        assert_that(self.consumer.is_running(), equal_to(True))
+
+    def test_reconnection_calls_revived_callbacks(self):
+        self.consumer.on_connection_revived()
+        self.consumer.on_connection_error(Exception(), 1)
+
+        self.consumer.on_connection_revived()
+
+        self.callback.assert_called_once_with()
+
+    def test_reconnection_with_named_queue_does_not_call_revived_callbacks(self):
+        config = dict(CONFIG, bus=dict(CONFIG['bus'], consumer_queue_name='chatd'))
+        consumer = Consumer(config)
+        consumer.on_revived(self.callback)
+
+        consumer.on_connection_revived()
+        consumer.on_connection_revived()
+
+        self.callback.assert_not_called()
+
+    def test_messages_acked_by_batch(self):
+        message_1, message_2 = Mock(), Mock()
+        body = {'name': 'event', 'data': {}}
+
+        self.consumer._on_bus_message(body, message_1)
+        self.consumer._on_bus_message(body, message_2)
+        message_2.ack.assert_not_called()
+
+        self._handle_dispatched()
+        self.consumer.on_iteration()
+
+        message_1.ack.assert_not_called()
+        message_2.ack.assert_called_once_with(multiple=True)
+
+    def test_messages_acked_after_previous_messages_are_handled(self):
+        self.consumer._dispatcher = Mock()
+        message_1, message_2 = Mock(), Mock()
+        self.consumer._on_bus_message({'name': 'event', 'data': {}}, message_1)
+        self.consumer._on_bus_message({'name': 'event', 'data': {}}, message_2)
+        (_, task_1), (_, task_2) = [
+            call[0] for call in self.consumer._dispatcher.dispatch.call_args_list
+        ]
+
+        task_2()
+        self.consumer.on_iteration()
+        message_2.ack.assert_not_called()
+
+        task_1()
+        self.consumer.on_iteration()
+        message_2.ack.assert_called_once_with(multiple=True)
+
+    def test_pending_acks_flushed_on_iteration(self):
+        message = Mock()
+        self.consumer._on_bus_message({'name': 'event', 'data': {}}, message)
+        self._handle_dispatched()
+
+        self.consumer.on_iteration()
+
+        message.ack.assert_called_once_with(multiple=True)
+
+    def test_deferred_ack(self):
+        acks = []
+        self.consumer.on_event(
+            'Hangup', lambda event: acks.append(self.consumer.defer_ack())
+        )
+        message = Mock()
+        self.consumer._on_bus_message({'name': 'Hangup', 'data': {}}, message)
+        self._handle_dispatched()
+
+        self.consumer.on_iteration()
+        message.ack.assert_not_called()
+
+        acks[0]()
+        self.consumer.on_iteration()
+        message.ack.assert_called_once_with(multiple=True)
+
+    def test_event_key(self):
+        self.consumer._dispatcher = Mock()
+        self.consumer.set_event_key(
+            lambda event: s.user_uuid if event.get('Device') else None
+        )
+
+        self.consumer._on_bus_message(
+            {'name': 'event', 'data': {'Device': 'a'}}, Mock()
+        )
+        self.consumer._on_bus_message({'name': 'event', 'data': {'uuid': 'b'}}, Mock())
+
+        keys = [
+            call[0][0] for call in self.consumer._dispatcher.dispatch.call_args_list
+        ]
+        assert_that(keys, equal_to([s.user_uuid, 'b']))
+
+    def test_event_key_error_uses_default_key(self):
+        self.consumer._dispatcher = Mock()
+        self.consumer.set_event_key(Mock(side_effect=Exception))
+
+        self.consumer._on_bus_message({'name': 'event', 'data': {'uuid': 'a'}}, Mock())
+
+        self.consumer._dispatcher.dispatch.assert_called_once_with('a', ANY)
+
+    def _handle_dispatched(self):
+        for tasks in self.consumer._dispatcher._queues:
+            while not tasks.empty():
+                tasks.get_nowait()()
+
+
+class TestEventKey(unittest.TestCase):
+    def test_channel_and_device_of_the_same_endpoint(self):
+        channel_key = _event_key({'Channel': 'PJSIP/abcd-00000001'})
+        device_key = _event_key({'Device': 'PJSIP/abcd'})
+
+        assert_that(channel_key, equal_to(device_key))
+
+    def test_user_events(self):
+        assert_that(_event_key({'user_uuid': s.user_uuid}), equal_to(s.user_uuid))
+        assert_that(_event_key({'user': {'uuid': s.user_uuid}}), equal_to(s.user_uuid))
+        assert_that(_event_key({'uuid': s.user_uuid}), equal_to(s.user_uuid))
+
+
+class TestPublisher(unittest.TestCase):
+    def setUp(self):
+        self.publisher = Publisher(CONFIG)
+
+    def test_publish_is_queued(self):
+        self.publisher.publish(s.event, headers=s.headers)
+
+        result = self.publisher._queue.get_nowait()
+
+        assert_that(result, equal_to([(s.event, s.headers)]))
+
+    def test_publish_many_is_queued_as_one_batch(self):
+        messages = [(s.event_1, s.headers_1), (s.event_2, s.headers_2)]
+
+        self.publisher.publish_many(messages)
+
+        assert_that(self.publisher._queue.qsize(), equal_to(1))
+        assert_that(self.publisher._queue.get_nowait(), equal_to(messages))
+
+    def test_publish_when_queue_is_full_then_event_dropped(self):
+        for _ in range(3):
+            self.publisher.publish_many([(s.event_1, None), (s.event_2, None)])
+
+        status = defaultdict(dict)
+        self.publisher.provide_status(status)
+
+        assert_that(
+            status['bus_publisher'],
+            has_entries(queue_size=2, dropped_events=2),
+        )
+
+    def test_publish_many_generator_when_queue_is_full(self):
+        for _ in range(3):
+            self.publisher.publish_many((event, None) for event in (s.e1, s.e2))
+
+        status = defaultdict(dict)
+        self.publisher.provide_status(status)
+
+        assert_that(status['bus_publisher'], has_entries(dropped_events=2))
+
+    def test_publish_records_latency_and_status(self):
+        publish = Mock()
+
+        self.publisher._publish(publish, [(s.event, s.headers)])
+
+        publish.assert_called_once_with(s.event, headers=s.headers)
+        status = defaultdict(dict)
+        self.publisher.provide_status(status)
+        assert_that(status['bus_publisher'], has_entries(status=Status.ok))
+
+    def test_publish_failure_sets_status_fail(self):
+        publish = Mock(side_effect=Exception)
+
+        self.publisher._publish(publish, [(Mock(name='event'), None)])
+
+        status = defaultdict(dict)
+        self.publisher.provide_status(status)
+        assert_that(status['bus_publisher'], has_entries(status=Status.fail))
+
+    def test_stop_when_broker_is_unreachable(self):
+        config = dict(CONFIG, bus=dict(CONFIG['bus'], host='127.0.0.1', port=1))
+        publisher = Publisher(config)
+        publisher.publish(Mock(name='event'))
+        thread = threading.Thread(target=publisher.run)
+        thread.start()
+        time.sleep(1)
+
+        publisher.stop()
+        thread.join(timeout=5)
+
+        assert_that(thread.is_alive(), equal_to(False))
+        status = defaultdict(dict)
+        publisher.provide_status(status)
+        assert_that(status['bus_publisher'], has_entries(dropped_events=1))
+
+
+def marshal_message(event):
+    return json.dumps(
+        {
+            'name': event.name,
+            'required_acl': event.required_acl,
+            'data': event.marshal(),
+        }
+    )
+
+
+def event(payload, required_acl=None):
+    event = Mock(marshal=Mock(return_value=payload), required_acl=required_acl)
+    event.name = 'event'
+    return event
+
+
+@patch('wazo_chatd.bus.Marshaler.marshal_message', side_effect=marshal_message)
+class TestBatchMarshaler(unittest.TestCase):
+    def setUp(self):
+        self.marshaler = _BatchMarshaler('wazo-uuid')
+
+    def test_marshal_message_shared_payload_serialized_once(self, _):
+        payload = {'content': 'hello'}
+
+        with patch('wazo_chatd.bus.json.dumps', wraps=json.dumps) as dumps:
+            self.marshaler.marshal_message(event(payload))
+            self.marshaler.marshal_message(event(payload))
+
+        dumped_payloads = [c for c in dumps.call_args_list if c[0][0] is payload]
+        assert_that(dumped_payloads, has_length(1))
+
+    def test_marshal_message_envelope_per_event(self, _):
+        payload = {'content': 'hello'}
+
+        result_1 = self.marshaler.marshal_message(event(payload, 'acl.user-1'))
+        result_2 = self.marshaler.marshal_message(event(payload, 'acl.user-2'))
+
+        assert_that(
+            json.loads(result_1),
+            equal_to({'name': 'event', 'required_acl': 'acl.user-1', 'data': payload}),
+        )
+        assert_that(
+            json.loads(result_2),
+            equal_to({'name': 'event', 'required_acl': 'acl.user-2', 'data': payload}),
+        )
+
+    def test_clear(self, _):
+        payload = {'content': 'hello'}
+        self.marshaler.marshal_message(event(payload))
+
+        self.marshaler.clear()
+
+        assert_that(self.marshaler._cache, equal_to({}))